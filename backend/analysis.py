@@ -0,0 +1,305 @@
+import math
+import multiprocessing
+import os
+import re
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Size of the chunks documents are read in
+CHUNK_SIZE = 1024 * 1024
+
+# Bytes kept between two PDF chunks so that a dictionary split across them is still seen whole
+PDF_OVERLAP = 4096
+
+# Largest decompressed PDF object stream we look into
+MAX_OBJECT_STREAM = 16 * 1024 * 1024
+
+# Layout used to turn a plain text file into printed pages
+TXT_LINES_PER_PAGE = 60
+TXT_CHARS_PER_LINE = 80
+
+PDF_PAGES_TYPE = re.compile(rb'/Type\s*/Pages\b')
+PDF_PAGE_TYPE = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+PDF_COUNT = re.compile(rb'/Count\s+(\d+)')
+PDF_STREAM = re.compile(rb'\bstream\r?\n')
+PDF_OBJECT_STREAM = re.compile(rb'/Type\s*/ObjStm\b')
+PDF_OBJECT = re.compile(rb'(?<![0-9])(\d+)\s+\d+\s+obj\b')
+PDF_CATALOG_TYPE = re.compile(rb'/Type\s*/Catalog\b')
+PDF_PAGES_REF = re.compile(rb'/Pages\s+(\d+)\s+\d+\s+R')
+PDF_ROOT_REF = re.compile(rb'/Root\s+(\d+)\s+\d+\s+R')
+PDF_FIRST = re.compile(rb'/First\s+(\d+)')
+PDF_WHITESPACE = re.compile(rb'[\0\t\n\f\r ]')
+DOCX_PAGES = re.compile(rb'<Pages>(\d+)</Pages>')
+DOCX_PAGE_BREAK = re.compile(rb'<w:br [^>]*w:type="page"')
+
+
+# Function to get the dictionary around position pos, i.e. the text between the innermost
+# unclosed '<<' before it and its matching '>>'
+def enclosing_dict(data, pos):
+    start = data.rfind(b'<<', 0, pos)
+    while start != -1 and data.count(b'>>', start, pos) >= data.count(b'<<', start, pos):
+        start = data.rfind(b'<<', 0, start)
+    if start == -1:
+        return b''
+    depth = 0
+    i = start
+    while i < len(data) - 1:
+        token = data[i:i + 2]
+        if token == b'<<':
+            depth += 1
+            i += 2
+        elif token == b'>>':
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return data[start:i]
+        else:
+            i += 1
+    return data[start:]
+
+
+# Scanner fed with the plain (non-stream) parts of a PDF and the contents of its object
+# streams, in file order. An incrementally saved PDF appends new versions of the objects it
+# changes, so only the last definition of every object number counts. The page count is the
+# /Count of the page tree root: the /Pages of the catalog named by the last trailer's /Root.
+# Files whose catalog it cannot resolve fall back to the largest /Count of the page trees
+# still defined, then to the number of /Type /Page objects.
+class PdfPageScanner:
+    def __init__(self):
+        self.root = None
+        # Catalog object number -> object number of its page tree root
+        self.catalogs = {}
+        # /Type /Pages object number -> its /Count
+        self.page_trees = {}
+        # Object number -> whether its last definition is a /Type /Page
+        self.pages = {}
+        # /Type /Page objects found outside of any numbered object
+        self.loose_pages = 0
+        # Number of the object the plain text scanned last belongs to
+        self.current = None
+
+    # Function to scan data[:limit]. The caller starts data at a token boundary and keeps the
+    # rest for the next call, so every match is seen exactly once.
+    def scan(self, data, limit):
+        for match in PDF_ROOT_REF.finditer(data, 0, limit):
+            self.root = int(match.group(1))
+        start = 0
+        for match in PDF_OBJECT.finditer(data, 0, limit):
+            self.scan_object(self.current, data, start, match.start())
+            self.current = self.define(int(match.group(1)))
+            start = match.end()
+        self.scan_object(self.current, data, start, limit)
+
+    # Function to scan the inflated contents of an object stream. It starts with the number
+    # and offset of every object it holds; the objects themselves start at byte first.
+    def scan_object_stream(self, data, first):
+        numbers = [int(number) for number in re.findall(rb'\d+', data[:first])]
+        objects = list(zip(numbers[0::2], numbers[1::2]))
+        for index, (number, offset) in enumerate(objects):
+            end = first + objects[index + 1][1] if index + 1 < len(objects) else len(data)
+            self.scan_object(self.define(number), data, first + offset, end)
+
+    # Function to start a new definition of an object, forgetting what earlier ones said
+    def define(self, number):
+        self.catalogs.pop(number, None)
+        self.page_trees.pop(number, None)
+        self.pages[number] = False
+        return number
+
+    def scan_object(self, number, data, start, end):
+        if start >= end:
+            return
+        for match in PDF_PAGES_TYPE.finditer(data, start, end):
+            count = PDF_COUNT.search(enclosing_dict(data, match.start()))
+            if count:
+                self.page_trees[number] = int(count.group(1))
+        for match in PDF_CATALOG_TYPE.finditer(data, start, end):
+            pages = PDF_PAGES_REF.search(enclosing_dict(data, match.start()))
+            if pages:
+                self.catalogs[number] = int(pages.group(1))
+        for match in PDF_PAGE_TYPE.finditer(data, start, end):
+            if number is None:
+                self.loose_pages += 1
+            else:
+                self.pages[number] = True
+
+    def result(self):
+        catalog = self.root
+        if catalog not in self.catalogs and len(self.catalogs) == 1:
+            catalog = next(iter(self.catalogs))
+        tree = self.catalogs.get(catalog)
+        if tree is not None and self.page_trees.get(tree):
+            return self.page_trees[tree]
+        counts = [count for count in self.page_trees.values() if count]
+        return max(counts) if counts else sum(self.pages.values()) + self.loose_pages
+
+
+# Function to count the pages of a PDF by streaming through it once. Text outside of streams is
+# scanned for the page tree, compressed object streams (PDF 1.5+) are inflated and scanned too,
+# and all other stream data (page contents, images, fonts) is skipped without being decoded.
+def count_pdf_pages(path):
+    scanner = PdfPageScanner()
+    buffer = b''
+    in_stream = False
+    inflater = None
+    inflated = b''
+    first = None
+
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            buffer += chunk
+            at_end = not chunk
+
+            while True:
+                if in_stream:
+                    end = buffer.find(b'endstream')
+                    if end == -1 and not at_end:
+                        # Keep enough bytes to see an 'endstream' split across chunks
+                        data, buffer = buffer[:-9], buffer[-9:]
+                    else:
+                        end = len(buffer) if end == -1 else end
+                        data, buffer = buffer[:end], buffer[end + len(b'endstream'):]
+                    if inflater is not None and len(inflated) < MAX_OBJECT_STREAM:
+                        try:
+                            inflated += inflater.decompress(data, MAX_OBJECT_STREAM - len(inflated))
+                        except zlib.error:
+                            inflater = None
+                    if end == -1 and not at_end:
+                        break
+                    if inflater is not None:
+                        if first is not None:
+                            scanner.scan_object_stream(inflated, first)
+                        else:
+                            scanner.scan(inflated, len(inflated))
+                    in_stream = False
+                    inflater = None
+                    inflated = b''
+                    continue
+
+                match = PDF_STREAM.search(buffer)
+                if match is None:
+                    limit = len(buffer) if at_end else max(len(buffer) - PDF_OVERLAP, 0)
+                    if not at_end:
+                        # Cut after whitespace, so the next buffer starts with a whole token
+                        space = max((m.end() for m in PDF_WHITESPACE.finditer(buffer, max(limit - PDF_OVERLAP, 0), limit)), default=None)
+                        limit = space if space is not None else limit
+                    scanner.scan(buffer, limit)
+                    buffer = buffer[limit:]
+                    break
+
+                # The stream dictionary is everything between 'obj' and 'stream'
+                stream_dict = buffer[buffer.rfind(b'obj', 0, match.start()) + 3:match.start()]
+                scanner.scan(buffer, match.start())
+                if PDF_OBJECT_STREAM.search(stream_dict) and b'/FlateDecode' in stream_dict:
+                    inflater = zlib.decompressobj()
+                    first = PDF_FIRST.search(stream_dict)
+                    first = int(first.group(1)) if first else None
+                buffer = buffer[match.end():]
+                in_stream = True
+
+            if at_end:
+                break
+
+    return scanner.result()
+
+
+# Function to count the pages of a DOCX. Word stores the page count of the last save in
+# docProps/app.xml; without it, explicit page breaks in the body are counted instead.
+def count_docx_pages(path):
+    with zipfile.ZipFile(path) as archive:
+        names = set(archive.namelist())
+        if 'docProps/app.xml' in names:
+            match = DOCX_PAGES.search(archive.read('docProps/app.xml'))
+            if match and int(match.group(1)) > 0:
+                return int(match.group(1))
+        if 'word/document.xml' not in names:
+            raise ValueError('Not a Word document')
+        breaks = 0
+        tail = b''
+        with archive.open('word/document.xml') as document:
+            while True:
+                chunk = document.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                data = tail + chunk
+                breaks += len(DOCX_PAGE_BREAK.findall(data))
+                # Keep the unfinished tag at the end so it is matched with the next chunk
+                cut = data.rfind(b'<')
+                tail = data[cut:] if cut != -1 else b''
+                breaks -= len(DOCX_PAGE_BREAK.findall(tail))
+        return breaks + 1
+
+
+# Function to count the printed pages of a text file, wrapping long lines
+def count_txt_pages(path):
+    lines = 0
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            lines += max(1, math.ceil(len(line.rstrip('\r\n')) / TXT_CHARS_PER_LINE))
+    return max(1, math.ceil(lines / TXT_LINES_PER_PAGE))
+
+
+# Function to count the pages of a stored upload; runs inside a worker process
+def count_pages(path, extension):
+    if extension == 'pdf':
+        return count_pdf_pages(path)
+    if extension == 'docx':
+        return count_docx_pages(path)
+    if extension == 'txt':
+        return count_txt_pages(path)
+    # Images print on a single page
+    return 1
+
+
+# Start method of the worker processes. By the time a pool starts, the web process runs the
+# writer, revocation and retention threads; a forked child could inherit a lock one of them
+# held (sqlite's own included) and hang on it. A fork server is forked from a clean process
+# instead; where there is none (Windows) workers start from scratch.
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+# Pool of worker processes doing CPU heavy work on uploads (page counting, image resizing)
+# off the request threads. Results are handed to the callback passed to submit, which runs
+# in a thread of the web process.
+class AnalysisPool:
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        # Jobs running right now, so the same blob is never processed twice at once
+        self.running = set()
+
+    def get_executor(self):
+        if self.executor is None or self.pid != os.getpid():
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context(START_METHOD))
+            self.pid = os.getpid()
+            self.running = set()
+        return self.executor
+
+    # Function to run function(path, *args) in a worker process and call callback(path, future)
+    # when it is done. Returns False if the same job for this path is already running.
+    def submit(self, path, function, args, callback):
+        key = (function.__name__, path)
+        with self.lock:
+            if key in self.running:
+                return False
+            self.running.add(key)
+            future = self.get_executor().submit(function, path, *args)
+
+        def done(future):
+            with self.lock:
+                self.running.discard(key)
+            callback(path, future)
+
+        future.add_done_callback(done)
+        return True
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            if self.executor is not None and self.pid == os.getpid():
+                self.executor.shutdown(wait=wait)
+            self.executor = None
@@ -1,64 +1,497 @@
 import datetime
-from flask import Flask, request, jsonify, send_from_directory, url_for
-from flask_bcrypt import Bcrypt
+import heapq
+import itertools
+import queue
+import threading
+import time
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify, send_from_directory, url_for
 from flask import send_from_directory, abort
 
 # JWT Manager for handling JWT tokens for user authentication
-from flask_jwt_extended import JWTManager, create_access_token, get_jwt, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt, jwt_required, get_jwt_identity, get_jwt_request_location
 from flask_cors import CORS
 import sqlite3
 import os
+import re
+import json
+import base64
+import unicodedata
+from collections import namedtuple
+from urllib.parse import quote
 
 # Secure filename to prevent path traversal attacks
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.exceptions import NotFound
+import mimetypes
 from werkzeug.security import generate_password_hash
 
 
-# Import create_tables function from models.py to create tables in the database
+# Import create_tables function from models.py to migrate the databases to the latest schema
 from models import create_tables
 
-app = Flask(__name__)
-app.config['JWT_SECRET_KEY'] = 'your_print_seva_secret_key'
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
-app.config['FILE_ALLOWED_EXTENSIONS'] = {'pdf', 'docx', 'txt', 'png', 'jpg', 'jpeg'}
+# Persistent per-thread database connections, see db.py
+from db import query_db, execute_db, transaction, snapshot, update_row, get_version, bump_version, statement_listeners
 
+# Chunked, hashed staging of uploaded print documents, see uploads.py
+from uploads import UploadRejected, file_extension, stage_upload, discard_upload
 
-bcrypt = Bcrypt(app)
-jwt = JWTManager(app)
-CORS(app)
+# Content-addressed, reference counted storage of uploaded files, see blobstore.py
+from blobstore import store_blob, release_blob
 
-# Create uploads directory if it doesn't exist
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+# bcrypt hashing in a bounded pool of worker processes, see passwords.py
+from passwords import PasswordHasher, PasswordPoolBusy
 
-# Create tables if they don't exist in the database, structure is defined in models.py file
-create_tables()
+# Page counting of uploaded documents in worker processes, see analysis.py
+from analysis import AnalysisPool, count_pages
 
-# In-memory storage for blacklisted tokens
-blacklist = set()
+# Thumbnail and medium sized variants of profile and shop images, see images.py
+from images import VARIANT_SIZES, VARIANT_FORMATS, is_blob, variant_path, make_variants
+
+# Revoked tokens shared across workers, see revocation.py
+from revocation import RevocationStore
+
+# Versioned in-process cache of serialized responses, see cache.py
+from cache import VersionedCache, LRUCache
+
+# Push channel for request changes, see events.py
+from events import ChangeBroker
+
+# Ordering of the accepted print jobs of a shop, see scheduler.py
+from scheduler import Job, POLICIES, schedule
+
+# Vectorized price quotes over the price table of every shop, see quotes.py
+from quotes import PriceTable
+
+# Archival of finished requests and garbage collection of uploads, see retention.py
+from retention import RetentionJob, TOMBSTONE_FLOOR
+
+# Group commit of the writes of many requests on one writer thread, see writer.py
+from writer import WriteQueue, WriteQueueFull
+
+# Placement of the requests of each shop on a shard database, see shards.py
+from shards import ShardMap, next_request_id
+
+# Latency, SQL and queue metrics in the Prometheus text format, see metrics.py
+from metrics import CONTENT_TYPE, Registry, RequestMetrics, current_request, statement_kind
+
+# Every route and hook of the API, registered on the app by create_app()
+api = Blueprint('api', __name__)
+
+
+# The password hasher, the write queues, the shard map, the analysis pool and the retention
+# job depend on the config, so create_app() builds them once it is final
+bcrypt = None
+writer = None
+shard_map = None
+# Writer of each shard database; with a single shard that is the main database and its writer
+shard_writers = {}
+# Worker processes verifying the page count of uploaded documents
+analysis_pool = None
+# Background archival, upload garbage collection and VACUUM
+retention_job = None
+
+jwt = JWTManager()
+
+# Serialized /api/shops pages, dropped whenever the 'shops' version changes
+shop_catalog = VersionedCache()
+
+# Shopkeeper columns that appear in /api/shops, changing any of them invalidates the catalog
+CATALOG_FIELDS = {'name', 'shop_name', 'address', 'shop_image', 'cost_single_side', 'cost_both_sides'}
+
+# Prices of every shop as arrays, reloaded whenever the 'shops' version changes
+price_table = PriceTable()
+
+# Scope claim of the short-lived tokens that only open the event stream
+EVENTS_SCOPE = 'events'
+
+# The authenticated caller of a request. role is 'user' or 'shopkeeper' and only the matching id is set.
+Principal = namedtuple('Principal', ['email', 'role', 'user_id', 'shopkeeper_id'])
+
+# Principals of tokens issued before the id and role were added to the claims, keyed by email
+principal_cache = LRUCache(4096)
+
+# Storage for blacklisted tokens, shared by every worker through the database
+blacklist = RevocationStore()
+
+# Request changes pushed to the open event streams of the user and shop involved.
+# Pass another fan-out to ChangeBroker to deliver them across worker processes.
+broker = ChangeBroker()
+
+# Metrics of this worker process, served at /metrics. Every worker is scraped on its own.
+metrics = Registry()
+request_latency = metrics.histogram('http_request_duration_seconds', 'Time to build the response of a request', ('endpoint', 'method', 'status'))
+request_statements = metrics.histogram('http_request_sql_statements', 'SQL statements run for a request', ('endpoint',),
+                                       buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+request_sql_latency = metrics.histogram('http_request_sql_duration_seconds', 'Time a request spent in SQL statements', ('endpoint',))
+sql_latency = metrics.histogram('sql_statement_duration_seconds', 'Time of each SQL statement, by its first keyword', ('kind',),
+                                buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1))
+upload_size = metrics.histogram('upload_size_bytes', 'Size of accepted uploads, by file type', ('extension',),
+                                buckets=tuple(2 ** power * 1024 for power in range(4, 17, 2)))
+upload_latency = metrics.histogram('upload_duration_seconds', 'Time to stream, check and hash an upload to disk', ('extension',))
+password_latency = metrics.histogram('password_hash_duration_seconds', 'Time a request waited for bcrypt, by operation', ('operation',),
+                                     buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+auth_latency = metrics.histogram('auth_check_duration_seconds', 'Time of the token revocation and principal lookups', ('check',))
+metrics.gauge('write_queue_depth', 'Writes waiting for the writer thread of each database',
+              lambda: {(database or 'main',): write_queue.depth() for database, write_queue in {None: writer, **shard_writers}.items()}, ('database',))
+metrics.gauge('password_jobs_in_flight', 'bcrypt jobs running or waiting for a worker process', lambda: bcrypt.in_flight)
+metrics.gauge('analysis_jobs_running', 'Page counts and image resizes in the analysis pool', lambda: len(analysis_pool.running))
+metrics.gauge('event_streams', 'Open event streams', lambda: sum(len(subscriptions) for subscriptions in list(broker.subscribers.values())))
+
+# Function to time every SQL statement, and to add it to the request it was run for
+def record_statement(query, elapsed):
+    sql_latency.observe(elapsed, statement_kind(query))
+    request_metrics = current_request.get()
+    if request_metrics is not None:
+        request_metrics.add_statement(query, elapsed)
+
+statement_listeners.append(record_statement)
 
 # Function to check if the image uploaded is of allowed type or not
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
 # Function to check if the file uploaded is of allowed type or not for user request
 def file_allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['FILE_ALLOWED_EXTENSIONS']
-
-# Function to query the database and return the results as a dictionary object or a list of dictionary objects.
-def query_db(query, args=(), one=False):
-    conn = sqlite3.connect('print_seva.db')
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute(query, args)
-    rv = cur.fetchall()
-    conn.commit()
-    conn.close()
-    return (rv[0] if rv else None) if one else rv
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config['FILE_ALLOWED_EXTENSIONS']
+
+# Function to validate an uploaded file and stream it into a staged temporary file.
+# Raises UploadRejected when the file type, size or content is not acceptable.
+def stage_file(file, allowed):
+    if not (file and allowed(file.filename)):
+        raise UploadRejected('File type not allowed')
+    extension = file_extension(file.filename)
+    started = time.perf_counter()
+    staged = stage_upload(file, current_app.config['UPLOAD_FOLDER'], extension, current_app.config['MAX_FILE_SIZE'][extension])
+    upload_latency.observe(time.perf_counter() - started, extension)
+    upload_size.observe(staged.size, extension)
+    return staged
+
+# Attempts to store the page count of a request after the first one failed, and the seconds
+# between them; the last one marks the request 'Failed'
+PAGE_COUNT_RETRIES = 3
+PAGE_COUNT_RETRY_SECONDS = 1
+
+# Function to hand the result of a page count to the write queues: the blob on the main database
+# and the requests waiting on it on every shard. Runs in the result thread of the analysis pool,
+# which delivers the results of every other job too, so it never waits for the database itself.
+def store_page_count(path, future):
+    try:
+        page_count = future.result()
+    except Exception as e:
+        print(f"Error counting pages of {path}: {e}")
+        page_count = None
+    if page_count is not None:
+        try:
+            writer.submit(write_blob_page_count, path, page_count).add_done_callback(
+                lambda write: write.exception() and print(f"Error storing the page count of {path}: {write.exception()}"))
+        except WriteQueueFull:
+            print(f"Error storing the page count of {path}: write queue is full")
+    for database, write_queue in shard_writers.items():
+        queue_request_page_count(write_queue, database, path, page_count)
+
+# Function to queue the update of the requests waiting on a file on one shard. A write that
+# fails is retried after PAGE_COUNT_RETRY_SECONDS; the last attempt marks the requests 'Failed'
+# instead, so they never stay 'Pending'.
+def queue_request_page_count(write_queue, database, path, page_count, retries=PAGE_COUNT_RETRIES):
+    def retry(error):
+        print(f"Error storing the page count of {path}: {error}")
+        if retries:
+            threading.Timer(PAGE_COUNT_RETRY_SECONDS, queue_request_page_count,
+                            (write_queue, database, path, page_count if retries > 1 else None, retries - 1)).start()
+
+    try:
+        write = write_queue.submit(write_request_page_count, path, page_count, database)
+    except WriteQueueFull:
+        retry('write queue is full')
+        return
+    write.add_done_callback(lambda write: write.exception() and retry(write.exception()))
+
+def write_blob_page_count(path, page_count):
+    execute_db('UPDATE blob SET page_count = ? WHERE path = ?', [page_count, path])
+
+# Function to store the page count of the requests waiting on a file, or to mark them 'Failed'
+# when it is None
+def write_request_page_count(path, page_count, database):
+    if page_count is None:
+        execute_db("UPDATE user_request SET analysis_status = 'Failed' WHERE file_path = ? AND analysis_status = 'Pending'",
+                   [path], database=database)
+    else:
+        execute_db('''
+            UPDATE user_request SET verified_pages = ?, analysis_status = 'Done'
+            WHERE file_path = ? AND analysis_status = 'Pending'
+        ''', [page_count, path], database=database)
+
+# Function to build the public URL of a stored upload, optionally of one of its resized variants
+def upload_url(path, size=None):
+    if not path:
+        return None
+    filename = os.path.relpath(path, current_app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+    if size:
+        return url_for('api.uploaded_file', filename=filename, size=size, _external=True)
+    return url_for('api.uploaded_file', filename=filename, _external=True)
+
+# Function to build the URLs of every resized variant of a stored image
+def image_variant_urls(path):
+    if not path:
+        return None
+    return {size: upload_url(path, size) for size in VARIANT_SIZES}
+
+# Function to resize a newly stored image in the background
+def submit_image_variants(path):
+    if path:
+        analysis_pool.submit(path, make_variants, (), log_image_variants)
+
+# Function to report images the background pool could not resize; the original is served instead
+def log_image_variants(path, future):
+    try:
+        future.result()
+    except Exception as e:
+        print(f"Error resizing image {path}: {e}")
+
+# Function to build the JWT identity of a user or shopkeeper. The numeric id and role travel in
+# the token, so authenticated endpoints do not need to look the caller up by email.
+def token_identity(email, role, principal_id):
+    return {'email': email, 'role': role, 'id': principal_id}
+
+# Function to get the principal of the current request, resolved once per request.
+# Older tokens that only carry the email are resolved through user_roles and cached.
+def current_principal():
+    if 'principal' not in g:
+        started = time.perf_counter()
+        identity = get_jwt_identity() or {}
+        role, principal_id = identity.get('role'), identity.get('id')
+        if role and principal_id:
+            principal = Principal(identity['email'], role,
+                                  principal_id if role == 'user' else None,
+                                  principal_id if role == 'shopkeeper' else None)
+        else:
+            principal = principal_cache.get(identity.get('email'))
+            if principal is None:
+                row = query_db('SELECT email, role, user_id, shopkeeper_id FROM user_roles WHERE email = ?', [identity.get('email')], one=True)
+                principal = Principal(row['email'], row['role'], row['user_id'], row['shopkeeper_id']) if row else None
+                if principal:
+                    principal_cache.put(principal.email, principal)
+        g.principal = principal
+        auth_latency.observe(time.perf_counter() - started, 'principal')
+    return g.principal
+
+# Function to push a change of a request to its user and its shop.
+# row needs the id, user_id, shop_id, status, action and update_time columns.
+def publish_request_change(event_type, row):
+    event = {
+        'type': event_type,
+        'request_id': row['id'],
+        'status': row['status'],
+        'action': row['action'],
+        'update_time': str(row['update_time']),
+    }
+    broker.publish(f"user:{row['user_id']}", event)
+    broker.publish(f"shop:{row['shop_id']}", event)
+
+# Function to store a password again with the current cost factor after a successful login.
+# The new hash is computed in the background and only replaces the old one if it is unchanged.
+# It is written through the write queue: the callback runs in the result thread of the bcrypt
+# pool, and waiting for the database there would hold back the result of every login.
+def rehash_on_login(table, email, pw_hash, password):
+    if bcrypt.needs_rehash(pw_hash):
+        bcrypt.rehash_async(password, lambda new_hash: writer.submit(store_rehash, table, email, pw_hash, new_hash).add_done_callback(
+            lambda write: write.exception() and print(f"Error storing rehashed password: {write.exception()}")))
+
+def store_rehash(table, email, pw_hash, new_hash):
+    execute_db(f'UPDATE {table} SET password = ? WHERE email = ? AND password = ?', [new_hash, email, pw_hash])
+
+# Refuse requests while the bcrypt pool is saturated or a write queue is full, instead of
+# letting them pile up
+@api.app_errorhandler(PasswordPoolBusy)
+@api.app_errorhandler(WriteQueueFull)
+def server_busy(e):
+    response = jsonify({'error': 'Server is busy, please try again'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Start collecting the metrics of a request, before any other handler runs
+@api.before_app_request
+def start_request_metrics():
+    current_request.set(RequestMetrics(current_app.config['SLOW_REQUEST_SECONDS'] is not None))
+
+# Record the latency and SQL of a request once its response is ready, and log it if it was slow
+@api.after_app_request
+def record_request_metrics(response):
+    request_metrics = current_request.get()
+    if request_metrics is None:
+        return response
+    elapsed = time.perf_counter() - request_metrics.started
+    endpoint = request.endpoint.rpartition('.')[2] if request.endpoint else 'unmatched'
+    request_latency.observe(elapsed, endpoint, request.method, str(response.status_code))
+    request_statements.observe(request_metrics.statements, endpoint)
+    request_sql_latency.observe(request_metrics.sql_seconds, endpoint)
+
+    slow = current_app.config['SLOW_REQUEST_SECONDS']
+    if slow is not None and elapsed >= slow:
+        print("Slow request: " + json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'ms': round(elapsed * 1000, 3),
+            'sql_ms': round(request_metrics.sql_seconds * 1000, 3),
+            'sql': request_metrics.queries,
+        }))
+    return response
+
+@api.teardown_app_request
+def end_request_metrics(exception):
+    current_request.set(None)
+
+# Start the retention job of this worker process with its first request
+@api.before_app_request
+def start_retention_job():
+    retention_job.ensure_running(current_app.config['RETENTION_INTERVAL'])
+
+# Return a JSON error instead of the default HTML page when a request body is too large
+@api.app_errorhandler(413)
+def request_entity_too_large(e):
+    return jsonify({'error': 'File is too large'}), 413
+
+# Function to encode the sort key of the last row of a page into an opaque cursor
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+# Function to check that a decoded cursor holds one value of the expected type per sort key column
+def valid_cursor(cursor, key_types):
+    return (isinstance(cursor, list) and len(cursor) == len(key_types) and
+            all(isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(cursor, key_types)))
+
+# Function to read the limit and cursor query parameters of a paginated list endpoint. key_types
+# are the types of the sort key columns, e.g. (str, int) for (request_time, id).
+# Returns (limit, cursor) where cursor is the decoded sort key list, or None if the parameters are invalid.
+def get_page_args(key_types):
+    try:
+        limit = int(request.args.get('limit', current_app.config['PAGE_SIZE']))
+        cursor = request.args.get('cursor')
+        if cursor:
+            cursor = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            if not valid_cursor(cursor, key_types):
+                return None
+    except ValueError:
+        return None
+    if limit < 1:
+        return None
+    return min(limit, current_app.config['MAX_PAGE_SIZE']), cursor or None
+
+# Function to build the JSON response of one page. The query fetched limit + 1 rows,
+# the extra row only tells us that another page exists.
+def page_response(rows, limit, key_columns):
+    items = [dict(row) for row in rows[:limit]]
+    response = jsonify(items)
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = encode_cursor([items[-1][column] for column in key_columns])
+    return response
+
+# Function to read the since query parameter of a list endpoint that supports delta sync.
+# With several shards it holds the sequence number of each shard, separated by commas.
+# Returns the list of sequence numbers, None if it is absent, or False if it is invalid.
+def get_since_arg():
+    since = request.args.get('since')
+    if since is None:
+        return None
+    try:
+        since = [int(seq) for seq in since.split(',')]
+    except ValueError:
+        return False
+    return since if all(seq >= 0 for seq in since) else False
+
+# Function to encode the sequence numbers of the shards as a since value. A single shard
+# keeps the plain number older clients expect.
+def format_change_seq(seqs):
+    return seqs[0] if len(seqs) == 1 else ','.join(str(seq) for seq in seqs)
+
+# Function to get the latest change sequence numbers of user_request. A full list sends them in
+# the X-Change-Seq header; they are read before the list, so the first delta may repeat a row
+# but never misses one. Every shard is included, so a shop moved to another shard is still
+# covered.
+def current_change_seq():
+    return format_change_seq([
+        query_db("SELECT value FROM change_sequence WHERE name = 'user_request'", one=True, database=database)['value']
+        for database in shard_map.databases()
+    ])
+
+# Function to get the database holding a request. Only looks the id up when there are
+# several shards; a request that does not exist is looked for in the first one.
+def request_database(request_id):
+    databases = shard_map.databases_for_id(request_id)
+    if len(databases) > 1:
+        for database in databases:
+            if query_db('SELECT 1 FROM user_request WHERE id = ?', [request_id], one=True, database=database):
+                return database
+    return databases[0]
+
+# Function to run a list query ordered by (request_time, id) on every shard and merge the rows
+# of all of them in that order, keeping the first limit rows
+def scatter_query(query, args, limit):
+    databases = shard_map.databases()
+    if len(databases) == 1:
+        return query_db(query, args, database=databases[0])
+    results = [query_db(query, args, database=database) for database in databases]
+    merged = heapq.merge(*results, key=lambda row: (row['request_time'], row['id']))
+    return list(itertools.islice(merged, limit))
+
+# Function to build the delta of the requests of one user or shop (owner_column is user_id or
+# shop_id) after the sequence number since. Changed rows that still belong in the list are
+# sent whole, deleted ones and those that no longer match keep(row) only by id. At most limit
+# changes are sent; seq is the number to pass as since next time, and has_more tells the
+# client to ask again right away. Returns 410 if tombstones after since were already pruned
+# or the number of shards changed, the client then has to load the full list again. Every
+# shard is read, filling the limit in shard order.
+def delta_response(columns, owner_column, owner_id, since, limit, keep=None):
+    databases = shard_map.databases()
+    if len(since) != len(databases):
+        return jsonify({'error': 'since is too old, reload the full list'}), 410
+
+    changed, deleted, seqs = [], [], []
+    has_more = False
+    for database, shard_since in zip(databases, since):
+        # The floor, the rows and the tombstones come from one snapshot, so seq never moves
+        # past a change that one of the reads missed
+        with snapshot(database):
+            floor = query_db('SELECT value FROM change_sequence WHERE name = ?', [TOMBSTONE_FLOOR], one=True, database=database)
+            if floor and shard_since < floor['value']:
+                return jsonify({'error': 'since is too old, reload the full list'}), 410
+            rows = query_db(f'''
+                SELECT {columns} FROM user_request
+                WHERE {owner_column} = ? AND change_seq > ?
+                ORDER BY change_seq LIMIT ?
+            ''', [owner_id, shard_since, limit + 1], database=database)
+            tombstones = query_db(f'''
+                SELECT change_seq, request_id FROM request_tombstone
+                WHERE {owner_column} = ? AND change_seq > ?
+                ORDER BY change_seq LIMIT ?
+            ''', [owner_id, shard_since, limit + 1], database=database)
+
+        changes = sorted([(row['change_seq'], row) for row in rows] + [(row['change_seq'], row) for row in tombstones],
+                         key=lambda change: change[0])
+        has_more = has_more or len(changes) > limit
+        changes = changes[:limit]
+        limit -= len(changes)
+
+        for seq, row in changes:
+            if 'request_id' in row.keys():
+                deleted.append(row['request_id'])
+            elif keep and not keep(row):
+                deleted.append(row['id'])
+            else:
+                changed.append(dict(row))
+        seqs.append(changes[-1][0] if changes else shard_since)
+
+    return jsonify({
+        'changed': changed,
+        'deleted': deleted,
+        'seq': format_change_seq(seqs),
+        'has_more': has_more,
+    }), 200
 
 # User Registration API
-@app.route('/register/user', methods=['POST'])
+@api.route('/register/user', methods=['POST'])
 def register_user():
     name = request.form.get('name')
     email = request.form.get('email')
@@ -72,53 +505,57 @@ def register_user():
         return jsonify({"error": "Passwords do not match"}), 400
     
     # Hash the password before storing it in the database
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+    hashed_password = bcrypt.generate_password_hash(password)
     
-    # Save profile image if uploaded by user and store the path in the database
+    # Stage profile image if uploaded by user, it is stored as a blob together with the user row
+    staged = None
     if 'profile_image' in request.files:
-        profile_image = request.files['profile_image']
-        if profile_image and allowed_file(profile_image.filename):
-            filename = secure_filename(profile_image.filename)
-            profile_image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            profile_image.save(profile_image_path)
-            os.chmod(profile_image_path, 0o644)
-        else:
-            return jsonify({'error': 'Invalid file type for profile image'}), 400
-    else:
-        profile_image_path = None
+        try:
+            staged = stage_file(request.files['profile_image'], allowed_file)
+        except UploadRejected as e:
+            return jsonify({'error': f'Invalid profile image: {e}'}), e.status
+
+    # Insert the user and their role on the writer thread, returns the stored image path
+    def insert_user():
+        with transaction():
+            # Check if email already exists in the database and return an error if it does
+            if query_db("SELECT 1 FROM user_roles WHERE email = ?", (email,), one=True):
+                raise sqlite3.IntegrityError('Email already registered')
+
+            profile_image_path = store_blob(staged, current_app.config['UPLOAD_FOLDER']) if staged else None
+
+            # Insert user details into the database
+            cursor = execute_db('''
+                INSERT INTO user (name, email, password, profile_image)
+                VALUES (?, ?, ?, ?)
+            ''', (name, email, hashed_password, profile_image_path))
+
+            # Get the user_id of the user that was just inserted
+            user_id = cursor.lastrowid
+
+            execute_db('''
+                INSERT INTO user_roles (email, role, user_id)
+                VALUES (?, 'user', ?)
+            ''', (email, user_id))
+        return profile_image_path
 
-    # Check if email already exists in the database and return an error if it does
     try:
-        conn = sqlite3.connect('print_seva.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM user_roles WHERE email = ?", (email,))
-        if cursor.fetchone():
-            return jsonify({"error": "Email already registered"}), 400
-
-        # Insert user details into the database
-        cursor.execute('''
-            INSERT INTO user (name, email, password, profile_image)
-            VALUES (?, ?, ?, ?)
-        ''', (name, email, hashed_password, profile_image_path))
-        
-        # Get the user_id of the user that was just inserted
-        user_id = cursor.lastrowid
-
-        cursor.execute('''
-            INSERT INTO user_roles (email, role, user_id)
-            VALUES (?, 'user', ?)
-        ''', (email, user_id))
-        conn.commit()
-        conn.close()
+        profile_image_path = writer.execute(insert_user)
+        principal_cache.invalidate(email)
 
     # Return an error if the email is already registered
     except sqlite3.IntegrityError:
         return jsonify({"error": "Email already registered"}), 400
+    finally:
+        if staged:
+            discard_upload(staged)
+
+    submit_image_variants(profile_image_path)
 
     return jsonify({"message": "User registered successfully"}), 201
 
 # Shopkeeper Registration API
-@app.route('/register/shopkeeper', methods=['POST'])
+@api.route('/register/shopkeeper', methods=['POST'])
 def register_shopkeeper():
     name = request.form.get('name')
     email = request.form.get('email')
@@ -134,52 +571,58 @@ def register_shopkeeper():
         return jsonify({"error": "Passwords do not match"}), 400
 
     # Hash the password before storing it in the database
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+    hashed_password = bcrypt.generate_password_hash(password)
     
-    # Save shop image if uploaded by shopkeeper and store the path in the database
+    # Stage shop image if uploaded by shopkeeper, it is stored as a blob together with the shopkeeper row
+    staged = None
     if 'shop_image' in request.files:
-        shop_image = request.files['shop_image']
-        if shop_image and allowed_file(shop_image.filename):
-            filename = secure_filename(shop_image.filename)
-            shop_image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            shop_image.save(shop_image_path)
-            os.chmod(shop_image_path, 0o644)
-        else:
-            return jsonify({'error': 'Invalid file type for shop image'}), 400
-    else:
-        shop_image_path = None
+        try:
+            staged = stage_file(request.files['shop_image'], allowed_file)
+        except UploadRejected as e:
+            return jsonify({'error': f'Invalid shop image: {e}'}), e.status
+
+    # Insert the shopkeeper and their role on the writer thread, returns the stored image path
+    def insert_shopkeeper():
+        with transaction():
+            # Check if email already exists in the database and return an error if it does
+            if query_db("SELECT 1 FROM user_roles WHERE email = ?", (email,), one=True):
+                raise sqlite3.IntegrityError('Email already registered')
+
+            shop_image_path = store_blob(staged, current_app.config['UPLOAD_FOLDER']) if staged else None
+
+            # Insert shopkeeper details into the database
+            cursor = execute_db('''
+                INSERT INTO shopkeeper (name, email, password, shop_name, address, contact, shop_image, cost_single_side, cost_both_sides)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (name, email, hashed_password, shop_name, address, contact, shop_image_path, cost_single_side, cost_both_sides))
+
+            # Get the shopkeeper_id of the shopkeeper that was just inserted
+            shopkeeper_id = cursor.lastrowid
+
+            execute_db('''
+                INSERT INTO user_roles (email, role, shopkeeper_id)
+                VALUES (?, 'shopkeeper', ?)
+            ''', (email, shopkeeper_id))
+            bump_version('shops')
+        return shop_image_path
 
-    # Check if email already exists in the database and return an error if it does
     try:
-        conn = sqlite3.connect('print_seva.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM user_roles WHERE email = ?", (email,))
-        if cursor.fetchone():
-            return jsonify({"error": "Email already registered"}), 400
-
-        # Insert shopkeeper details into the database
-        cursor.execute('''
-            INSERT INTO shopkeeper (name, email, password, shop_name, address, contact, shop_image, cost_single_side, cost_both_sides)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (name, email, hashed_password, shop_name, address, contact, shop_image_path, cost_single_side, cost_both_sides))
-        
-        # Get the shopkeeper_id of the shopkeeper that was just inserted
-        shopkeeper_id = cursor.lastrowid
-
-        cursor.execute('''
-            INSERT INTO user_roles (email, role, shopkeeper_id)
-            VALUES (?, 'shopkeeper', ?)
-        ''', (email, shopkeeper_id))
-        conn.commit()
-        conn.close()
+        shop_image_path = writer.execute(insert_shopkeeper)
+        shop_catalog.invalidate()
+        principal_cache.invalidate(email)
 
     # Return an error if the email is already registered
     except sqlite3.IntegrityError:
         return jsonify({"error": "Email already registered"}), 400
+    finally:
+        if staged:
+            discard_upload(staged)
+
+    submit_image_variants(shop_image_path)
 
     return jsonify({"message": "Shopkeeper registered successfully"}), 201
 
-@app.route('/login/user', methods=['POST'])
+@api.route('/login/user', methods=['POST'])
 def login_user():
     data = request.get_json()
     email = data.get('email')
@@ -191,7 +634,8 @@ def login_user():
     user = query_db('SELECT * FROM user WHERE email = ?', [email], one=True)
     
     if user and bcrypt.check_password_hash(user['password'], password):
-        token = create_access_token(identity={'email': user['email']})
+        rehash_on_login('user', user['email'], user['password'], password)
+        token = create_access_token(identity=token_identity(user['email'], 'user', user['user_id']))
 
         user_data = {
             'user_id': user['user_id'],
@@ -205,7 +649,7 @@ def login_user():
     return jsonify({"error": "Invalid credentials"}), 401
 
 # login_shopkeeper API
-@app.route('/login/shopkeeper', methods=['POST'])
+@api.route('/login/shopkeeper', methods=['POST'])
 def login_shopkeeper():
     data = request.get_json()
     email = data['email']
@@ -213,7 +657,8 @@ def login_shopkeeper():
     
     shopkeeper = query_db('SELECT * FROM shopkeeper WHERE email = ?', [email], one=True)
     if shopkeeper and bcrypt.check_password_hash(shopkeeper['password'], password):
-        token = create_access_token(identity={'email': shopkeeper['email']})
+        rehash_on_login('shopkeeper', shopkeeper['email'], shopkeeper['password'], password)
+        token = create_access_token(identity=token_identity(shopkeeper['email'], 'shopkeeper', shopkeeper['shopkeeper_id']))
         
         shopkeeper_data = {
             'shopkeeper_id': shopkeeper['shopkeeper_id'],
@@ -227,18 +672,19 @@ def login_shopkeeper():
 
 
 # Get user details API
-@app.route('/api/user', methods=['GET'])
+@api.route('/api/user', methods=['GET'])
 @jwt_required()
 def get_user():
-    current_user = get_jwt_identity()
-    if current_user:
-        user = query_db('SELECT * FROM user WHERE email = ?', [current_user['email']], one=True)
+    principal = current_principal()
+    if principal and principal.user_id:
+        user = query_db('SELECT * FROM user WHERE user_id = ?', [principal.user_id], one=True)
         if user:
             user_data = {
                 'user_id': user['user_id'],
                 'email': user['email'],
                 'name': user['name'],
-                'profile_image': url_for('uploaded_file', filename=os.path.basename(user['profile_image']), _external=True) if user['profile_image'] else None,
+                'profile_image': upload_url(user['profile_image']),
+                'profile_image_variants': image_variant_urls(user['profile_image']),
                 'contact': user['contact'],
                 'address': user['address']
             }
@@ -246,11 +692,13 @@ def get_user():
     return jsonify({"error": "User not found"}), 404
 
 # Get shopkeeper details API
-@app.route('/api/shopkeeper', methods=['GET'])
+@api.route('/api/shopkeeper', methods=['GET'])
 @jwt_required()
 def get_shopkeeper():
-    current_user = get_jwt_identity()
-    shopkeeper = query_db('SELECT * FROM shopkeeper WHERE email = ?', [current_user['email']], one=True)
+    principal = current_principal()
+    shopkeeper = None
+    if principal and principal.shopkeeper_id:
+        shopkeeper = query_db('SELECT * FROM shopkeeper WHERE shopkeeper_id = ?', [principal.shopkeeper_id], one=True)
     if shopkeeper:
         shopkeeper_data = {
             'shopkeeper_id': shopkeeper['shopkeeper_id'],
@@ -259,7 +707,8 @@ def get_shopkeeper():
             'shop_name': shopkeeper['shop_name'],
             'address': shopkeeper['address'],
             'contact': shopkeeper['contact'],
-            'shop_image': url_for('uploaded_file', filename=os.path.basename(shopkeeper['shop_image']), _external=True) if shopkeeper['shop_image'] else None,
+            'shop_image': upload_url(shopkeeper['shop_image']),
+            'shop_image_variants': image_variant_urls(shopkeeper['shop_image']),
             'cost_single_side': shopkeeper['cost_single_side'],
             'cost_both_sides': shopkeeper['cost_both_sides']
         }
@@ -268,42 +717,169 @@ def get_shopkeeper():
 
 
 
-# API to get all shops available
-@app.route('/api/shops', methods=['GET'])
+# Function to convert a shopkeeper row into the public shop listing format
+def shop_to_dict(shop):
+    return {
+        'shopkeeper_id': shop['shopkeeper_id'],
+        'shop_name': shop['shop_name'],
+        'address': shop['address'],
+        'shop_image': upload_url(shop['shop_image']),
+        'shop_image_variants': image_variant_urls(shop['shop_image']),
+        'name': shop['name'],
+        'cost_single_side': shop['cost_single_side'],
+        'cost_both_sides': shop['cost_both_sides']
+    }
+
+# API to get all shops available, paginated by shopkeeper_id.
+# Pages are served from shop_catalog and answer If-None-Match with 304 while the catalog is unchanged.
+@api.route('/api/shops', methods=['GET'])
 def get_shops():
-    shops = query_db('SELECT * FROM shopkeeper')
-    shop_list = []
-    
-    for shop in shops:
-        shop_dict = {
-            'shopkeeper_id': shop['shopkeeper_id'],
-            'shop_name': shop['shop_name'],
-            'address': shop['address'],
-            'shop_image': url_for('uploaded_file', filename=os.path.basename(shop['shop_image']), _external=True) if shop['shop_image'] else None,
-            'name': shop['name'],
-            'cost_single_side': shop['cost_single_side'],
-            'cost_both_sides': shop['cost_both_sides']
-        }
-        shop_list.append(shop_dict)
+    page = get_page_args((int,))
+    if page is None:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    limit, cursor = page
+
+    version = get_version('shops')
+    key = (request.host_url, limit, tuple(cursor) if cursor else None)
+    entry = shop_catalog.get(version, key)
+    if entry is None:
+        if cursor:
+            shops = query_db('SELECT * FROM shopkeeper WHERE shopkeeper_id > ? ORDER BY shopkeeper_id LIMIT ?', [cursor[0], limit + 1])
+        else:
+            shops = query_db('SELECT * FROM shopkeeper ORDER BY shopkeeper_id LIMIT ?', [limit + 1])
+        shop_list = [shop_to_dict(shop) for shop in shops]
+
+        response = page_response(shop_list, limit, ['shopkeeper_id'])
+        headers = {'X-Next-Cursor': response.headers['X-Next-Cursor']} if 'X-Next-Cursor' in response.headers else {}
+        entry = shop_catalog.put(version, key, response.get_data(), headers)
+
+    headers = {'ETag': entry.etag, 'Cache-Control': 'no-cache', **entry.headers}
+    if request.if_none_match.contains(entry.etag.strip('"')):
+        return Response(status=304, headers=headers)
+    return Response(entry.body, status=200, mimetype='application/json', headers=headers)
+
+# Query parameters of the shop search that filter on price, with the column and comparison they apply
+SHOP_PRICE_FILTERS = (
+    ('min_single', 'cost_single_side', '>='),
+    ('max_single', 'cost_single_side', '<='),
+    ('min_both', 'cost_both_sides', '>='),
+    ('max_both', 'cost_both_sides', '<='),
+)
+
+# Function to turn free text into an FTS5 query in which every word has to match as a prefix.
+# Words are quoted, so user input can never be read as FTS5 syntax.
+def fts_query(text):
+    return ' '.join('"%s"*' % word for word in re.findall(r'\w+', text))
+
+# API to search shops by name, address and owner name through the shop_search FTS5 index,
+# optionally filtered by price range. Text matches are ranked with bm25, shop names weigh most.
+@api.route('/api/shops/search', methods=['GET'])
+def search_shops():
+    text = request.args.get('q', '').strip()
+    conditions, args = [], []
+    try:
+        limit = min(int(request.args.get('limit', current_app.config['PAGE_SIZE'])), current_app.config['MAX_PAGE_SIZE'])
+        for param, column, operator in SHOP_PRICE_FILTERS:
+            if request.args.get(param):
+                # Prices that are not numbers are TEXT, which SQLite orders after every number
+                conditions.append(f"typeof(shopkeeper.{column}) IN ('integer', 'real') AND shopkeeper.{column} {operator} ?")
+                args.append(float(request.args[param]))
+    except ValueError:
+        return jsonify({'error': 'limit and price filters must be numbers'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    filters = ''.join(' AND ' + condition for condition in conditions)
+    if text:
+        match = fts_query(text)
+        if not match:
+            return jsonify([]), 200
+        shops = query_db('''
+            SELECT shopkeeper.* FROM shop_search
+            JOIN shopkeeper ON shopkeeper.shopkeeper_id = shop_search.rowid
+            WHERE shop_search MATCH ?''' + filters + '''
+            ORDER BY bm25(shop_search, 10.0, 2.0, 1.0) LIMIT ?
+        ''', [match, *args, limit])
+    else:
+        shops = query_db('SELECT * FROM shopkeeper WHERE 1 = 1' + filters + ' ORDER BY cost_single_side, shopkeeper_id LIMIT ?',
+                         [*args, limit])
+
+    return jsonify([shop_to_dict(shop) for shop in shops]), 200
+
+# Function to read the print job fields a quote depends on from a dict of strings or numbers.
+# Raises ValueError if they are missing or not numbers.
+def quote_job(data):
+    pages, copies = int(data['total_pages']), int(data.get('no_of_copies', 1))
+    if pages < 1 or copies < 1:
+        raise ValueError('total_pages and no_of_copies must be positive')
+    return pages, copies, data.get('print_side') == 'double'
+
+# API to price one print job at every shop, cheapest first.
+# Takes total_pages, no_of_copies, print_side and limit as query parameters.
+@api.route('/api/shops/quote', methods=['GET'])
+def quote_shops():
+    try:
+        pages, copies, double_sided = quote_job(request.args)
+        limit = min(int(request.args.get('limit', current_app.config['PAGE_SIZE'])), current_app.config['MAX_PAGE_SIZE'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'total_pages, no_of_copies and limit must be positive numbers'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    ranked = price_table.rank_shops(get_version('shops'), pages, copies, double_sided, limit)
+    return jsonify([{'shopkeeper_id': shop_id, 'shop_name': shop_name, 'price': round(price, 2)}
+                    for shop_id, shop_name, price in ranked]), 200
+
+# API to price many print jobs at one shop.
+# Takes {"jobs": [{"total_pages": 10, "no_of_copies": 2, "print_side": "double"}, ...]}.
+@api.route('/api/shops/<int:shop_id>/quote', methods=['POST'])
+def quote_jobs(shop_id):
+    data = request.get_json(silent=True) or {}
+    jobs = data.get('jobs')
+    if not isinstance(jobs, list) or not jobs or len(jobs) > current_app.config['MAX_PAGE_SIZE']:
+        return jsonify({'error': f"jobs must be a list of 1 to {current_app.config['MAX_PAGE_SIZE']} jobs"}), 400
+    try:
+        pages, copies, double_sided = zip(*(quote_job(job) for job in jobs))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Every job needs positive total_pages and no_of_copies'}), 400
 
-    return jsonify(shop_list), 200
+    prices = price_table.price_jobs(get_version('shops'), shop_id, pages, copies, double_sided)
+    if prices is None:
+        return jsonify({'error': 'Shop not found'}), 404
+    return jsonify({
+        'shopkeeper_id': shop_id,
+        'prices': [None if price is None else round(price, 2) for price in prices],
+        'total': None if None in prices else round(sum(prices), 2),
+    }), 200
 
 # Check if a token has been blacklisted
 @jwt.token_in_blocklist_loader
 def check_if_token_in_blacklist(jwt_header, jwt_payload):
     jti = jwt_payload['jti']
-    return jti in blacklist
+    started = time.perf_counter()
+    revoked = blacklist.is_revoked(jti)
+    auth_latency.observe(time.perf_counter() - started, 'revocation')
+    return revoked
+
+# Stream tokens (see /api/events/token) are refused by every endpoint but the event stream
+@jwt.token_verification_loader
+def check_token_scope(jwt_header, jwt_payload):
+    return jwt_payload.get('scope') != EVENTS_SCOPE or request.endpoint == 'api.stream_events'
+
+@jwt.token_verification_failed_loader
+def token_scope_failed(jwt_header, jwt_payload):
+    return jsonify({'error': 'Token cannot be used for this request'}), 403
 
 # Logout route to blacklist the token
-@app.route('/api/logout', methods=['POST'])
+@api.route('/api/logout', methods=['POST'])
 @jwt_required()
 def logout():
-    jti = get_jwt()['jti']
-    blacklist.add(jti)
+    token = get_jwt()
+    blacklist.revoke(token['jti'], token.get('exp'))
     return jsonify({"message": "Logout successful"}), 200
 
 # Dashboard API
-@app.route('/dashboard', methods=['GET'])
+@api.route('/dashboard', methods=['GET'])
 @jwt_required()
 def dashboard():
     # Get the current user from the JWT token and return it as a response
@@ -315,7 +891,7 @@ def row_to_dict(row):
     return dict(row) if row else {}
 
 
-@app.route('/api/user/update', methods=['POST'])
+@api.route('/api/user/update', methods=['POST'])
 @jwt_required()
 def update_user():
     current_user = get_jwt_identity()
@@ -330,39 +906,43 @@ def update_user():
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    # Update user details
+    # Collect every changed field first so that they are written with a single UPDATE
+    fields = {}
+    if name:
+        fields['name'] = name
+    if contact:
+        fields['contact'] = contact
+    if address:
+        fields['address'] = address
+    if old_password and new_password:
+        if not bcrypt.check_password_hash(user['password'], old_password):
+            return jsonify({"error": "Old password is incorrect"}), 400
+        fields['password'] = bcrypt.generate_password_hash(new_password)
+
+    staged = None
+    if 'profile_image' in request.files:
+        try:
+            staged = stage_file(request.files['profile_image'], allowed_file)
+        except UploadRejected as e:
+            return jsonify({'error': f'Invalid profile image: {e}'}), e.status
+
+    # Update user details, swapping the blob reference of the profile image in the same transaction
     try:
-        if name:
-            query_db('UPDATE user SET name = ? WHERE email = ?', [name, email])
-        if contact:
-            query_db('UPDATE user SET contact = ? WHERE email = ?', [contact, email])
-        if address:
-            query_db('UPDATE user SET address = ? WHERE email = ?', [address, email])
-        if old_password and new_password:
-            if bcrypt.check_password_hash(user['password'], old_password):
-                hashed_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
-                query_db('UPDATE user SET password = ? WHERE email = ?', [hashed_password, email])
-            else:
-                return jsonify({"error": "Old password is incorrect"}), 400
-        if 'profile_image' in request.files:
-            profile_image = request.files['profile_image']
-            if profile_image and allowed_file(profile_image.filename):
-                filename = secure_filename(profile_image.filename)
-                profile_image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                profile_image.save(profile_image_path)
-                os.chmod(profile_image_path, 0o644)
-                query_db('UPDATE user SET profile_image = ? WHERE email = ?', [profile_image_path, email])
-            else:
-                return jsonify({'error': 'Invalid file type for profile image'}), 400
+        with transaction():
+            if staged:
+                fields['profile_image'] = store_blob(staged, current_app.config['UPLOAD_FOLDER'])
+                release_blob(user['profile_image'])
+
+            updated_user = update_row('user', 'email', email, fields)
+        submit_image_variants(fields.get('profile_image'))
 
-        # Fetch updated user data
-        updated_user = query_db('SELECT * FROM user WHERE email = ?', [email], one=True)
         if updated_user:
             user_data = {
                 'user_id': updated_user['user_id'],
                 'email': updated_user['email'],
                 'name': updated_user['name'],
-                'profile_image': url_for('uploaded_file', filename=os.path.basename(updated_user['profile_image']), _external=True) if updated_user['profile_image'] else None,
+                'profile_image': upload_url(updated_user['profile_image']),
+                'profile_image_variants': image_variant_urls(updated_user['profile_image']),
                 'contact': updated_user['contact'],
                 'address': updated_user['address']
             }
@@ -370,11 +950,14 @@ def update_user():
     except Exception as e:
         print(f"Error updating user: {e}")
         return jsonify({"error": "An error occurred while updating user"}), 500
+    finally:
+        if staged:
+            discard_upload(staged)
 
     return jsonify({"message": "User updated successfully"}), 200
 
 
-@app.route('/api/shopkeeper/update', methods=['POST'])
+@api.route('/api/shopkeeper/update', methods=['POST'])
 @jwt_required()
 def update_shopkeeper():
     current_user = get_jwt_identity()
@@ -392,39 +975,46 @@ def update_shopkeeper():
     if not shopkeeper:
         return jsonify({"error": "Shopkeeper not found"}), 404
 
-    # Update shopkeeper details
+    # Collect every changed field first so that they are written with a single UPDATE
+    fields = {}
+    if name:
+        fields['name'] = name
+    if contact:
+        fields['contact'] = contact
+    if address:
+        fields['address'] = address
+    if shop_name:
+        fields['shop_name'] = shop_name
+    if cost_single_side:
+        fields['cost_single_side'] = cost_single_side
+    if cost_both_sides:
+        fields['cost_both_sides'] = cost_both_sides
+    if old_password and new_password:
+        if not bcrypt.check_password_hash(shopkeeper['password'], old_password):
+            return jsonify({"error": "Old password is incorrect"}), 400
+        fields['password'] = bcrypt.generate_password_hash(new_password)
+
+    staged = None
+    if 'shop_image' in request.files:
+        try:
+            staged = stage_file(request.files['shop_image'], allowed_file)
+        except UploadRejected as e:
+            return jsonify({'error': f'Invalid shop image: {e}'}), e.status
+
+    # Update shopkeeper details, swapping the blob reference of the shop image in the same transaction
     try:
-        if name:
-            query_db('UPDATE shopkeeper SET name = ? WHERE email = ?', [name, email])
-        if contact:
-            query_db('UPDATE shopkeeper SET contact = ? WHERE email = ?', [contact, email])
-        if address:
-            query_db('UPDATE shopkeeper SET address = ? WHERE email = ?', [address, email])
-        if shop_name:
-            query_db('UPDATE shopkeeper SET shop_name = ? WHERE email = ?', [shop_name, email])
-        if cost_single_side:
-            query_db('UPDATE shopkeeper SET cost_single_side = ? WHERE email = ?', [cost_single_side, email])
-        if cost_both_sides:
-            query_db('UPDATE shopkeeper SET cost_both_sides = ? WHERE email = ?', [cost_both_sides, email])
-        if old_password and new_password:
-            if bcrypt.check_password_hash(shopkeeper['password'], old_password):
-                hashed_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
-                query_db('UPDATE shopkeeper SET password = ? WHERE email = ?', [hashed_password, email])
-            else:
-                return jsonify({"error": "Old password is incorrect"}), 400
-        if 'shop_image' in request.files:
-            shop_image = request.files['shop_image']
-            if shop_image and allowed_file(shop_image.filename):
-                filename = secure_filename(shop_image.filename)
-                shop_image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                shop_image.save(shop_image_path)
-                os.chmod(shop_image_path, 0o644)
-                query_db('UPDATE shopkeeper SET shop_image = ? WHERE email = ?', [shop_image_path, email])
-            else:
-                return jsonify({'error': 'Invalid file type for shop image'}), 400
+        with transaction():
+            if staged:
+                fields['shop_image'] = store_blob(staged, current_app.config['UPLOAD_FOLDER'])
+                release_blob(shopkeeper['shop_image'])
+
+            updated_shopkeeper = update_row('shopkeeper', 'email', email, fields)
+            if CATALOG_FIELDS.intersection(fields):
+                bump_version('shops')
+        if CATALOG_FIELDS.intersection(fields):
+            shop_catalog.invalidate()
+        submit_image_variants(fields.get('shop_image'))
 
-        # Fetch updated shopkeeper data
-        updated_shopkeeper = query_db('SELECT * FROM shopkeeper WHERE email = ?', [email], one=True)
         if updated_shopkeeper:
             shopkeeper_data = {
                 'shopkeeper_id': updated_shopkeeper['shopkeeper_id'],
@@ -433,7 +1023,8 @@ def update_shopkeeper():
                 'shop_name': updated_shopkeeper['shop_name'],
                 'address': updated_shopkeeper['address'],
                 'contact': updated_shopkeeper['contact'],
-                'shop_image': url_for('uploaded_file', filename=os.path.basename(updated_shopkeeper['shop_image']), _external=True) if updated_shopkeeper['shop_image'] else None,
+                'shop_image': upload_url(updated_shopkeeper['shop_image']),
+                'shop_image_variants': image_variant_urls(updated_shopkeeper['shop_image']),
                 'cost_single_side': updated_shopkeeper['cost_single_side'],
                 'cost_both_sides': updated_shopkeeper['cost_both_sides']
             }
@@ -441,38 +1032,30 @@ def update_shopkeeper():
     except Exception as e:
         print(f"Error updating shopkeeper: {e}")
         return jsonify({"error": "An error occurred while updating shopkeeper"}), 500
+    finally:
+        if staged:
+            discard_upload(staged)
 
     return jsonify({"message": "Shopkeeper updated successfully"}), 200
 
 #API to store user request data
-@app.route('/api/user_request', methods=['POST'])
+@api.route('/api/user_request', methods=['POST'])
 @jwt_required()
 def create_user_request():
-    current_user = get_jwt_identity()
-    
-    # Check if a file is included in the request
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part'}), 400
-
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
-
-    if file and file_allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-    else:
-        return jsonify({'error': 'File type not allowed'}), 400
+    principal = current_principal()
 
-    user = query_db('SELECT user_id FROM user WHERE email = ?', [current_user['email']], one=True)
-    if not user:
+    # Validate the sender, the shop and the form fields before touching the uploaded file
+    if not principal or not principal.user_id:
         return jsonify({'error': 'User not found'}), 404
     
-    user_id = user['user_id']
+    user_id = principal.user_id
     
-    shop_name = request.form.get('shop_name')
-    shop = query_db('SELECT shopkeeper_id FROM shopkeeper WHERE shop_name = ?', [shop_name], one=True)
+    # Resolve the shop by its id, falling back to the (indexed) shop name sent by older clients
+    shop_id = request.form.get('shop_id')
+    if shop_id:
+        shop = query_db('SELECT shopkeeper_id FROM shopkeeper WHERE shopkeeper_id = ?', [shop_id], one=True)
+    else:
+        shop = query_db('SELECT shopkeeper_id FROM shopkeeper WHERE shop_name = ?', [request.form.get('shop_name')], one=True)
     if not shop:
         return jsonify({'error': 'Shop not found'}), 404
     
@@ -487,29 +1070,83 @@ def create_user_request():
     comments = request.form.get('comments')
 
     # Check if all required fields are provided
-    if not all([total_pages, print_type, print_side, page_size, copies, shop_id, file_path]):
+    if not all([total_pages, print_type, print_side, page_size, copies, shop_id]):
         return jsonify({'error': 'Please provide all required fields'}), 400
 
+    # Check if a file is included in the request
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    # Stream the file to a temporary file in chunks, hashing it and enforcing the size limit of its type
+    try:
+        staged = stage_file(file, file_allowed_file)
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status
+
+    filename = secure_filename(file.filename)
+
+    # The request goes to the shard database of its shop
+    database = shard_map.database(shop_id)
+
+    # The file is stored under its content hash, and only once its row has been inserted.
+    # A file that is already stored is not written again. Runs on the main writer thread.
+    def store_file():
+        file_path = store_blob(staged, current_app.config['UPLOAD_FOLDER'])
+
+        # Content that was analysed before already has a verified page count
+        blob = query_db('SELECT page_count FROM blob WHERE path = ?', [file_path], one=True)
+        return file_path, blob['page_count']
+
+    # Runs on the writer thread of the shard
+    def insert_request(file_path, verified_pages):
+        analysis_status = 'Pending' if verified_pages is None else 'Done'
+        return query_db('''
+            INSERT INTO user_request (id, user_id, total_pages, print_type, print_side, page_size, no_of_copies, shop_id, file_path, file_name, sender_email, status, request_time, update_time, comments, verified_pages, analysis_status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'Pending', ?, ?, ?, ?, ?)
+            RETURNING id, user_id, shop_id, status, action, update_time, analysis_status
+        ''', (next_request_id(database), user_id, total_pages, print_type, print_side, page_size, copies, shop_id, file_path, filename, principal.email, datetime.datetime.now(), datetime.datetime.now(), comments, verified_pages, analysis_status), one=True, database=database)
+
+    # In a single database the file reference and the row are written in one transaction.
+    # A shard is written once the file is stored, and the reference is dropped again if the
+    # insert fails.
+    def store_and_insert():
+        with transaction():
+            file_path, verified_pages = store_file()
+            return file_path, insert_request(file_path, verified_pages)
+
     try:
-        conn = sqlite3.connect('print_seva.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO user_request (user_id, total_pages, print_type, print_side, page_size, no_of_copies, shop_id, file_path, sender_email, status, request_time, update_time, comments)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'Pending', ?, ?, ?)
-        ''', (user_id, total_pages, print_type, print_side, page_size, copies, shop_id, file_path, current_user['email'], datetime.datetime.now(), datetime.datetime.now(), comments))
-        conn.commit()
-        conn.close()
+        if database is None:
+            file_path, created = writer.execute(store_and_insert)
+        else:
+            file_path, verified_pages = writer.execute(store_file)
+            try:
+                created = shard_writers[database].execute(insert_request, file_path, verified_pages)
+            except Exception:
+                writer.execute(release_blob, file_path)
+                raise
     except sqlite3.IntegrityError as e:
         return jsonify({"error": "Failed to create request", "details": str(e)}), 400
+    finally:
+        discard_upload(staged)
+
+    publish_request_change('request_created', created)
+
+    # Count the pages in the background, the response does not wait for it
+    if created['analysis_status'] == 'Pending':
+        analysis_pool.submit(file_path, count_pages, (staged.extension,), store_page_count)
 
     return jsonify({"message": "User request created successfully"}), 201
 
 
 # Get all requests for the current shopkeeper
-@app.route('/api/shopkeeper/requests', methods=['POST'])
+@api.route('/api/shopkeeper/requests', methods=['POST'])
 @jwt_required()
 def get_shopkeeper_requests():
-    current_user = get_jwt_identity()
+    principal = current_principal()
     data = request.get_json()
     shopkeeper_id = data.get('shopkeeper_id')
     
@@ -517,30 +1154,54 @@ def get_shopkeeper_requests():
         return jsonify({'error': 'shopkeeper_id is required'}), 400
 
     # Ensure the current user is authorized to access the shopkeeper's requests
-    shopkeeper = query_db('SELECT shopkeeper_id FROM shopkeeper WHERE email = ? AND shopkeeper_id = ?', 
-                          [current_user['email'], shopkeeper_id], one=True)
-
-    if not shopkeeper:
+    if not principal or str(principal.shopkeeper_id) != str(shopkeeper_id):
         return jsonify({'error': 'Shopkeeper not found or unauthorized access'}), 403
     
-    # Retrieve user requests for the shopkeeper
-    rows = query_db(''' SELECT * FROM user_request WHERE shop_id = ? AND status = 'Pending' ''', [shopkeeper_id])
+    page = get_page_args((str, int))
+    if page is None:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    limit, cursor = page
+
+    since = get_since_arg()
+    if since is False:
+        return jsonify({'error': 'Invalid since'}), 400
+
+    # Only what changed after the client's last sync, requests that left the queue by id
+    if since is not None:
+        return delta_response('*', 'shop_id', shopkeeper_id, since, limit,
+                              keep=lambda row: row['status'] == 'Pending')
+
+    change_seq = current_change_seq()
+    database = shard_map.database(shopkeeper_id)
+
+    # Retrieve user requests for the shopkeeper, one page at a time in (request_time, id) order
+    if cursor:
+        rows = query_db('''
+            SELECT * FROM user_request
+            WHERE shop_id = ? AND status = 'Pending' AND (request_time, id) > (?, ?)
+            ORDER BY request_time, id LIMIT ?
+        ''', [shopkeeper_id, cursor[0], cursor[1], limit + 1], database=database)
+    else:
+        rows = query_db('''
+            SELECT * FROM user_request
+            WHERE shop_id = ? AND status = 'Pending'
+            ORDER BY request_time, id LIMIT ?
+        ''', [shopkeeper_id, limit + 1], database=database)
 
     if rows is None:
         return jsonify({'error': 'Error retrieving requests'}), 500
     
-    # Convert rows to a list of dictionaries
-    requests = [dict(row) for row in rows]
-
-    if len(requests) == 0:
-        return jsonify({'message': 'No requests found for this shopkeeper'}), 200
-
-    return jsonify(requests), 200
+    if len(rows) == 0:
+        response = jsonify({'message': 'No requests found for this shopkeeper'})
+    else:
+        response = page_response(rows, limit, ['request_time', 'id'])
+    response.headers['X-Change-Seq'] = str(change_seq)
+    return response, 200
 
 
 
 # Update the request status based on the shopkeeper's action
-@app.route('/api/shopkeeper/requests/<int:request_id>/<action>', methods=['POST'])
+@api.route('/api/shopkeeper/requests/<int:request_id>/<action>', methods=['POST'])
 @jwt_required()
 def update_request_status(request_id, action):
     try:
@@ -549,48 +1210,125 @@ def update_request_status(request_id, action):
         action = 'Accepted' if action == 'accept' else 'Declined'
         status = 'Responded'
 
-        conn = sqlite3.connect('print_seva.db')
-        cursor = conn.cursor()
-        cursor.execute('''
+        database = request_database(request_id)
+        updated = shard_writers[database].execute(query_db, '''
             UPDATE user_request
             SET status = ?, action = ?, update_time=?
             WHERE id = ?
-        ''', (status, action, datetime.datetime.now(), request_id))
-        conn.commit()
-        conn.close()
+            RETURNING id, user_id, shop_id, status, action, update_time
+        ''', (status, action, datetime.datetime.now(), request_id), one=True, database=database)
+
+        if updated:
+            publish_request_change('request_status', updated)
         
         return jsonify({'message': 'Request updated successfully'}), 200
 
+    except WriteQueueFull:
+        raise
     except Exception as e:
         print(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
     
 
-@app.route('/api/user/notifications', methods=['GET'])
+# Stream of changes to the requests of the current user or shop, as Server-Sent Events.
+# Clients load the list once and then apply these events instead of polling it; an idle
+# stream only waits on its queue and sends a keep-alive comment now and then.
+# API to get a stream token: a token that expires after EVENTS_TOKEN_EXPIRES seconds and only
+# opens /api/events, for EventSource clients that have to put it in the URL. URLs end up in
+# access logs and Referer headers, so the access token itself is never accepted there. Get a
+# new one before the EventSource reconnects.
+@api.route('/api/events/token', methods=['POST'])
+@jwt_required()
+def create_events_token():
+    token = create_access_token(identity=get_jwt_identity(), additional_claims={'scope': EVENTS_SCOPE},
+                                expires_delta=datetime.timedelta(seconds=current_app.config['EVENTS_TOKEN_EXPIRES']))
+    return jsonify({'token': token}), 200
+
+@api.route('/api/events', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def stream_events():
+    if get_jwt_request_location() == 'query_string' and get_jwt().get('scope') != EVENTS_SCOPE:
+        return jsonify({'error': 'Only a token from /api/events/token can be passed in the URL'}), 401
+
+    principal = current_principal()
+    if not principal:
+        return jsonify({'error': 'User not found'}), 404
+
+    if principal.role == 'shopkeeper':
+        channel = f'shop:{principal.shopkeeper_id}'
+    else:
+        channel = f'user:{principal.user_id}'
+    heartbeat = current_app.config['EVENTS_HEARTBEAT']
+    subscription = broker.subscribe(channel)
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = subscription.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            broker.unsubscribe(channel, subscription)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx from buffering the stream
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@api.route('/api/user/notifications', methods=['GET'])
 @jwt_required()
 def get_user_notifications():
-    current_user = get_jwt_identity()
+    principal = current_principal()
+    user_id = principal.user_id if principal else None
+
+    page = get_page_args((str, int))
+    if page is None:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    limit, cursor = page
+
+    since = get_since_arg()
+    if since is False:
+        return jsonify({'error': 'Invalid since'}), 400
+
+    columns = 'id, total_pages, verified_pages, analysis_status, print_type, print_side, page_size, no_of_copies, file_path, file_name, comments, status, action, update_time, request_time, change_seq'
+
+    # Only what changed after the client's last sync
+    if since is not None:
+        return delta_response(columns, 'user_id', user_id, since, limit)
+
+    change_seq = current_change_seq()
 
-    # Retrieve user requests for the current user
-    notifications = query_db('''
-        SELECT id, total_pages, print_type, print_side, page_size, no_of_copies, file_path, comments, status, action, update_time, request_time
+    # Retrieve user requests for the current user, one page at a time in (request_time, id) order.
+    # The user's requests are spread over the shards of their shops, each shard returns its
+    # first page and the pages are merged.
+    query = f'''
+        SELECT {columns}
         FROM user_request
-        WHERE user_id = (SELECT user_id FROM user WHERE email = ?)
-    ''', [current_user['email']])
+        WHERE user_id = ?
+    '''
+    if cursor:
+        notifications = scatter_query(query + ' AND (request_time, id) > (?, ?) ORDER BY request_time, id LIMIT ?',
+                                      [user_id, cursor[0], cursor[1], limit + 1], limit + 1)
+    else:
+        notifications = scatter_query(query + ' ORDER BY request_time, id LIMIT ?', [user_id, limit + 1], limit + 1)
     
     if not notifications:
-        return jsonify({'message': 'No notifications found for this user'}), 404
-
-    # Convert rows to a list of dictionaries
-    requests = [dict(row) for row in notifications]
-
-    if len(requests) == 0:
-        return jsonify({'message': 'No requests found for this shopkeeper'}), 200
+        response = jsonify({'message': 'No notifications found for this user'})
+        response.headers['X-Change-Seq'] = str(change_seq)
+        return response, 404
 
-    return jsonify(requests), 200
+    response = page_response(notifications, limit, ['request_time', 'id'])
+    response.headers['X-Change-Seq'] = str(change_seq)
+    return response, 200
 
 
-@app.route('/api/shopkeeper/pending_requests', methods=['GET'])
+@api.route('/api/shopkeeper/pending_requests', methods=['GET'])
 @jwt_required()
 def get_pending_requests():
     try:
@@ -600,33 +1338,138 @@ def get_pending_requests():
         # Ensure the shopkeeper_id is valid
         if not shopkeeper_id:
             return jsonify({'error': 'shopkeeper_id is required'}), 400
-
-        # Fetch and return requests
-        rows = query_db('''
-            SELECT id, total_pages, print_type, print_side, page_size, no_of_copies, file_path, comments, status, sender_email, request_time
+        if not shopkeeper_id.isdigit():
+            return jsonify({'error': 'Invalid shopkeeper_id'}), 400
+        shopkeeper_id = int(shopkeeper_id)
+
+        page = get_page_args((str, int))
+        if page is None:
+            return jsonify({'error': 'Invalid limit or cursor'}), 400
+        limit, cursor = page
+
+        # Fetch and return requests, one page at a time in (request_time, id) order
+        query = '''
+            SELECT id, total_pages, verified_pages, analysis_status, print_type, print_side, page_size, no_of_copies, file_path, file_name, comments, status, sender_email, request_time
             FROM user_request
             WHERE shop_id = ? AND status = 'Responded' AND action = 'Accepted'
-        ''', [shopkeeper_id])
+        '''
+        database = shard_map.database(shopkeeper_id)
+        if cursor:
+            rows = query_db(query + ' AND (request_time, id) > (?, ?) ORDER BY request_time, id LIMIT ?',
+                            [shopkeeper_id, cursor[0], cursor[1], limit + 1], database=database)
+        else:
+            rows = query_db(query + ' ORDER BY request_time, id LIMIT ?', [shopkeeper_id, limit + 1], database=database)
 
         if rows is None:
             return jsonify({'error': 'Error retrieving requests'}), 500
-        
-        # Convert rows to a list of dictionaries
-        requests = [dict(row) for row in rows]
 
-        if len(requests) == 0:
+        if len(rows) == 0:
             return jsonify({'message': 'No requests found for this shopkeeper'}), 200
 
-        return jsonify(requests), 200
+        return page_response(rows, limit, ['request_time', 'id']), 200
 
     except Exception as e:
         print(f"Error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
 
+# Function to read a timestamp column, stored either by the datetime adapter or CURRENT_TIMESTAMP
+def parse_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Print queue of the current shop: its accepted jobs in the order the scheduler suggests
+# printing them, with the estimated print time and ETA of each. ?policy= picks fifo, sjf or
+# balanced (shortest first, batched by page size and print type, fair across users).
+@api.route('/api/shopkeeper/queue', methods=['GET'])
+@jwt_required()
+def get_print_queue():
+    principal = current_principal()
+    if not principal or not principal.shopkeeper_id:
+        return jsonify({'error': 'Shopkeeper not found or unauthorized access'}), 403
+
+    policy = request.args.get('policy', current_app.config['QUEUE_POLICY'])
+    if policy not in POLICIES:
+        return jsonify({'error': f"policy must be one of {', '.join(POLICIES)}"}), 400
+
+    # The job was accepted when the request was last updated
+    rows = query_db('''
+        SELECT id, user_id, total_pages, verified_pages, print_type, print_side, page_size, no_of_copies, file_path, file_name, comments, sender_email, request_time, update_time
+        FROM user_request
+        WHERE shop_id = ? AND status = 'Responded' AND action = 'Accepted'
+        ORDER BY request_time, id LIMIT ?
+    ''', [principal.shopkeeper_id, current_app.config['QUEUE_MAX_JOBS']], database=shard_map.database(principal.shopkeeper_id))
+
+    now = datetime.datetime.now()
+    rows_by_id = {row['id']: row for row in rows}
+    jobs = []
+    for row in rows:
+        accepted_time = parse_timestamp(row['update_time']) or now
+        # The page count worked out on the server is trusted over the one the user typed in
+        pages = row['verified_pages'] or row['total_pages']
+        jobs.append(Job(row['id'], row['user_id'], pages, row['no_of_copies'], row['print_side'],
+                        row['print_type'], row['page_size'], max((now - accepted_time).total_seconds(), 0)))
+
+    queue_items = []
+    for position, scheduled in enumerate(schedule(jobs, policy), 1):
+        item = dict(rows_by_id[scheduled.job.id])
+        item['position'] = position
+        item['estimated_seconds'] = round(scheduled.estimate)
+        item['eta_seconds'] = round(scheduled.end)
+        item['eta'] = (now + datetime.timedelta(seconds=scheduled.end)).isoformat(timespec='seconds')
+        queue_items.append(item)
+
+    return jsonify({
+        'policy': policy,
+        'jobs': queue_items,
+        'total_seconds': round(queue_items[-1]['eta_seconds']) if queue_items else 0,
+    }), 200
+
+
+# Dashboard figures of the current shop for each of the last ?days= days (30 by default),
+# read from the request_daily_stats rollup, so the cost grows with the days asked for and
+# not with the number of requests.
+@api.route('/api/shopkeeper/stats', methods=['GET'])
+@jwt_required()
+def get_shop_stats():
+    principal = current_principal()
+    if not principal or not principal.shopkeeper_id:
+        return jsonify({'error': 'Shopkeeper not found or unauthorized access'}), 403
+
+    try:
+        days = int(request.args.get('days', 30))
+    except ValueError:
+        return jsonify({'error': 'days must be a number'}), 400
+    if not 1 <= days <= 366:
+        return jsonify({'error': 'days must be between 1 and 366'}), 400
+
+    first_day = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+    rows = query_db('''
+        SELECT day,
+               SUM(CASE WHEN status = 'Pending' THEN requests ELSE 0 END) AS received,
+               SUM(CASE WHEN status = 'Responded' AND action = 'Accepted' THEN requests ELSE 0 END) AS accepted,
+               SUM(CASE WHEN status = 'Responded' AND action = 'Declined' THEN requests ELSE 0 END) AS declined,
+               SUM(CASE WHEN status = 'Printed' THEN requests ELSE 0 END) AS printed,
+               SUM(CASE WHEN status = 'Printed' THEN pages ELSE 0 END) AS pages_printed,
+               SUM(CASE WHEN status = 'Printed' THEN copies ELSE 0 END) AS copies_printed
+        FROM request_daily_stats
+        WHERE shop_id = ? AND day >= ?
+        GROUP BY day ORDER BY day
+    ''', [principal.shopkeeper_id, first_day], database=shard_map.database(principal.shopkeeper_id))
+
+    daily = [dict(row) for row in rows]
+    totals = {key: sum(day[key] for day in daily) for key in
+              ('received', 'accepted', 'declined', 'printed', 'pages_printed', 'copies_printed')}
+    return jsonify({'from': first_day, 'days': daily, 'totals': totals}), 200
+
 
 # Endpoint to update request status
-@app.route('/api/shopkeeper/update_status', methods=['POST'])
+@api.route('/api/shopkeeper/update_status', methods=['POST'])
 @jwt_required()
 def update_request_status_printed():
     data = request.get_json()
@@ -641,28 +1484,127 @@ def update_request_status_printed():
 
         status = 'Printed'
 
-        conn = sqlite3.connect('print_seva.db')
-        cursor = conn.cursor()
-        cursor.execute('''
+        database = request_database(request_id)
+        updated = shard_writers[database].execute(query_db, '''
             UPDATE user_request
             SET status = ?, update_time = ?
             WHERE id = ?
-        ''', (status, datetime.datetime.now(), request_id))
-        conn.commit()
-        conn.close()
+            RETURNING id, user_id, shop_id, status, action, update_time
+        ''', (status, datetime.datetime.now(), request_id), one=True, database=database)
+
+        if updated:
+            publish_request_change('request_status', updated)
         
         return jsonify({'message': 'Request updated successfully'}), 200
 
+    except WriteQueueFull:
+        raise
     except Exception as e:
         print(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/user/requests/<int:request_id>', methods=['GET'])
+# Status and action columns set by each action of the batch endpoint
+BATCH_ACTIONS = {
+    'accept': {'status': 'Responded', 'action': 'Accepted'},
+    'decline': {'status': 'Responded', 'action': 'Declined'},
+    'printed': {'status': 'Printed'},
+}
+
+# Status and action columns a request must have for each action of the batch endpoint: only
+# pending requests are accepted or declined, and only accepted ones are printed
+BATCH_FROM_STATES = {
+    'accept': {'status': 'Pending'},
+    'decline': {'status': 'Pending'},
+    'printed': {'status': 'Responded', 'action': 'Accepted'},
+}
+
+
+# Endpoint to accept, decline or mark as printed many requests of the current shop at once.
+# Takes {"items": [{"id": 1, "action": "accept"}, ...]}; ownership of every id is checked in
+# one query, the updates are applied in one transaction, and the outcome of each item
+# ('updated', 'not_found', 'wrong_state', 'invalid' or 'duplicate') is reported in the same
+# order. Items whose request is not in the state the action starts from are 'wrong_state'.
+@api.route('/api/shopkeeper/requests/batch', methods=['POST'])
+@jwt_required()
+def update_request_status_batch():
+    principal = current_principal()
+    if not principal or not principal.shopkeeper_id:
+        return jsonify({'error': 'Shopkeeper not found or unauthorized access'}), 403
+
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items must be a non-empty list'}), 400
+    if len(items) > current_app.config['MAX_PAGE_SIZE']:
+        return jsonify({'error': f"At most {current_app.config['MAX_PAGE_SIZE']} items per batch"}), 400
+
+    results = []
+    seen = set()
+    for item in items:
+        request_id = item.get('id') if isinstance(item, dict) else None
+        action = item.get('action') if isinstance(item, dict) else None
+        if (not isinstance(request_id, int) or isinstance(request_id, bool)
+                or not isinstance(action, str) or action not in BATCH_ACTIONS):
+            results.append({'id': request_id, 'action': action, 'result': 'invalid'})
+        elif request_id in seen:
+            results.append({'id': request_id, 'action': action, 'result': 'duplicate'})
+        else:
+            seen.add(request_id)
+            results.append({'id': request_id, 'action': action, 'result': None})
+
+    # Requests of other shops are reported as not found, like ids that do not exist
+    database = shard_map.database(principal.shopkeeper_id)
+    owned = {row['id']: row for row in query_db('''
+        SELECT id, status, action FROM user_request
+        WHERE id IN (SELECT value FROM json_each(?)) AND shop_id = ?
+    ''', [json.dumps(sorted(seen)), principal.shopkeeper_id], database=database)}
+
+    by_action = {}
+    for result in results:
+        if result['result'] is None:
+            row = owned.get(result['id'])
+            if row is None:
+                result['result'] = 'not_found'
+            elif any(row[column] != value for column, value in BATCH_FROM_STATES[result['action']].items()):
+                result['result'] = 'wrong_state'
+            else:
+                by_action.setdefault(result['action'], []).append(result['id'])
+
+    # One UPDATE per action, all in the same transaction on the writer thread of the shard. The
+    # state is checked again there, in case it changed since it was read above.
+    def apply_actions():
+        updated = []
+        now = datetime.datetime.now()
+        with transaction(database):
+            for action, ids in by_action.items():
+                fields, states = BATCH_ACTIONS[action], BATCH_FROM_STATES[action]
+                assignments = ', '.join(f'{column} = ?' for column in fields)
+                conditions = ''.join(f' AND {column} = ?' for column in states)
+                updated += query_db(f'''
+                    UPDATE user_request SET {assignments}, update_time = ?
+                    WHERE id IN (SELECT value FROM json_each(?)) AND shop_id = ?{conditions}
+                    RETURNING id, user_id, shop_id, status, action, update_time
+                ''', [*fields.values(), now, json.dumps(ids), principal.shopkeeper_id, *states.values()], database=database)
+        return updated
+
+    updated = shard_writers[database].execute(apply_actions)
+
+    updated_ids = {row['id'] for row in updated}
+    for result in results:
+        if result['result'] is None:
+            result['result'] = 'updated' if result['id'] in updated_ids else 'wrong_state'
+    for row in updated:
+        publish_request_change('request_status', row)
+
+    return jsonify({'results': results, 'updated': len(updated)}), 200
+
+
+@api.route('/api/user/requests/<int:request_id>', methods=['GET'])
 def get_request_details(request_id):
     try:
         # Fetch the request from the database
-        user_request = query_db(''' SELECT * FROM user_request WHERE id = ? LIMIT 1''', [request_id], one=True)
+        user_request = query_db(''' SELECT * FROM user_request WHERE id = ? LIMIT 1''', [request_id], one=True, database=request_database(request_id))
         
         if not user_request:
             return jsonify({"error": "Request not found"}), 404
@@ -671,6 +1613,8 @@ def get_request_details(request_id):
         request_data = {
             "id": user_request['id'],
             "total_pages": user_request['total_pages'],
+            "verified_pages": user_request['verified_pages'],
+            "analysis_status": user_request['analysis_status'],
             "print_type": user_request['print_type'],
             "print_side": user_request['print_side'],
             "page_size": user_request['page_size'],
@@ -686,31 +1630,21 @@ def get_request_details(request_id):
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/api/user/requests/update/<int:request_id>', methods=['PUT'])
+# Fields of a request that the user may edit after sending it
+EDITABLE_REQUEST_FIELDS = ('total_pages', 'print_type', 'print_side', 'page_size', 'no_of_copies', 'comments')
+
+
+@api.route('/api/user/requests/update/<int:request_id>', methods=['PUT'])
 def update_request(request_id):
     data = request.get_json()
     try:
-        # Update the fields if they exist in the request data
-        if 'total_pages' in data:
-            query_db('UPDATE user_request SET total_pages = ? WHERE id = ?', [data['total_pages'], request_id])
-        if 'print_type' in data:
-            query_db('UPDATE user_request SET print_type = ? WHERE id = ?', [data['print_type'], request_id])
-        if 'print_side' in data:
-            query_db('UPDATE user_request SET print_side = ? WHERE id = ?', [data['print_side'], request_id])
-        if 'page_size' in data:
-            query_db('UPDATE user_request SET page_size = ? WHERE id = ?', [data['page_size'], request_id])
-        if 'no_of_copies' in data:
-            query_db('UPDATE user_request SET no_of_copies = ? WHERE id = ?', [data['no_of_copies'], request_id])
-        if 'comments' in data:
-            query_db('UPDATE user_request SET comments = ? WHERE id = ?', [data['comments'], request_id])
-        
-        # Update the request time to the current time
-        query_db('UPDATE user_request SET update_time = ? WHERE id = ?', [datetime.datetime.now(), request_id])
-        
-        # Fetch the updated request data
-        updated_request = query_db('SELECT * FROM user_request WHERE id = ?', [request_id], one=True)
-        
+        # Update the fields if they exist in the request data, together with the update time
+        fields = {field: data[field] for field in EDITABLE_REQUEST_FIELDS if field in data}
+        fields['update_time'] = datetime.datetime.now()
+        updated_request = update_row('user_request', 'id', request_id, fields, database=request_database(request_id))
+
         if updated_request:
+            publish_request_change('request_updated', updated_request)
             request_data = {
                 'id': updated_request['id'],
                 'user_id': updated_request['user_id'],
@@ -723,22 +1657,30 @@ def update_request(request_id):
                 'update_time': updated_request['update_time']
             }
             return jsonify({"message": "Request updated successfully", "request": request_data}), 200
-        
+
     except Exception as e:
         print(f"Error updating request: {e}")
         return jsonify({"error": "An error occurred while updating request"}), 500
 
+    return jsonify({"error": "Request not found"}), 404
+
 
-@app.route('/api/user/requests/<int:request_id>', methods=['DELETE'])
+@api.route('/api/user/requests/<int:request_id>', methods=['DELETE'])
 def delete_request(request_id):
     try:
-        request_to_delete = query_db('SELECT * FROM user_request WHERE id = ?', [request_id], one=True)
+        database = request_database(request_id)
+        request_to_delete = query_db('SELECT * FROM user_request WHERE id = ?', [request_id], one=True, database=database)
         
         if not request_to_delete:
             return jsonify({"error": "Request not found"}), 404
 
-        # Perform the deletion
-        query_db('DELETE FROM user_request WHERE id = ?', [request_id])
+        # Perform the deletion and drop the request's reference to its file. The main database
+        # commits last, so a failure in between keeps the file rather than losing it.
+        with transaction(), transaction(database):
+            execute_db('DELETE FROM user_request WHERE id = ?', [request_id], database=database)
+            release_blob(request_to_delete['file_path'])
+
+        publish_request_change('request_deleted', request_to_delete)
 
         return jsonify({"message": "Request deleted successfully", "request_id": request_id}), 200
     
@@ -747,26 +1689,230 @@ def delete_request(request_id):
         return jsonify({"error": "An error occurred while deleting the request"}), 500
 
 # Download file API
-@app.route('/api/download/uploads/<path:filename>', methods=['GET'])
+# Function to build the Content-Disposition of a download as in RFC 6266: an ASCII filename for
+# old clients and the exact name, percent-encoded as UTF-8, in filename*
+def attachment_disposition(name):
+    fallback = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    fallback = re.sub(r'[\x00-\x1f\x7f"\\%]', '_', fallback) or 'download'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(name, safe='')}"
+
+# Function to get the name to download a stored upload as. Blobs are named after their hash,
+# so it is the original name the caller's own request gave the file; other files keep theirs.
+def download_name(path):
+    principal = current_principal()
+    if principal and principal.shopkeeper_id:
+        owner_column, owner_id, databases = 'shop_id', principal.shopkeeper_id, [shard_map.database(principal.shopkeeper_id)]
+    elif principal and principal.user_id:
+        owner_column, owner_id, databases = 'user_id', principal.user_id, shard_map.databases()
+    else:
+        databases = []
+    for database in databases:
+        row = query_db(f'''
+            SELECT file_name FROM user_request WHERE {owner_column} = ? AND file_path = ? AND file_name IS NOT NULL
+            ORDER BY request_time DESC LIMIT 1
+        ''', [owner_id, path], one=True, database=database)
+        if row and row['file_name']:
+            return row['file_name']
+    return os.path.basename(path)
+
+@api.route('/api/download/uploads/<path:filename>', methods=['GET'])
 @jwt_required()
 def download_file(filename):
     current_user = get_jwt_identity()
 
     try:
-        directory = app.config['UPLOAD_FOLDER']
-        return send_from_directory(directory, filename, as_attachment=True)
-    except FileNotFoundError:
+        directory = current_app.config['UPLOAD_FOLDER']
+        path = safe_join(directory, filename)
+        if path is None or not os.path.isfile(path):
+            return jsonify({'error': 'File not found'}), 404
+
+        # Let the front proxy send the file, it handles Range and conditional requests itself
+        offload = current_app.config['DOWNLOAD_OFFLOAD']
+        if offload:
+            response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            response.headers['Content-Disposition'] = attachment_disposition(download_name(path))
+            if offload == 'x-accel-redirect':
+                # nginx decodes the URI, so names with spaces, '%' or non-ASCII characters survive
+                response.headers['X-Accel-Redirect'] = current_app.config['DOWNLOAD_ACCEL_PREFIX'] + quote(filename)
+            else:
+                response.headers['X-Sendfile'] = os.path.abspath(path)
+            return response
+
+        # Blobs are named after their SHA-256, which makes a strong ETag that survives restores and copies.
+        # conditional=True answers Range with 206 and If-None-Match / If-Modified-Since with 304.
+        etag = os.path.splitext(os.path.basename(filename))[0] if is_blob(filename) else True
+        response = send_from_directory(directory, filename, as_attachment=True, conditional=True, etag=etag)
+        response.headers['Content-Disposition'] = attachment_disposition(download_name(path))
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+    except NotFound:
         return jsonify({'error': 'File not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-# File Upload API
-@app.route('/uploads/<filename>')
+# File Upload API. Images can be requested resized with ?size=thumb|medium, in WebP when the
+# client accepts it and JPEG otherwise. Until the background pool has written the variant the
+# original is served. Content-addressed blobs never change, so they are cached for a year.
+@api.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    size = request.args.get('size')
+    if size and size not in VARIANT_SIZES:
+        return jsonify({'error': 'Unknown image size'}), 400
+
+    immutable = is_blob(filename)
+    if size and immutable:
+        allowed_types = {mimetype: extension for extension, (_, mimetype) in VARIANT_FORMATS.items()}
+        best = request.accept_mimetypes.best_match(list(allowed_types), default='image/jpeg')
+        variant = variant_path(filename, size, allowed_types[best])
+        if os.path.exists(os.path.join(current_app.config['UPLOAD_FOLDER'], variant)):
+            response = send_from_directory(current_app.config['UPLOAD_FOLDER'], variant, conditional=True)
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+            response.headers['Vary'] = 'Accept'
+            return response
+        immutable = False
+
+    response = send_from_directory(current_app.config['UPLOAD_FOLDER'], filename, conditional=True)
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+# Metrics of this worker in the Prometheus text format. They are not authenticated, keep the
+# path reachable from the scraper only.
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+# Function to stop the pools, write queues and retention job of the app created before, if any
+def shutdown_resources():
+    if retention_job is not None:
+        retention_job.shutdown()
+    if analysis_pool is not None:
+        analysis_pool.shutdown(wait=False)
+    if bcrypt is not None:
+        bcrypt.shutdown()
+    for write_queue in {None: writer, **shard_writers}.values():
+        if write_queue is not None:
+            write_queue.shutdown()
+
+
+# Function to build the app with the given config overrides and return it. Importing this
+# module has no side effects; servers call the factory, e.g. gunicorn 'app:create_app()', and
+# `flask run` finds it by itself. Starting a worker on an up to date database only reads the
+# schema version of each file. The pools and queues of a process belong to the app created
+# last: calling the factory again stops the ones of the previous app first.
+def create_app(config=None):
+    global bcrypt, writer, shard_map, shard_writers, analysis_pool, retention_job
+    app = Flask(__name__)
+    app.config['JWT_SECRET_KEY'] = 'your_print_seva_secret_key'
+    app.config['UPLOAD_FOLDER'] = 'uploads'
+    app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
+    app.config['FILE_ALLOWED_EXTENSIONS'] = {'pdf', 'docx', 'txt', 'png', 'jpg', 'jpeg'}
+
+    # Largest request body accepted at all, bigger bodies are refused with 413 before they are read
+    app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
+
+    # Largest print document accepted for each file type, in bytes
+    app.config['MAX_FILE_SIZE'] = {
+        'pdf': 50 * 1024 * 1024,
+        'docx': 25 * 1024 * 1024,
+        'txt': 5 * 1024 * 1024,
+        'png': 10 * 1024 * 1024,
+        'jpg': 10 * 1024 * 1024,
+        'jpeg': 10 * 1024 * 1024,
+    }
+
+    # bcrypt cost factor for new hashes. Existing hashes made with another cost are
+    # transparently rehashed the next time their owner logs in.
+    app.config['BCRYPT_LOG_ROUNDS'] = 12
+    # Worker processes doing bcrypt, and how many more hashes may wait for one before
+    # requests are refused with 503
+    app.config['PASSWORD_HASH_WORKERS'] = os.cpu_count() or 2
+    app.config['PASSWORD_HASH_QUEUE'] = 32
+
+    # Hand file downloads over to the front proxy instead of streaming them from a Python worker:
+    # None, 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+    app.config['DOWNLOAD_OFFLOAD'] = None
+    # nginx location marked 'internal' that is aliased to UPLOAD_FOLDER, used with x-accel-redirect
+    app.config['DOWNLOAD_ACCEL_PREFIX'] = '/protected-uploads/'
+
+    # Number of worker processes counting the pages of uploaded documents
+    app.config['ANALYSIS_WORKERS'] = 2
+
+    # Default and maximum number of rows returned by one page of a list endpoint
+    app.config['PAGE_SIZE'] = 100
+    app.config['MAX_PAGE_SIZE'] = 500
+
+    # Tokens are only taken from the Authorization header. Browsers cannot send it with an
+    # EventSource, so /api/events also takes a stream token from the ?jwt= query parameter.
+    app.config['JWT_TOKEN_LOCATION'] = ['headers']
+    # Seconds a stream token from /api/events/token can be used to open the event stream
+    app.config['EVENTS_TOKEN_EXPIRES'] = 60
+    # Seconds between keep-alive comments on an idle event stream
+    app.config['EVENTS_HEARTBEAT'] = 15
+
+    # Writes queued within this many seconds of each other are committed together by the writer
+    # thread, at most WRITE_BATCH_SIZE at a time; more than WRITE_QUEUE_SIZE waiting writes are
+    # refused with 503
+    app.config['WRITE_BATCH_WINDOW'] = 0.002
+    app.config['WRITE_BATCH_SIZE'] = 64
+    app.config['WRITE_QUEUE_SIZE'] = 1000
+
+    # Number of database files user_request is spread over by shop_id, each with its own write
+    # lock and writer thread; 1 keeps every table in one file. After changing it, run
+    # `python shards.py --shards N rebalance` to move the existing requests to their shard.
+    app.config['SHARD_COUNT'] = 1
+
+    # Requests that take at least this many seconds are logged together with the SQL they ran;
+    # None turns the slow request log off, and with it the recording of the SQL text
+    app.config['SLOW_REQUEST_SECONDS'] = None
+
+    # Finished (printed or declined) requests older than this many days are moved to the archive
+    # database, and tombstones of deleted requests are kept for TOMBSTONE_RETENTION_DAYS
+    app.config['RETENTION_DAYS'] = 90
+    app.config['TOMBSTONE_RETENTION_DAYS'] = 30
+    # Seconds between runs of the retention job in each worker, None to run it from cron
+    # with `python retention.py` instead
+    app.config['RETENTION_INTERVAL'] = 3600
+
+    # Ordering policy of the print queue when the shopkeeper does not pick one, see scheduler.py
+    app.config['QUEUE_POLICY'] = 'balanced'
+    # Most accepted jobs scheduled at once, the oldest ones first
+    app.config['QUEUE_MAX_JOBS'] = 1000
+
+    if config:
+        app.config.update(config)
+
+    shutdown_resources()
+    bcrypt = PasswordHasher(app.config['BCRYPT_LOG_ROUNDS'], app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'])
+    bcrypt.listeners.append(lambda operation, elapsed: password_latency.observe(elapsed, operation))
+    writer = WriteQueue(app.config['WRITE_BATCH_WINDOW'], app.config['WRITE_BATCH_SIZE'], app.config['WRITE_QUEUE_SIZE'])
+    shard_map = ShardMap(app.config['SHARD_COUNT'])
+    shard_writers = {database: writer if database is None else
+                     WriteQueue(app.config['WRITE_BATCH_WINDOW'], app.config['WRITE_BATCH_SIZE'], app.config['WRITE_QUEUE_SIZE'], database=database)
+                     for database in shard_map.databases()}
+    analysis_pool = AnalysisPool(app.config['ANALYSIS_WORKERS'])
+    retention_job = RetentionJob(app.config['UPLOAD_FOLDER'], app.config['RETENTION_DAYS'], app.config['TOMBSTONE_RETENTION_DAYS'],
+                                 databases=shard_map.databases())
+
+    jwt.init_app(app)
+    # The cursor of the next page and the change sequence are sent in headers so list bodies stay plain arrays
+    CORS(app, expose_headers=['X-Next-Cursor', 'X-Change-Seq'])
+    app.register_blueprint(api)
+
+    # Create uploads directory if it doesn't exist
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # Bring the databases to the latest schema version, structure is defined in models.py file
+    create_tables(app.config['SHARD_COUNT'])
+    return app
 
 
 # Run the Flask app on default port 5000 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,385 @@
+import argparse
+import collections
+import datetime
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import db
+from scheduler import PRINT_SIDES, PRINT_TYPES, Job, schedule
+
+# Endpoints driven by default, in the order they are run
+ENDPOINTS = ('login', 'shops', 'upload', 'notifications', 'status_update', 'download')
+
+# Password of every seeded account
+PASSWORD = 'benchmark-password'
+
+# Mix of the statuses seeded requests are given, as (status, action, weight)
+REQUEST_STATES = (
+    ('Pending', 'Pending', 5),
+    ('Responded', 'Accepted', 2),
+    ('Responded', 'Declined', 1),
+    ('Printed', 'Accepted', 2),
+)
+
+
+# Counter of the SQL statements run through query_db and execute_db, by every thread
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, query, elapsed):
+        with self.lock:
+            self.count += 1
+
+
+# Function to get the peak resident set size of this process so far, in kilobytes. The peak
+# never goes down, so a phase reports how much it raised it over the peak before it ran.
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+# Function to get the nearest-rank percentile of sorted values
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+# Function to summarize the latencies (in seconds) of one phase, rss_baseline being the peak
+# resident set size before it
+def summarize(latencies, errors, elapsed, statements, rss_baseline):
+    latencies = sorted(latencies)
+    milliseconds = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': milliseconds(percentile(latencies, 0.50)),
+        'p95_ms': milliseconds(percentile(latencies, 0.95)),
+        'p99_ms': milliseconds(percentile(latencies, 0.99)),
+        'mean_ms': milliseconds(sum(latencies) / len(latencies)) if latencies else None,
+        'max_ms': milliseconds(latencies[-1]) if latencies else None,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'sql_per_request': round(statements / len(latencies), 2) if latencies else None,
+        'peak_rss_growth_kb': peak_rss_kb() - rss_baseline,
+    }
+
+
+# Function to build the content of a synthetic PDF document of about size bytes
+def synthetic_pdf(rng, pages, size):
+    header = f'%PDF-1.4\n1 0 obj<</Type/Pages/Count {pages}/Kids[]>>endobj\n'.encode('ascii')
+    padding = max(size - len(header) - 6, 0)
+    return header + b'%' + rng.randbytes(padding // 2 + 1).hex().encode('ascii')[:padding] + b'\n%%EOF'
+
+
+# Deterministic data set for the benchmark, written through the schema of create_app() and the
+# same tables and shard placement the app uses. The same seed and counts always give the
+# same database, so results of two releases can be compared.
+class Dataset:
+    def __init__(self, seed, users, shops, requests, files, file_size):
+        self.rng = random.Random(seed)
+        self.users = users
+        self.shops = shops
+        self.requests = requests
+        self.files = files
+        self.file_size = file_size
+        self.file_paths = []
+        self.pending = {}
+
+    def seed(self, app_module, app):
+        from blobstore import blob_path
+        from passwords import hash_password
+        from shards import next_request_id
+
+        # One hash for every account, made with the cost factor of the app so logins never rehash
+        pw_hash = hash_password(PASSWORD, app.config['BCRYPT_LOG_ROUNDS'])
+        rng = self.rng
+
+        with db.transaction():
+            db.get_db().executemany('INSERT INTO user (name, email, password, contact, address) VALUES (?, ?, ?, ?, ?)', [
+                (f'User {i}', f'user{i}@bench.test', pw_hash, f'9{i:09d}', f'{i} Bench Road') for i in range(self.users)])
+            db.get_db().executemany('''
+                INSERT INTO shopkeeper (name, email, password, shop_name, address, contact, cost_single_side, cost_both_sides)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(f'Owner {i}', f'shop{i}@bench.test', pw_hash, f'Bench Shop {i}', f'{i} Market Street', f'8{i:09d}',
+                   rng.choice((1, 1.5, 2, 2.5)), rng.choice((1.5, 2, 3, 4))) for i in range(self.shops)])
+            db.execute_db("INSERT INTO user_roles (email, role, user_id) SELECT email, 'user', user_id FROM user")
+            db.execute_db("INSERT INTO user_roles (email, role, shopkeeper_id) SELECT email, 'shopkeeper', shopkeeper_id FROM shopkeeper")
+            db.bump_version('shops')
+
+            # Synthetic uploads, stored as blobs like the ones the app writes
+            folder = app.config['UPLOAD_FOLDER']
+            for _ in range(self.files):
+                content = synthetic_pdf(rng, rng.randint(1, 40), self.file_size)
+                digest = hashlib.sha256(content).hexdigest()
+                path = blob_path(folder, digest, 'pdf')
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(content)
+                db.execute_db('INSERT OR IGNORE INTO blob (sha256, path, size, ref_count) VALUES (?, ?, ?, 0)', [digest, path, len(content)])
+                self.file_paths.append(path)
+
+        users = {row['user_id']: row['email'] for row in db.query_db('SELECT user_id, email FROM user')}
+        shops = {row['shopkeeper_id']: row['email'] for row in db.query_db('SELECT shopkeeper_id, email FROM shopkeeper')}
+        user_ids, shop_ids = sorted(users), sorted(shops)
+        states = [(status, action) for status, action, weight in REQUEST_STATES for _ in range(weight)]
+        now = datetime.datetime.now()
+        rows = {}
+        for _ in range(self.requests):
+            shop_id = rng.choice(shop_ids)
+            status, action = rng.choice(states)
+            request_time = now - datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 60))
+            rows.setdefault(app_module.shard_map.database(shop_id), []).append((
+                rng.choice(user_ids), rng.randint(1, 40), rng.choice(PRINT_TYPES), rng.choice(PRINT_SIDES),
+                rng.choice(('A4', 'A3', 'Letter')), rng.randint(1, 5), shop_id, rng.choice(self.file_paths), 'document.pdf',
+                status, action, request_time, request_time + datetime.timedelta(minutes=rng.randint(0, 600))))
+
+        for database, shard_rows in rows.items():
+            with db.transaction(database):
+                for row in shard_rows:
+                    db.execute_db('''
+                        INSERT INTO user_request (id, user_id, total_pages, print_type, print_side, page_size, no_of_copies, shop_id, file_path, file_name, status, action, request_time, update_time, analysis_status)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'Done')
+                    ''', [next_request_id(database), *row], database=database)
+                pending = db.query_db("SELECT id, shop_id FROM user_request WHERE status = 'Pending'", database=database)
+            for row in pending:
+                self.pending.setdefault(row['shop_id'], []).append(row['id'])
+        references = collections.Counter(row[7] for shard_rows in rows.values() for row in shard_rows)
+        with db.transaction():
+            for path, count in references.items():
+                db.execute_db('UPDATE blob SET ref_count = ? WHERE path = ?', [count, path])
+
+        return users, shops
+
+
+# Runs the endpoints of the real app with the Flask test client, each of them once with a
+# single client and once with several concurrent ones
+class Benchmark:
+    def __init__(self, app_module, app, dataset, users, shops, iterations, login_iterations, clients, warmup):
+        self.app_module = app_module
+        self.app = app
+        self.dataset = dataset
+        self.users = users
+        self.user_ids = sorted(users)
+        self.shop_ids = sorted(shops)
+        self.iterations = iterations
+        self.login_iterations = login_iterations
+        self.clients = clients
+        self.warmup = warmup
+        self.lock = threading.Lock()
+        self.statements = StatementCounter()
+        db.statement_listeners.append(self.statements)
+
+        # Tokens are made directly, so only the login endpoint pays for bcrypt
+        from flask_jwt_extended import create_access_token
+        token_identity = app_module.token_identity
+        with self.app.app_context():
+            self.user_tokens = {user_id: create_access_token(identity=token_identity(email, 'user', user_id))
+                                for user_id, email in users.items()}
+            self.shop_tokens = {shop_id: create_access_token(identity=token_identity(email, 'shopkeeper', shop_id))
+                                for shop_id, email in shops.items()}
+
+    def user_headers(self, rng):
+        return {'Authorization': f'Bearer {self.user_tokens[rng.choice(self.user_ids)]}'}
+
+    def login(self, client, rng):
+        return client.post('/login/user', json={'email': self.users[rng.choice(self.user_ids)], 'password': PASSWORD}), (200,)
+
+    def shops(self, client, rng):
+        return client.get('/api/shops'), (200,)
+
+    def upload(self, client, rng):
+        # Every other upload repeats stored content, the rest is new
+        content = synthetic_pdf(rng, rng.randint(1, 40), self.dataset.file_size)
+        if rng.random() < 0.5:
+            with open(rng.choice(self.dataset.file_paths), 'rb') as f:
+                content = f.read()
+        return client.post('/api/user_request', headers=self.user_headers(rng), content_type='multipart/form-data', data={
+            'file': (io.BytesIO(content), 'document.pdf'),
+            'shop_id': str(rng.choice(self.shop_ids)),
+            'total_pages': str(rng.randint(1, 40)),
+            'print_type': rng.choice(PRINT_TYPES),
+            'print_side': rng.choice(PRINT_SIDES),
+            'page_size': 'A4',
+            'no_of_copies': str(rng.randint(1, 5)),
+        }), (201,)
+
+    def notifications(self, client, rng):
+        return client.get('/api/user/notifications?limit=50', headers=self.user_headers(rng)), (200, 404)
+
+    def status_update(self, client, rng):
+        with self.lock:
+            shop_id = rng.choice([shop_id for shop_id, ids in self.dataset.pending.items() if ids] or self.shop_ids)
+            ids = self.dataset.pending.get(shop_id)
+            request_id = ids.pop() if ids else 0
+        return client.post(f'/api/shopkeeper/requests/{request_id}/accept',
+                           headers={'Authorization': f'Bearer {self.shop_tokens[shop_id]}'}), (200,)
+
+    def download(self, client, rng):
+        path = os.path.relpath(rng.choice(self.dataset.file_paths), self.app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        return client.get(f'/api/download/uploads/{path}', headers=self.user_headers(rng)), (200,)
+
+    # Function to call one endpoint iterations times from clients threads and summarize it
+    def run_phase(self, endpoint, iterations, clients, seed):
+        call = getattr(self, endpoint)
+        latencies, errors = [], []
+
+        def work(index):
+            rng = random.Random(f'{seed}-{endpoint}-{clients}-{index}')
+            client = self.app.test_client()
+            count = iterations // clients + (1 if index < iterations % clients else 0)
+            for _ in range(count):
+                started = time.perf_counter()
+                response, expected = call(client, rng)
+                elapsed = time.perf_counter() - started
+                response.close()
+                with self.lock:
+                    latencies.append(elapsed)
+                    if response.status_code not in expected:
+                        errors.append(response.status_code)
+
+        for index in range(self.warmup):
+            call(self.app.test_client(), random.Random(f'{seed}-warmup-{index}'))[0].close()
+        self.statements.count = 0
+        rss_baseline = peak_rss_kb()
+        started = time.perf_counter()
+        threads = [threading.Thread(target=work, args=(index,)) for index in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result = summarize(latencies, len(errors), time.perf_counter() - started, self.statements.count, rss_baseline)
+        if errors:
+            result['error_statuses'] = sorted(set(errors))
+        return result
+
+    def run(self, endpoints, seed):
+        results = {}
+        for endpoint in endpoints:
+            iterations = self.login_iterations if endpoint == 'login' else self.iterations
+            results[endpoint] = {}
+            for mode, clients in (('serial', 1), ('concurrent', self.clients)):
+                print(f'{endpoint} {mode}...', file=sys.stderr)
+                results[endpoint][mode] = self.run_phase(endpoint, iterations, clients, seed)
+        return results
+
+
+# Function to time a function called iterations times in this thread
+def time_calls(function, iterations):
+    latencies = []
+    rss_baseline = peak_rss_kb()
+    for _ in range(iterations):
+        started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies, 0, sum(latencies), 0, rss_baseline)
+
+
+# Micro-benchmarks of the hot helpers behind the endpoints, without HTTP in between
+def micro_benchmarks(app_module, shop_ids, iterations, seed):
+    rng = random.Random(f'{seed}-micro')
+    jobs = [Job(i, rng.randrange(50), rng.randint(1, 200), rng.randint(1, 5), rng.choice(PRINT_SIDES),
+                rng.choice(PRINT_TYPES), rng.choice(('A4', 'A3')), rng.randint(0, 3600)) for i in range(1000)]
+    version = db.get_version('shops')
+    shop_id = shop_ids[0]
+    return {
+        'schedule_1000_jobs': time_calls(lambda: schedule(jobs, 'balanced'), max(iterations // 10, 1)),
+        'rank_shops': time_calls(lambda: app_module.price_table.rank_shops(version, 12, 2, False, 10), iterations),
+        'query_db_lookup': time_calls(lambda: db.query_db('SELECT * FROM shopkeeper WHERE shopkeeper_id = ?', [shop_id], one=True), iterations),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a database and benchmark the endpoints of the app, results as JSON')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--shops', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--files', type=int, default=50, help='synthetic upload files to seed')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='bytes per synthetic file')
+    parser.add_argument('--iterations', type=int, default=200, help='requests per endpoint and mode')
+    parser.add_argument('--login-iterations', type=int, default=20, help='requests for the bcrypt bound login endpoint')
+    parser.add_argument('--clients', type=int, default=8, help='threads of the concurrent mode')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--workdir', help='directory of the seeded database and uploads, a new temporary one by default')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory')
+    parser.add_argument('--output', help='file to write the JSON results to instead of stdout')
+    args = parser.parse_args()
+
+    endpoints = [endpoint for endpoint in args.endpoints.split(',') if endpoint]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    if args.shops < 1 or args.users < 1 or args.files < 1:
+        parser.error('--users, --shops and --files must be at least 1')
+
+    # The app keeps its database and uploads in the working directory
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='print_seva_bench_'))
+    os.makedirs(workdir, exist_ok=True)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    try:
+        import app as app_module
+        app = app_module.create_app()
+        app.root_path = workdir
+
+        dataset = Dataset(args.seed, args.users, args.shops, args.requests, args.files, args.file_size)
+        print(f'Seeding {workdir}...', file=sys.stderr)
+        users, shops = dataset.seed(app_module, app)
+
+        benchmark = Benchmark(app_module, app, dataset, users, shops, args.iterations, args.login_iterations,
+                              args.clients, args.warmup)
+        results = {
+            'meta': {
+                'seed': args.seed,
+                'users': args.users,
+                'shops': args.shops,
+                'requests': args.requests,
+                'files': args.files,
+                'file_size': args.file_size,
+                'iterations': args.iterations,
+                'login_iterations': args.login_iterations,
+                'clients': args.clients,
+                'shard_count': app.config['SHARD_COUNT'],
+                'bcrypt_rounds': app.config['BCRYPT_LOG_ROUNDS'],
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            },
+            'endpoints': benchmark.run(endpoints, args.seed),
+            'micro': micro_benchmarks(app_module, sorted(shops), args.iterations, args.seed),
+        }
+        results['meta']['peak_rss_kb'] = peak_rss_kb()
+    finally:
+        os.chdir('/')
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import os
+
+from db import query_db, execute_db
+from uploads import commit_upload, discard_upload
+
+# Number of two-character directory levels blobs are sharded into, e.g. uploads/ab/cd/abcd...
+SHARD_LEVELS = 2
+
+
+# Function to get the path of a blob from its SHA-256, sharded by the leading hex digits
+def blob_path(upload_folder, digest, extension):
+    shards = [digest[i * 2:i * 2 + 2] for i in range(SHARD_LEVELS)]
+    filename = f'{digest}.{extension}' if extension else digest
+    return os.path.join(upload_folder, *shards, filename)
+
+
+# Function to store a staged upload as a content-addressed blob and return its path.
+# Must run inside transaction(): the reference is counted in the same transaction as the row
+# that points at the blob. If the content is already stored, the staged copy is dropped and
+# the write is skipped entirely. The file is put in place before the transaction commits, while
+# it holds the write lock; the retention job only removes blob files under that lock, and
+# removes the file of a transaction that rolled back once it is older than its grace period.
+def store_blob(staged, upload_folder):
+    blob = query_db('SELECT path FROM blob WHERE sha256 = ?', [staged.sha256], one=True)
+    if blob:
+        path = blob['path']
+        execute_db('UPDATE blob SET ref_count = ref_count + 1 WHERE sha256 = ?', [staged.sha256])
+    else:
+        path = blob_path(upload_folder, staged.sha256, staged.extension)
+        execute_db('INSERT INTO blob (sha256, path, size, ref_count) VALUES (?, ?, ?, 1)',
+                   [staged.sha256, path, staged.size])
+
+    if os.path.exists(path):
+        discard_upload(staged)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        commit_upload(staged, path)
+    return path
+
+
+# Function to drop one reference to a blob. Blobs left without references are removed
+# from disk by the garbage collection job, not here, so a concurrent upload of the same
+# content can still reuse the file.
+def release_blob(path):
+    if path:
+        execute_db('UPDATE blob SET ref_count = ref_count - 1 WHERE path = ? AND ref_count > 0', [path])
@@ -0,0 +1,70 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+# A serialized response body together with its strong ETag and extra headers
+CachedPage = namedtuple('CachedPage', ['body', 'etag', 'headers'])
+
+
+# In-process cache of serialized responses that all belong to one version of the underlying
+# data. The version lives in the database (see the cache_version table), so when this or any
+# other worker writes and bumps it, the next lookup sees a new version and drops every entry.
+class VersionedCache:
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, version, key):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+                return None
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, version, key, body, headers=None):
+        etag = '"%d-%s"' % (version, hashlib.sha1(body).hexdigest()[:20])
+        entry = CachedPage(body, etag, headers or {})
+        with self.lock:
+            # Do not store a page built from data that another request already replaced
+            if version == self.version:
+                self.entries[key] = entry
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.version = None
+
+
+# Small thread-safe LRU mapping, with explicit invalidation of single keys
+class LRUCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
@@ -0,0 +1,194 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DATABASE = 'print_seva.db'
+
+# Number of prepared statements each connection keeps in its cache
+STATEMENT_CACHE_SIZE = 256
+
+# Pragmas applied once to every new connection. WAL lets readers run alongside the
+# single writer, and synchronous=NORMAL only fsyncs at checkpoints in WAL mode.
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 134217728',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# Each thread keeps its own connection to every database it uses for the life of the worker
+# process. None stands for DATABASE; the shard files of user_request are the others.
+_local = threading.local()
+
+# Callables run after every statement of query_db and execute_db with the SQL text and its
+# duration in seconds, e.g. to count or time the statements of a request
+statement_listeners = []
+
+
+# Function to open a new connection with the tuned pragmas applied
+def connect(database=None):
+    conn = sqlite3.connect(database or DATABASE, timeout=5, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+# Function to get the connections and transaction depths of the current thread,
+# dropping the ones inherited from the parent after a fork
+def _state():
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.conns = {}
+        _local.depths = {}
+        _local.pid = os.getpid()
+    return _local
+
+
+# Function to get the persistent connection of the current thread to the given database
+def get_db(database=None):
+    state = _state()
+    conn = state.conns.get(database)
+    if conn is None:
+        conn = connect(database)
+        state.conns[database] = conn
+        state.depths[database] = 0
+    return conn
+
+
+# Function to close the connections of the current thread
+def close_db():
+    state = _state()
+    for conn in state.conns.values():
+        conn.close()
+    state.conns.clear()
+    state.depths.clear()
+
+
+# Context manager to run several statements in one write transaction.
+# Nested blocks join the outer transaction, which commits once at the end.
+@contextmanager
+def transaction(database=None):
+    conn = get_db(database)
+    depths = _local.depths
+    if depths[database]:
+        depths[database] += 1
+        try:
+            yield conn
+        finally:
+            depths[database] -= 1
+        return
+
+    conn.execute('BEGIN IMMEDIATE')
+    depths[database] = 1
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        depths[database] = 0
+
+
+# Context manager to run several reads against one snapshot of the database. In WAL mode the
+# snapshot is taken at the first read and writers are not blocked. Inside a transaction()
+# block the reads already share its snapshot.
+@contextmanager
+def snapshot(database=None):
+    conn = get_db(database)
+    depths = _local.depths
+    if depths[database]:
+        yield conn
+        return
+
+    conn.execute('BEGIN')
+    depths[database] = 1
+    try:
+        yield conn
+    finally:
+        depths[database] = 0
+        conn.rollback()
+
+
+# Context manager to run statements inside a savepoint of the current transaction, so that
+# a failure only undoes its own statements and leaves the rest of the transaction intact
+@contextmanager
+def savepoint(name='write', database=None):
+    conn = get_db(database)
+    conn.execute(f'SAVEPOINT {name}')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute(f'ROLLBACK TO {name}')
+        conn.execute(f'RELEASE {name}')
+        raise
+    else:
+        conn.execute(f'RELEASE {name}')
+
+
+# Function to pass a finished statement on to the statement listeners
+def _record(query, started):
+    if statement_listeners:
+        elapsed = time.perf_counter() - started
+        for listener in statement_listeners:
+            listener(query, elapsed)
+
+
+# Function to query the database and return the results as a dictionary object or a list of dictionary objects.
+# Reads never open a transaction; writes are committed straight away unless they run inside transaction().
+def query_db(query, args=(), one=False, database=None):
+    conn = get_db(database)
+    started = time.perf_counter()
+    try:
+        cur = conn.execute(query, args)
+        rv = cur.fetchall()
+    except Exception:
+        if conn.in_transaction and not _local.depths[database]:
+            conn.rollback()
+        raise
+    if conn.in_transaction and not _local.depths[database]:
+        conn.commit()
+    _record(query, started)
+    return (rv[0] if rv else None) if one else rv
+
+
+# Function to run a write statement and return the cursor, so callers can read lastrowid/rowcount
+def execute_db(query, args=(), database=None):
+    conn = get_db(database)
+    started = time.perf_counter()
+    try:
+        cur = conn.execute(query, args)
+    except Exception:
+        if conn.in_transaction and not _local.depths[database]:
+            conn.rollback()
+        raise
+    if conn.in_transaction and not _local.depths[database]:
+        conn.commit()
+    _record(query, started)
+    return cur
+
+
+# Function to update the given columns of one row in a single statement and return the new row.
+# Column names must come from a fixed whitelist in the caller, only the values are bound.
+def update_row(table, key_column, key, fields, database=None):
+    if not fields:
+        return query_db(f'SELECT * FROM {table} WHERE {key_column} = ?', [key], one=True, database=database)
+    assignments = ', '.join(f'{column} = ?' for column in fields)
+    return query_db(f'UPDATE {table} SET {assignments} WHERE {key_column} = ? RETURNING *',
+                    [*fields.values(), key], one=True, database=database)
+
+
+# Function to read the current version of a cached data set
+def get_version(name):
+    row = query_db('SELECT version FROM cache_version WHERE name = ?', [name], one=True)
+    return row['version'] if row else 0
+
+
+# Function to mark a cached data set as changed; call it in the same transaction as the write
+def bump_version(name):
+    execute_db('UPDATE cache_version SET version = version + 1 WHERE name = ?', [name])
@@ -0,0 +1,63 @@
+import queue
+import threading
+from collections import defaultdict
+
+# Events a subscriber may fall behind by before the oldest ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+# Fan-out used when there is only one web process: a published event is delivered straight
+# to the subscribers of this process. A cross-worker fan-out (Redis pub/sub, Postgres
+# LISTEN/NOTIFY, ...) implements the same two methods: attach(deliver) is called once with the
+# broker's delivery function, and publish(channel, event) must end up calling deliver(channel,
+# event) in every worker process, this one included.
+class LocalFanout:
+    def __init__(self):
+        self.deliver = None
+
+    def attach(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, channel, event):
+        self.deliver(channel, event)
+
+
+# In-process broker of change events. Endpoints publish to a channel per principal
+# ('user:<id>', 'shop:<id>') and every open event stream of that principal gets a copy.
+# Idle subscribers only wait on their queue, they never touch the database.
+class ChangeBroker:
+    def __init__(self, fanout=None):
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+        self.fanout = fanout or LocalFanout()
+        self.fanout.attach(self.deliver)
+
+    def subscribe(self, channel):
+        subscription = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel, subscription):
+        with self.lock:
+            self.subscribers[channel].discard(subscription)
+            if not self.subscribers[channel]:
+                del self.subscribers[channel]
+
+    def publish(self, channel, event):
+        self.fanout.publish(channel, event)
+
+    def deliver(self, channel, event):
+        with self.lock:
+            subscriptions = list(self.subscribers.get(channel, ()))
+        for subscription in subscriptions:
+            # A slow client loses its oldest events instead of blocking the publisher
+            while True:
+                try:
+                    subscription.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        subscription.get_nowait()
+                    except queue.Empty:
+                        pass
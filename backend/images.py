@@ -0,0 +1,62 @@
+import os
+import re
+import tempfile
+
+from PIL import Image, ImageOps
+
+# Longest side in pixels of each resized variant of a profile or shop image
+VARIANT_SIZES = {
+    'thumb': 160,
+    'medium': 640,
+}
+
+# Encodings every variant is stored in, keyed by the file extension they are saved with
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+VARIANT_QUALITY = 82
+
+# Blob file names are the SHA-256 of their content, so their URLs can be cached forever
+BLOB_NAME = re.compile(r'^[0-9a-f]{64}(\.[a-z0-9]+)?$')
+
+
+# Function to tell whether an upload path is a content-addressed blob
+def is_blob(path):
+    return bool(BLOB_NAME.match(os.path.basename(path)))
+
+
+# Function to get the path of one variant of an image, stored next to the original
+def variant_path(path, size, extension):
+    root, _ = os.path.splitext(path)
+    return f'{root}.{size}.{extension}'
+
+
+# Function to write every size and format variant of an image; runs inside a worker process.
+# Variants are written to a temporary file first, so a reader never sees a partial image.
+def make_variants(path):
+    created = []
+    with Image.open(path) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        for size, max_side in VARIANT_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+            for extension, (image_format, _) in VARIANT_FORMATS.items():
+                target = variant_path(path, size, extension)
+                if os.path.exists(target):
+                    continue
+                output = resized.convert('RGB') if image_format == 'JPEG' else resized
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.part')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        output.save(f, image_format, quality=VARIANT_QUALITY, optimize=True)
+                    os.chmod(temp_path, 0o644)
+                    os.replace(temp_path, target)
+                except BaseException:
+                    os.unlink(temp_path)
+                    raise
+                created.append(target)
+    return created
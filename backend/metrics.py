@@ -0,0 +1,139 @@
+import bisect
+import contextvars
+import math
+import threading
+import time
+
+# Upper bounds of the default latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metrics of the request being served. It is a context variable rather than a thread local,
+# so work the request hands to another thread in a copied context (see writer.py) is counted
+# for the request too.
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+# Function to escape a label value for the text format
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+# Function to format a sample value for the text format
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+# Function to format the labels of a sample, e.g. {endpoint="login",method="POST"}
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+# Histogram with cumulative buckets, like the Prometheus client libraries. observe() is one
+# binary search and three additions under a lock.
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self.lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self.series.items()}
+        names = self.labelnames + ('le',)
+        for labels, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(names, labels + (format_value(bound),))} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}'
+            yield f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}'
+
+
+# Gauge read when the metrics are scraped. function returns a number, or a dict from tuples
+# of label values to numbers.
+class CallbackGauge:
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}'
+
+
+# The metrics of one process, rendered together in the text format
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function, labelnames=()):
+        return self.add(CallbackGauge(name, documentation, function, labelnames))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+# What one request did: its SQL statements and their total time, and when it started. The
+# statements themselves are only kept when record_queries is set (the slow request log).
+class RequestMetrics:
+    __slots__ = ('started', 'statements', 'sql_seconds', 'queries')
+
+    def __init__(self, record_queries=False):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.queries = [] if record_queries else None
+
+    def add_statement(self, query, elapsed):
+        self.statements += 1
+        self.sql_seconds += elapsed
+        if self.queries is not None:
+            self.queries.append((' '.join(query.split()), round(elapsed * 1000, 3)))
+
+
+# Function to get the kind of a SQL statement for the statement metrics, e.g. 'SELECT'
+def statement_kind(query):
+    kind = query.lstrip()[:7].split(None, 1)
+    return kind[0].upper() if kind else 'OTHER'
@@ -1,9 +1,174 @@
-import sqlite3
+from db import connect
+from shards import shard_database, first_request_id
 
-def create_tables():
-    conn = sqlite3.connect('print_seva.db')
-    cursor = conn.cursor()
-    
+# Function to add a column to an existing table if an older database does not have it yet
+def ensure_column(cursor, table, column, definition):
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# Function to create user_request and the tables its triggers maintain. They live in the
+# main database, and in every shard database when requests are sharded by shop; a shard
+# numbers its requests itself from first_id on.
+def create_request_tables(cursor, first_id=None):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_request (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            total_pages INTEGER,
+            print_type TEXT,
+            print_side TEXT,
+            page_size TEXT,
+            no_of_copies INTEGER,
+            shop_id INTEGER,
+            file_path TEXT,
+            sender_email TEXT,
+            status TEXT DEFAULT 'Pending',
+            action TEXT DEFAULT 'Pending',
+            request_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            comments TEXT,
+            FOREIGN KEY (user_id) REFERENCES user(user_id),
+            FOREIGN KEY (shop_id) REFERENCES shopkeeper(shopkeeper_id)
+        )
+    ''')
+
+    # Original name of the uploaded file, the stored file is named after its hash
+    ensure_column(cursor, 'user_request', 'file_name', 'TEXT')
+
+    # Page count worked out on the server, copied from the blob of the request
+    ensure_column(cursor, 'user_request', 'verified_pages', 'INTEGER')
+    ensure_column(cursor, 'user_request', 'analysis_status', 'TEXT')
+
+    # Change sequence of user_request. Every insert, update and delete of a request takes the
+    # next number of the 'user_request' counter, and deleted requests leave a tombstone, so a
+    # client can fetch just what changed after the last sequence number it has seen.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_sequence (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS request_tombstone (
+            change_seq INTEGER PRIMARY KEY,
+            request_id INTEGER NOT NULL,
+            user_id INTEGER,
+            shop_id INTEGER,
+            deleted_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    ensure_column(cursor, 'user_request', 'change_seq', 'INTEGER')
+    # Requests of an older database are numbered in id order before the triggers exist
+    cursor.execute('UPDATE user_request SET change_seq = id WHERE change_seq IS NULL')
+    cursor.execute('''
+        INSERT OR IGNORE INTO change_sequence (name, value)
+        VALUES ('user_request', (SELECT COALESCE(MAX(change_seq), 0) FROM user_request))
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_request_change_insert AFTER INSERT ON user_request BEGIN
+            UPDATE change_sequence SET value = value + 1 WHERE name = 'user_request';
+            UPDATE user_request SET change_seq = (SELECT value FROM change_sequence WHERE name = 'user_request')
+            WHERE id = new.id;
+        END
+    ''')
+    # The WHEN clause skips the update made by the triggers themselves
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_request_change_update AFTER UPDATE ON user_request
+        WHEN new.change_seq IS old.change_seq BEGIN
+            UPDATE change_sequence SET value = value + 1 WHERE name = 'user_request';
+            UPDATE user_request SET change_seq = (SELECT value FROM change_sequence WHERE name = 'user_request')
+            WHERE id = new.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_request_change_delete AFTER DELETE ON user_request BEGIN
+            UPDATE change_sequence SET value = value + 1 WHERE name = 'user_request';
+            INSERT INTO request_tombstone (change_seq, request_id, user_id, shop_id)
+            VALUES ((SELECT value FROM change_sequence WHERE name = 'user_request'), old.id, old.user_id, old.shop_id);
+        END
+    ''')
+
+    if first_id is not None:
+        cursor.execute("INSERT OR IGNORE INTO change_sequence (name, value) VALUES ('request_id', ?)", [first_id])
+
+    # Daily rollup of every shop's requests. Each row counts the requests that reached a
+    # status and action on that day, with their pages (times copies) and copies, so a
+    # dashboard reads a few rows per day instead of scanning user_request. Deleting a request
+    # does not change the history.
+    stats_exist = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'request_daily_stats'").fetchone()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS request_daily_stats (
+            shop_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            status TEXT NOT NULL,
+            action TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            pages INTEGER NOT NULL DEFAULT 0,
+            copies INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (shop_id, day, status, action)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_request_stats_insert AFTER INSERT ON user_request
+        WHEN new.shop_id IS NOT NULL BEGIN
+            INSERT INTO request_daily_stats (shop_id, day, status, action, requests, pages, copies)
+            VALUES (new.shop_id, COALESCE(date(new.request_time), date('now', 'localtime')), COALESCE(new.status, 'Pending'), COALESCE(new.action, 'Pending'), 1,
+                    COALESCE(new.verified_pages, new.total_pages, 0) * COALESCE(new.no_of_copies, 1), COALESCE(new.no_of_copies, 1))
+            ON CONFLICT (shop_id, day, status, action) DO UPDATE SET
+                requests = requests + 1, pages = pages + excluded.pages, copies = copies + excluded.copies;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_request_stats_update AFTER UPDATE OF status, action ON user_request
+        WHEN new.shop_id IS NOT NULL AND (new.status IS NOT old.status OR new.action IS NOT old.action) BEGIN
+            INSERT INTO request_daily_stats (shop_id, day, status, action, requests, pages, copies)
+            VALUES (new.shop_id, COALESCE(date(new.update_time), date('now', 'localtime')), COALESCE(new.status, 'Pending'), COALESCE(new.action, 'Pending'), 1,
+                    COALESCE(new.verified_pages, new.total_pages, 0) * COALESCE(new.no_of_copies, 1), COALESCE(new.no_of_copies, 1))
+            ON CONFLICT (shop_id, day, status, action) DO UPDATE SET
+                requests = requests + 1, pages = pages + excluded.pages, copies = copies + excluded.copies;
+        END
+    ''')
+    # An older database gets its history from the requests it still has: every request was
+    # received on its request day and reached its current status on its last update day
+    if not stats_exist:
+        cursor.execute('''
+            INSERT INTO request_daily_stats (shop_id, day, status, action, requests, pages, copies)
+            SELECT shop_id, day, status, action, COUNT(*), SUM(pages), SUM(copies) FROM (
+                SELECT shop_id, date(request_time) AS day, 'Pending' AS status, 'Pending' AS action,
+                       COALESCE(verified_pages, total_pages, 0) * COALESCE(no_of_copies, 1) AS pages, COALESCE(no_of_copies, 1) AS copies
+                FROM user_request
+                UNION ALL
+                SELECT shop_id, date(update_time), status, action,
+                       COALESCE(verified_pages, total_pages, 0) * COALESCE(no_of_copies, 1), COALESCE(no_of_copies, 1)
+                FROM user_request WHERE status != 'Pending'
+            ) WHERE shop_id IS NOT NULL AND day IS NOT NULL
+            GROUP BY shop_id, day, status, action
+        ''')
+
+    # Adding indexes for optimization
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_request_status_update_time ON user_request(status, update_time)')
+
+    # Composite indexes matching the WHERE and ORDER BY of each paginated list endpoint,
+    # so a page is a single index range scan ordered by (request_time, id)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_request_user_time ON user_request(user_id, request_time, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_request_shop_status_time ON user_request(shop_id, status, request_time, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_request_shop_status_action_time ON user_request(shop_id, status, action, request_time, id)')
+
+    # Delta sync reads the changes of one user or shop in change_seq order
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_request_user_change ON user_request(user_id, change_seq)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_request_shop_change ON user_request(shop_id, change_seq)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_request_tombstone_user ON request_tombstone(user_id, change_seq)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_request_tombstone_shop ON request_tombstone(shop_id, change_seq)')
+
+    # The single column indexes are prefixes of the composite ones above
+    cursor.execute('DROP INDEX IF EXISTS idx_user_request_status')
+    cursor.execute('DROP INDEX IF EXISTS idx_user_request_user_id')
+    cursor.execute('DROP INDEX IF EXISTS idx_user_request_shop_id')
+
+
+# Function to create every table of the main database
+def create_main_tables(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS user (
             user_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -42,35 +207,146 @@ def create_tables():
         )
     ''')
     
+    # Content-addressed store of uploaded files. Every row of user_request, user or shopkeeper
+    # pointing at a blob holds one reference; blobs without references are garbage collected.
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_request (
+        CREATE TABLE IF NOT EXISTS blob (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Page count worked out on the server. It is kept per blob, so the same content is only
+    # analysed once, and copied to every request pointing at it.
+    ensure_column(cursor, 'blob', 'page_count', 'INTEGER')
+
+    # Version counters of cached data, bumped by every write that changes it so that
+    # each worker can tell whether its in-process copy is stale
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_version (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO cache_version (name, version) VALUES ('shops', 0)")
+
+    # Revoked JWTs shared by every worker. Rows are pruned once the token has expired anyway;
+    # the AUTOINCREMENT id lets each worker fetch only the revocations it has not seen yet.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS revoked_token (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            total_pages INTEGER,
-            print_type TEXT,
-            print_side TEXT,
-            page_size TEXT,
-            no_of_copies INTEGER,
-            shop_id INTEGER,
-            file_path TEXT,
-            sender_email TEXT,
-            status TEXT DEFAULT 'Pending',
-            action TEXT DEFAULT 'Pending',
-            request_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            comments TEXT,
-            FOREIGN KEY (user_id) REFERENCES user(user_id),
-            FOREIGN KEY (shop_id) REFERENCES shopkeeper(shopkeeper_id)
+            jti TEXT NOT NULL UNIQUE,
+            expires_at INTEGER NOT NULL
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_revoked_token_expires_at ON revoked_token(expires_at)')
+
+    # Full text index over the searchable shop columns. It reads its content from shopkeeper
+    # and the triggers below keep it in sync with every insert, update and delete.
+    search_exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'shop_search'").fetchone()
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS shop_search USING fts5(
+            shop_name, address, name,
+            content='shopkeeper', content_rowid='shopkeeper_id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS shopkeeper_search_insert AFTER INSERT ON shopkeeper BEGIN
+            INSERT INTO shop_search (rowid, shop_name, address, name)
+            VALUES (new.shopkeeper_id, new.shop_name, new.address, new.name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS shopkeeper_search_delete AFTER DELETE ON shopkeeper BEGIN
+            INSERT INTO shop_search (shop_search, rowid, shop_name, address, name)
+            VALUES ('delete', old.shopkeeper_id, old.shop_name, old.address, old.name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS shopkeeper_search_update AFTER UPDATE OF shop_name, address, name ON shopkeeper BEGIN
+            INSERT INTO shop_search (shop_search, rowid, shop_name, address, name)
+            VALUES ('delete', old.shopkeeper_id, old.shop_name, old.address, old.name);
+            INSERT INTO shop_search (rowid, shop_name, address, name)
+            VALUES (new.shopkeeper_id, new.shop_name, new.address, new.name);
+        END
+    ''')
+    if not search_exists:
+        cursor.execute("INSERT INTO shop_search (shop_search) VALUES ('rebuild')")
 
     # Adding indexes for optimization
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_request_user_id ON user_request(user_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_request_shop_id ON user_request(shop_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_request_status ON user_request(status)')
-    
-    conn.commit()
-    conn.close()
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_shopkeeper_shop_name ON shopkeeper(shop_name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_shopkeeper_cost_single_side ON shopkeeper(cost_single_side)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_shopkeeper_cost_both_sides ON shopkeeper(cost_both_sides)')
+
+    # Shops that were moved to another shard than the default one, see shards.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shop_shard (
+            shop_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO cache_version (name, version) VALUES ('shards', 0)")
+
+    # Requests stay in the main database too: all of them when there is a single shard, and
+    # ones from before sharding was turned on until they are moved to their shard
+    create_request_tables(cursor)
+
+
+# Schema changes of each kind of database, in order. PRAGMA user_version of a database is the
+# number of them it has had. The first one is the whole schema as it was before versioning
+# and also brings older unversioned databases up to date. Never change a migration that has
+# shipped; append a new function (new columns, tables, indexes) instead, so it runs once.
+MIGRATIONS = (
+    create_main_tables,
+)
+# Shard migrations are called with the first request id of the shard as well
+SHARD_MIGRATIONS = (
+    create_request_tables,
+)
+
+
+# Function to apply the migrations a database has not had yet, in one transaction. An up to
+# date database costs a single PRAGMA read; a worker that finds the database behind waits for
+# the write lock and checks again, so only one of several starting workers migrates.
+def migrate(database, migrations, *args):
+    conn = connect(database)
+    try:
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= len(migrations):
+            return False
+
+        # A new database gets incremental auto_vacuum, so the retention job can give free pages
+        # back without a full VACUUM. It only takes effect through a VACUUM, which is instant
+        # while the file is empty.
+        if not conn.execute('SELECT 1 FROM sqlite_master').fetchone():
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            cursor = conn.cursor()
+            for number in range(version, len(migrations)):
+                migrations[number](cursor, *args)
+            conn.execute(f'PRAGMA user_version = {len(migrations)}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return version < len(migrations)
+    finally:
+        conn.close()
+
+
+# Function to bring the main database, and every shard database when there is more than one
+# shard, up to the latest schema version
+def create_tables(shard_count=1):
+    migrate(None, MIGRATIONS)
+    for shard in range(shard_count if shard_count > 1 else 0):
+        migrate(shard_database(shard, shard_count), SHARD_MIGRATIONS, first_request_id(shard))
 
 if __name__ == '__main__':
     create_tables()
@@ -0,0 +1,136 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+# bcrypt only looks at the first 72 bytes of a password
+MAX_PASSWORD_BYTES = 72
+
+# The pool starts inside a threaded web process, and a plain fork would copy any lock another
+# thread holds at that moment into the worker. Workers come from a fork server, or are
+# spawned where the platform has none.
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+# Function to hash a password with the given cost factor; runs inside a worker process
+def hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8')[:MAX_PASSWORD_BYTES], bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+# Function to check a password against its hash; runs inside a worker process
+def check_password(pw_hash, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8')[:MAX_PASSWORD_BYTES], pw_hash.encode('utf-8'))
+    except ValueError:
+        return False
+
+
+# Function to read the cost factor a hash was made with, e.g. 12 for '$2b$12$...'
+def hash_rounds(pw_hash):
+    try:
+        return int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+# Raised when too many hashes are queued already; answer with 503 and Retry-After
+class PasswordPoolBusy(Exception):
+    pass
+
+
+# Dedicated pool of worker processes for bcrypt, so a burst of logins cannot pin the web
+# threads on CPU. At most max_workers + max_queue jobs are in flight; any more are refused
+# at once instead of queueing behind the others.
+class PasswordHasher:
+    def __init__(self, rounds=12, max_workers=2, max_queue=32, timeout=10):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.in_flight = 0
+        # Callables run after every hash and check the request waited for, with the operation
+        # ('hash' or 'check') and the seconds it took including the wait for a worker
+        self.listeners = []
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context(START_METHOD))
+                self.pid = os.getpid()
+                self.slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+                self.in_flight = 0
+            return self.executor
+
+    # Function to stop the worker processes of this process, cancelling the jobs still waiting
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None and self.pid == os.getpid():
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    # Function to queue a job in the pool and get its future, or raise PasswordPoolBusy
+    def submit(self, function, *args):
+        executor = self.get_executor()
+        slots = self.slots
+        if not slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+        try:
+            future = executor.submit(function, *args)
+        except BaseException:
+            slots.release()
+            raise
+        with self.lock:
+            self.in_flight += 1
+        future.add_done_callback(lambda _: self.done(slots))
+        return future
+
+    def done(self, slots):
+        slots.release()
+        with self.lock:
+            self.in_flight -= 1
+
+    def generate_password_hash(self, password):
+        return self.wait('hash', self.submit(hash_password, password, self.rounds))
+
+    def check_password_hash(self, pw_hash, password):
+        return self.wait('check', self.submit(check_password, pw_hash, password))
+
+    def wait(self, operation, future):
+        started = time.perf_counter()
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise PasswordPoolBusy()
+        finally:
+            for listener in self.listeners:
+                listener(operation, time.perf_counter() - started)
+
+    # Function to tell whether a hash was made with a different cost factor than the current one
+    def needs_rehash(self, pw_hash):
+        return hash_rounds(pw_hash) != self.rounds
+
+    # Function to hash a password again with the current cost factor in the background.
+    # callback(new_hash) is called from the result thread of the pool once it is done, which
+    # delivers every other result too, so it must hand any slow work (a database write) on.
+    # A full pool just skips it.
+    def rehash_async(self, password, callback):
+        try:
+            future = self.submit(hash_password, password, self.rounds)
+        except PasswordPoolBusy:
+            return False
+
+        def done(future):
+            try:
+                callback(future.result())
+            except Exception as e:
+                print(f"Error rehashing password: {e}")
+
+        future.add_done_callback(done)
+        return True
@@ -0,0 +1,82 @@
+import math
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from db import query_db
+
+# Prices of every shop as parallel arrays, rows in shopkeeper_id order. A shop without a
+# price for a print side has NaN there and is left out of quotes for that side.
+PriceArrays = namedtuple('PriceArrays', ['version', 'shop_ids', 'shop_names', 'single', 'both'])
+
+
+# Function to read a stored price as a float. Registration stores prices as they were typed, so
+# blank or non-numeric ones are TEXT in SQLite; they become NaN like missing prices.
+def parse_price(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return value if math.isfinite(value) else math.nan
+
+
+# Function to price jobs with the given per-page (single) or per-sheet (double sided) rates.
+# Every argument may be a scalar or an array; they are broadcast against each other, so one
+# job against every shop and many jobs against one shop are both a single vectorized pass.
+def price(pages, copies, double_sided, single, both):
+    pages = np.maximum(np.asarray(pages, dtype=np.float64), 1)
+    copies = np.maximum(np.asarray(copies, dtype=np.float64), 1)
+    sheets = np.ceil(pages / 2)
+    return np.where(double_sided, sheets * both, pages * single) * copies
+
+
+# In-process copy of the price table of every shop, reloaded when the 'shops' cache version
+# changes, i.e. whenever a shop is registered or update_shopkeeper changes its prices.
+class PriceTable:
+    def __init__(self):
+        self.arrays = None
+        self.lock = threading.Lock()
+
+    # Function to get the price arrays of the given version, loading them if needed
+    def get(self, version):
+        arrays = self.arrays
+        if arrays is not None and arrays.version == version:
+            return arrays
+        with self.lock:
+            if self.arrays is None or self.arrays.version != version:
+                self.arrays = self.load(version)
+            return self.arrays
+
+    def load(self, version):
+        rows = query_db('SELECT shopkeeper_id, shop_name, cost_single_side, cost_both_sides FROM shopkeeper ORDER BY shopkeeper_id')
+        return PriceArrays(
+            version,
+            np.array([row['shopkeeper_id'] for row in rows], dtype=np.int64),
+            [row['shop_name'] for row in rows],
+            np.array([parse_price(row['cost_single_side']) for row in rows], dtype=np.float64),
+            np.array([parse_price(row['cost_both_sides']) for row in rows], dtype=np.float64),
+        )
+
+    # Function to price one job at every shop of the given version. Returns up to limit
+    # (shopkeeper_id, shop_name, price) tuples, cheapest first; only the cheapest limit shops
+    # are sorted.
+    def rank_shops(self, version, pages, copies, double_sided, limit):
+        arrays = self.get(version)
+        prices = price(pages, copies, double_sided, arrays.single, arrays.both)
+        candidates = np.flatnonzero(~np.isnan(prices))
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(prices[candidates], limit - 1)[:limit]]
+        order = candidates[np.lexsort((arrays.shop_ids[candidates], prices[candidates]))]
+        return [(int(arrays.shop_ids[i]), arrays.shop_names[i], float(prices[i])) for i in order]
+
+    # Function to price many jobs at one shop. pages, copies and double_sided are sequences with
+    # one entry per job. Returns a list of prices, None for jobs the shop has no price for, or
+    # None if the shop does not exist.
+    def price_jobs(self, version, shop_id, pages, copies, double_sided):
+        arrays = self.get(version)
+        index = np.searchsorted(arrays.shop_ids, shop_id)
+        if index == len(arrays.shop_ids) or arrays.shop_ids[index] != shop_id:
+            return None
+        prices = price(pages, copies, double_sided, arrays.single[index], arrays.both[index])
+        return np.where(np.isnan(prices), None, prices).tolist()
@@ -0,0 +1,286 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import datetime
+
+from db import DATABASE, connect, get_db, query_db, execute_db, transaction
+from blobstore import release_blob
+from images import VARIANT_SIZES, VARIANT_FORMATS, variant_path
+
+# Database file finished requests are moved to once they are past the retention period
+ARCHIVE_DATABASE = 'print_seva_archive.db'
+
+# Requests that will not change any more: printed, or declined by the shop
+FINISHED_REQUESTS = "(status = 'Printed' OR (status = 'Responded' AND action = 'Declined'))"
+
+# Name of the change_sequence row holding the highest change_seq whose tombstone was pruned
+TOMBSTONE_FLOOR = 'request_tombstone_floor'
+
+# Blobs, their variants and resized images all start with the SHA-256 of the content
+BLOB_PREFIX = re.compile(r'^([0-9a-f]{64})(\.|$)')
+
+# Value of PRAGMA auto_vacuum for incremental mode
+INCREMENTAL_AUTO_VACUUM = 2
+
+
+# Background compaction of the database and the upload folder:
+# - finished requests older than retention_days move to the archive database, batch_size rows
+#   per transaction and at most max_batches per run, and drop their blob references;
+# - tombstones older than tombstone_days are pruned (clients syncing from before them get 410);
+# - blobs without references are deleted together with their files and image variants;
+# - upload files no row refers to (leftovers of failed uploads) are removed after grace_seconds;
+# - free pages are returned to the file system with incremental VACUUM.
+# Every step is idempotent, so several workers running it at once is harmless. Requests are
+# archived and tombstones pruned in each of the given databases (the shards of shards.py).
+class RetentionJob:
+    def __init__(self, upload_folder, retention_days=90, tombstone_days=30, batch_size=500, max_batches=20,
+                 grace_seconds=3600, vacuum_pages=2000, archive_database=ARCHIVE_DATABASE, databases=(None,)):
+        self.upload_folder = upload_folder
+        self.retention_days = retention_days
+        self.tombstone_days = tombstone_days
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.grace_seconds = grace_seconds
+        self.vacuum_pages = vacuum_pages
+        self.archive_database = archive_database
+        self.databases = list(databases)
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    # Function to run every step once and report how much each one did
+    def run(self):
+        return {
+            'archived': self.archive_requests(),
+            'tombstones': self.prune_tombstones(),
+            'blobs': self.collect_blobs(),
+            'files': self.remove_stray_files(),
+            'vacuumed': self.vacuum(),
+        }
+
+    # Function to run the job every interval seconds in a daemon thread of this process.
+    # Safe to call on every request; a forked worker starts its own thread.
+    def ensure_running(self, interval):
+        if not interval or self.stopped.is_set() or (self.thread is not None and self.pid == os.getpid()):
+            return
+        with self.lock:
+            if (self.thread is None or self.pid != os.getpid()) and not self.stopped.is_set():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.loop, args=(interval,), name='retention', daemon=True)
+                self.thread.start()
+
+    # Function to stop the job after its current run, for good
+    def shutdown(self):
+        self.stopped.set()
+
+    def loop(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.run()
+            except Exception as e:
+                print(f"Error running retention job: {e}")
+
+    # Function to attach the archive database to this thread's connection to a database and
+    # give its user_request table every column the live one has. Returns the column names.
+    def attach_archive(self, database=None):
+        conn = get_db(database)
+        if not any(row['name'] == 'archive' for row in conn.execute('PRAGMA database_list')):
+            conn.execute('ATTACH DATABASE ? AS archive', [self.archive_database])
+        columns = [(row['name'], row['type']) for row in conn.execute('PRAGMA main.table_info(user_request)')]
+        conn.execute('CREATE TABLE IF NOT EXISTS archive.user_request (id INTEGER PRIMARY KEY, archived_time TIMESTAMP)')
+        existing = {row['name'] for row in conn.execute('PRAGMA archive.table_info(user_request)')}
+        for name, definition in columns:
+            if name not in existing:
+                conn.execute(f'ALTER TABLE archive.user_request ADD COLUMN {name} {definition}')
+        return [name for name, _ in columns]
+
+    def archive_requests(self):
+        return sum(self.archive_shard(database) for database in self.databases)
+
+    # Function to archive the finished requests of one database. The blob references are
+    # dropped in the main database, whose transaction is taken first and committed last: if
+    # the shard commits and the main database does not, a blob is merely kept too long.
+    def archive_shard(self, database):
+        columns = ', '.join(self.attach_archive(database))
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=self.retention_days)
+        archived = 0
+        for _ in range(self.max_batches):
+            with transaction(), transaction(database):
+                rows = query_db(f'''
+                    SELECT id, file_path FROM main.user_request
+                    WHERE {FINISHED_REQUESTS} AND update_time < ?
+                    ORDER BY update_time LIMIT ?
+                ''', [cutoff, self.batch_size], database=database)
+                if not rows:
+                    break
+                ids = json.dumps([row['id'] for row in rows])
+                # INSERT OR REPLACE, so a batch copied before a crash is simply copied again
+                execute_db(f'''
+                    INSERT OR REPLACE INTO archive.user_request ({columns}, archived_time)
+                    SELECT {columns}, ? FROM main.user_request WHERE id IN (SELECT value FROM json_each(?))
+                ''', [datetime.datetime.now(), ids], database=database)
+                execute_db('DELETE FROM main.user_request WHERE id IN (SELECT value FROM json_each(?))', [ids], database=database)
+                for row in rows:
+                    release_blob(row['file_path'])
+            archived += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        return archived
+
+    def prune_tombstones(self):
+        return sum(self.prune_shard_tombstones(database) for database in self.databases)
+
+    def prune_shard_tombstones(self, database):
+        pruned = 0
+        for _ in range(self.max_batches):
+            with transaction(database):
+                floor = query_db('''
+                    SELECT MAX(change_seq) AS floor, COUNT(*) AS count FROM (
+                        SELECT change_seq FROM request_tombstone
+                        WHERE deleted_time < datetime('now', ?)
+                        ORDER BY change_seq LIMIT ?
+                    )
+                ''', [f'-{self.tombstone_days} days', self.batch_size], one=True, database=database)
+                if not floor['count']:
+                    break
+                execute_db('DELETE FROM request_tombstone WHERE change_seq <= ?', [floor['floor']], database=database)
+                execute_db('''
+                    INSERT INTO change_sequence (name, value) VALUES (?, ?)
+                    ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)
+                ''', [TOMBSTONE_FLOOR, floor['floor']], database=database)
+            pruned += floor['count']
+            if floor['count'] < self.batch_size:
+                break
+        return pruned
+
+    # Function to delete blobs nobody refers to any more. The files are removed inside the
+    # write transaction, so store_blob (which takes the same lock) can never reuse a row
+    # whose file is being deleted; a failed commit leaves a row without a file, which
+    # store_blob writes again on the next upload of that content.
+    def collect_blobs(self):
+        collected = 0
+        for _ in range(self.max_batches):
+            with transaction():
+                rows = query_db('''
+                    DELETE FROM blob WHERE sha256 IN (
+                        SELECT sha256 FROM blob WHERE ref_count = 0 LIMIT ?
+                    ) RETURNING path
+                ''', [self.batch_size])
+                for row in rows:
+                    self.remove_file(row['path'])
+                    for size in VARIANT_SIZES:
+                        for extension in VARIANT_FORMATS:
+                            self.remove_file(variant_path(row['path'], size, extension))
+            collected += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        return collected
+
+    # Function to remove files under the upload folder that no row refers to and that are older
+    # than the grace period: temporary files of interrupted uploads, blobs whose transaction was
+    # rolled back, and files of older requests that have been archived. Blobs are checked again
+    # under the write lock before they go, see remove_stray_blob.
+    def remove_stray_files(self):
+        cutoff = time.time() - self.grace_seconds
+        removed = 0
+        for directory, _, filenames in os.walk(self.upload_folder):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    if os.path.getmtime(path) >= cutoff:
+                        continue
+                except OSError:
+                    continue
+                match = BLOB_PREFIX.match(filename)
+                if filename.endswith('.part'):
+                    stray = True
+                elif match:
+                    if query_db('SELECT 1 FROM blob WHERE sha256 = ?', [match.group(1)], one=True) is None:
+                        removed += self.remove_stray_blob(match.group(1), path)
+                    continue
+                else:
+                    stray = query_db('''
+                        SELECT 1 FROM user WHERE profile_image = ?
+                        UNION ALL SELECT 1 FROM shopkeeper WHERE shop_image = ?
+                        LIMIT 1
+                    ''', [path, path], one=True) is None and not any(
+                        query_db('SELECT 1 FROM user_request WHERE file_path = ? LIMIT 1', [path], one=True, database=database)
+                        for database in self.databases)
+                if stray:
+                    self.remove_file(path)
+                    removed += 1
+        return removed
+
+    # Function to remove the file of a blob if no row refers to it, in a write transaction.
+    # store_blob inserts the row and puts the file in place (or reuses the one there) under the
+    # same write lock, so an upload in flight either commits its row first or runs after the
+    # file is gone and writes it again.
+    def remove_stray_blob(self, sha256, path):
+        with transaction():
+            if query_db('SELECT 1 FROM blob WHERE sha256 = ?', [sha256], one=True) is not None:
+                return False
+            self.remove_file(path)
+        return True
+
+    def remove_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # Function to give free pages back to the file system in the main database and every
+    # shard. A database created before auto_vacuum was enabled is skipped: switching it on
+    # takes a full VACUUM, which holds the write lock for as long as it rewrites the file, so
+    # that is left to enable_incremental_vacuum() (python retention.py --enable-incremental-vacuum).
+    def vacuum(self):
+        vacuumed = [self.vacuum_database(database) for database in dict.fromkeys([None, *self.databases])]
+        return any(vacuumed)
+
+    def vacuum_database(self, database):
+        conn = get_db(database)
+        # freelist_count reads the file header first, so auto_vacuum is not a stale cached value
+        if not conn.execute('PRAGMA main.freelist_count').fetchone()[0]:
+            return False
+        if conn.execute('PRAGMA main.auto_vacuum').fetchone()[0] != INCREMENTAL_AUTO_VACUUM:
+            return False
+        # execute() would step the pragma once and free a single page; executescript() runs it
+        # to the end. The connection is never inside a transaction here.
+        conn.executescript(f'PRAGMA main.incremental_vacuum({int(self.vacuum_pages)});')
+        return True
+
+
+# Function to switch a database created before auto_vacuum was enabled to incremental mode,
+# with the full VACUUM that takes. It rewrites the whole file under the write lock, so run it
+# once while the app is stopped. Returns False if the database was already incremental.
+def enable_incremental_vacuum(database=None):
+    conn = connect(database)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == INCREMENTAL_AUTO_VACUUM:
+            return False
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return True
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    from shards import shard_database
+
+    parser = argparse.ArgumentParser(description='Run the retention job once')
+    parser.add_argument('--shards', type=int, default=1, help='SHARD_COUNT of the app')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='switch older databases to incremental auto_vacuum with a full VACUUM, while the app is stopped')
+    args = parser.parse_args()
+
+    databases = [shard_database(shard, args.shards) for shard in range(args.shards)]
+    if args.enable_incremental_vacuum:
+        for database in dict.fromkeys([None, *databases]):
+            changed = enable_incremental_vacuum(database)
+            print(f"{database or DATABASE}: {'switched to incremental auto_vacuum' if changed else 'already incremental'}")
+    else:
+        print(RetentionJob('uploads', databases=databases).run())
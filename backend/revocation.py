@@ -0,0 +1,153 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db import query_db, execute_db
+
+# How long a token without an exp claim is remembered as revoked
+DEFAULT_TTL = 30 * 24 * 3600
+
+
+# Fixed size bloom filter over strings. A miss means the string was never added;
+# a hit only means it probably was. Positions come from the built-in str hash, which is
+# cached on the string and only stable within one process; that is all a per-worker
+# filter rebuilt from the database needs.
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def add(self, item):
+        h = hash(item)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % self.size
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        h = hash(item)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        bits, size = self.bits, self.size
+        # Stops at the first clear bit, which for a sparse filter is usually the first one
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+# Revoked token ids shared by every worker through the revoked_token table. Each worker keeps
+# a bloom filter of all revoked ids in front of it, so the check for a token that was never
+# revoked (nearly every request) does not touch the database. Filter hits are confirmed with
+# the table and remembered in a small LRU. A background thread of every worker picks up the
+# revocations of other workers every sync_interval seconds, and every prune_interval seconds
+# deletes expired rows and rebuilds the filter, so request threads never wait for either.
+class RevocationStore:
+    def __init__(self, capacity=100000, lru_size=4096, sync_interval=1.0, prune_interval=600.0):
+        self.capacity = capacity
+        self.lru_size = lru_size
+        self.sync_interval = sync_interval
+        self.prune_interval = prune_interval
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.lru = OrderedDict()
+        self.last_id = 0
+        self.last_prune = 0.0
+        self.thread = None
+        self.pid = None
+
+    # Function to start the sync thread of this process. Safe to call on every request; a
+    # forked worker starts its own thread.
+    def ensure_running(self):
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.loop, name='revocation-sync', daemon=True)
+                self.thread.start()
+
+    def loop(self):
+        while True:
+            now = time.monotonic()
+            try:
+                if self.bloom is None or now - self.last_prune >= self.prune_interval:
+                    self.prune(now)
+                else:
+                    self.sync()
+            except Exception as e:
+                print(f"Error syncing revoked tokens: {e}")
+            time.sleep(self.sync_interval)
+
+    # Function to build a new bloom filter from every row that has not expired yet and swap it
+    # in. Only the revocations made while it was being built are added under the lock.
+    def rebuild(self):
+        rows = query_db('SELECT id, jti FROM revoked_token WHERE expires_at >= ?', [int(time.time())])
+        bloom = BloomFilter(max(self.capacity, 2 * len(rows)))
+        for row in rows:
+            bloom.add(row['jti'])
+        last_id = max([row['id'] for row in rows] + [self.last_id])
+        with self.lock:
+            for row in query_db('SELECT id, jti FROM revoked_token WHERE id > ? ORDER BY id', [last_id]):
+                bloom.add(row['jti'])
+                last_id = row['id']
+            self.bloom = bloom
+            self.lru.clear()
+            self.last_id = last_id
+
+    # Function to add the revocations other workers made since the last sync
+    def sync(self):
+        rows = query_db('SELECT id, jti FROM revoked_token WHERE id > ? ORDER BY id', [self.last_id])
+        if not rows:
+            return
+        with self.lock:
+            for row in rows:
+                self.bloom.add(row['jti'])
+                self.lru.pop(row['jti'], None)
+                self.last_id = row['id']
+            full = self.bloom.count > self.bloom.capacity
+        if full:
+            self.rebuild()
+
+    # Function to delete revocations of tokens that have expired anyway.
+    # now is time.monotonic(), it only paces the prune interval.
+    def prune(self, now):
+        execute_db('DELETE FROM revoked_token WHERE expires_at < ?', [int(time.time())])
+        self.last_prune = now
+        self.rebuild()
+
+    def revoke(self, jti, expires_at=None):
+        expires_at = int(expires_at or time.time() + DEFAULT_TTL)
+        execute_db('INSERT OR IGNORE INTO revoked_token (jti, expires_at) VALUES (?, ?)', [jti, expires_at])
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(jti)
+            self.remember(jti, True)
+
+    def is_revoked(self, jti):
+        # The common case, a token that was never revoked, is answered by the filter without
+        # locking. Until the sync thread has built the filter, every token is looked up.
+        self.ensure_running()
+        bloom = self.bloom
+        if bloom is not None and jti not in bloom:
+            return False
+
+        with self.lock:
+            if jti in self.lru:
+                self.lru.move_to_end(jti)
+                return self.lru[jti]
+            revoked = query_db('SELECT 1 FROM revoked_token WHERE jti = ?', [jti], one=True) is not None
+            self.remember(jti, revoked)
+            return revoked
+
+    def remember(self, jti, revoked):
+        self.lru[jti] = revoked
+        self.lru.move_to_end(jti)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
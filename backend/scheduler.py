@@ -0,0 +1,114 @@
+import heapq
+from collections import namedtuple
+
+# An accepted print job as the scheduler sees it. waited is how many seconds it has been
+# waiting since it was accepted.
+Job = namedtuple('Job', ['id', 'user_id', 'pages', 'copies', 'print_side', 'print_type', 'page_size', 'waited'])
+
+# A job in scheduled order: when it starts and ends, in seconds from now
+ScheduledJob = namedtuple('ScheduledJob', ['job', 'estimate', 'start', 'end'])
+
+# Values of print_type and print_side the app and its frontend send
+PRINT_TYPES = ('black&white', 'color')
+PRINT_SIDES = ('single', 'double')
+
+# Printer speed in pages per minute for each print type, and for anything else
+PAGES_PER_MINUTE = {
+    'black&white': 40,
+    'color': 20,
+}
+DEFAULT_PAGES_PER_MINUTE = 30
+
+# A double sided page takes this much longer than a single sided one
+DUPLEX_FACTOR = 1.6
+
+# Seconds of handling per job (loading the file, collecting and handing over the prints)
+JOB_OVERHEAD = 30
+
+# Seconds lost when the printer has to be reconfigured for another page size or print type
+SETUP_SECONDS = 60
+
+# Weights of each ordering policy. A job's score is
+#   estimate * shortest + setup_seconds * batching + user's print time so far * fairness
+#   - seconds waited * aging
+# and the job with the lowest score goes next. aging lets long jobs that have waited a long
+# time overtake short new ones; fifo only looks at the waiting time.
+POLICIES = {
+    'fifo': {'shortest': 0, 'batching': 0, 'fairness': 0, 'aging': 1},
+    'sjf': {'shortest': 1, 'batching': 0, 'fairness': 0, 'aging': 0.1},
+    'balanced': {'shortest': 1, 'batching': 1, 'fairness': 0.5, 'aging': 0.1},
+}
+
+
+# Function to estimate how many seconds a job takes to print, without reconfiguring the printer
+def estimate_seconds(job):
+    pages_per_minute = PAGES_PER_MINUTE.get(job.print_type, DEFAULT_PAGES_PER_MINUTE)
+    seconds = max(job.pages or 1, 1) * max(job.copies or 1, 1) * 60 / pages_per_minute
+    if job.print_side == 'double':
+        seconds *= DUPLEX_FACTOR
+    return seconds + JOB_OVERHEAD
+
+
+# Function to order the jobs of one shop by the given policy and work out when each one runs.
+# Jobs are bucketed by printer setup and user. Within a bucket the order never changes, and
+# a bucket's priority only changes when its own user is served, so each setup keeps a heap of
+# its buckets (stale entries are skipped when they surface) and every step compares the best
+# bucket of each setup instead of every waiting job.
+def schedule(jobs, policy='balanced'):
+    weights = POLICIES[policy]
+    buckets = {}
+    for job in jobs:
+        estimate = estimate_seconds(job)
+        score = estimate * weights['shortest'] - job.waited * weights['aging']
+        key = ((job.page_size, job.print_type), job.user_id)
+        buckets.setdefault(key, []).append((score, job.id, estimate, job))
+
+    served = {}
+    user_buckets = {}
+    setup_heaps = {}
+
+    def priority(key):
+        return buckets[key][0][0] + served.get(key[1], 0) * weights['fairness']
+
+    def push(key):
+        heapq.heappush(setup_heaps[key[0]], (priority(key), buckets[key][0][1], key))
+
+    for key, bucket in buckets.items():
+        heapq.heapify(bucket)
+        user_buckets.setdefault(key[1], []).append(key)
+        setup_heaps.setdefault(key[0], [])
+        push(key)
+
+    setup = None
+    clock = 0.0
+    scheduled = []
+    while buckets:
+        best = None
+        for bucket_setup, heap in setup_heaps.items():
+            # Drop entries of buckets that are empty or whose priority changed since
+            while heap and (heap[0][2] not in buckets or heap[0][:2] != (priority(heap[0][2]), buckets[heap[0][2]][0][1])):
+                heapq.heappop(heap)
+            if not heap:
+                continue
+            cost = heap[0][0]
+            if setup is not None and bucket_setup != setup:
+                cost += SETUP_SECONDS * weights['batching']
+            if best is None or (cost, heap[0][1]) < best[:2]:
+                best = (cost, heap[0][1], heap[0][2])
+
+        key = best[2]
+        _, _, estimate, job = heapq.heappop(buckets[key])
+        if not buckets[key]:
+            del buckets[key]
+
+        if setup is not None and key[0] != setup:
+            clock += SETUP_SECONDS
+        setup = key[0]
+        scheduled.append(ScheduledJob(job, estimate, clock, clock + estimate))
+        clock += estimate
+
+        served[job.user_id] = served.get(job.user_id, 0) + estimate
+        for user_key in user_buckets[job.user_id]:
+            if user_key in buckets:
+                push(user_key)
+    return scheduled
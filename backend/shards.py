@@ -0,0 +1,229 @@
+import argparse
+import glob
+import json
+import threading
+import time
+
+from db import DATABASE, connect, query_db, get_version
+
+# Files holding user_request and its change, tombstone and stats tables when requests are
+# sharded by shop. user, shopkeeper, user_roles and the other tables stay in DATABASE.
+SHARD_DATABASE = 'print_seva.shard{}.db'
+
+# Shard k numbers its requests from (k + 1) << ID_BITS, so ids stay unique across shards and
+# a request can be looked up on the shard that created it first. Ids below 1 << ID_BITS were
+# handed out by the single database. JavaScript clients read ids exactly up to 2 ** 53.
+ID_BITS = 40
+
+# Seconds a move waits after switching the placement of a shop before it copies its rows,
+# longer than a write may take, so writes routed with the old placement have landed
+MOVE_SETTLE_SECONDS = 15
+
+
+# Function to get the database file of a shard, None (the main database) with a single shard
+def shard_database(shard, count):
+    return None if count == 1 else SHARD_DATABASE.format(shard)
+
+
+# Function to get the value the request id counter of a shard starts from
+def first_request_id(shard):
+    return (shard + 1) << ID_BITS
+
+
+# Placement of every shop on one of count shard databases. A shop lives on shard
+# shop_id % count unless the shop_shard table of the main database moved it elsewhere; those
+# overrides are cached per process and reloaded when the 'shards' version changes.
+class ShardMap:
+    def __init__(self, count):
+        self.count = count
+        self.overrides = (None, {})
+        self.lock = threading.Lock()
+
+    # Function to get the database of every shard
+    def databases(self):
+        return [shard_database(shard, self.count) for shard in range(self.count)]
+
+    def get_overrides(self):
+        version = get_version('shards')
+        overrides = self.overrides
+        if overrides[0] != version:
+            with self.lock:
+                if self.overrides[0] != version:
+                    rows = query_db('SELECT shop_id, shard FROM shop_shard')
+                    self.overrides = (version, {row['shop_id']: row['shard'] for row in rows if row['shard'] < self.count})
+                overrides = self.overrides
+        return overrides[1]
+
+    def shard_of(self, shop_id):
+        if self.count == 1:
+            return 0
+        shop_id = int(shop_id)
+        return self.get_overrides().get(shop_id, shop_id % self.count)
+
+    # Function to get the database holding the requests of a shop
+    def database(self, shop_id):
+        return shard_database(self.shard_of(shop_id), self.count)
+
+    # Function to get the databases to look a request up in by its id: the shard that
+    # created it first, since requests only leave it when their shop is moved
+    def databases_for_id(self, request_id):
+        databases = self.databases()
+        try:
+            home = (int(request_id) >> ID_BITS) - 1
+        except (TypeError, ValueError):
+            return databases
+        if 0 <= home < self.count:
+            databases.insert(0, databases.pop(home))
+        return databases
+
+
+# Function to take the next request id of a shard database, inside the transaction of the
+# insert. The main database has no counter and lets AUTOINCREMENT pick the id (None).
+def next_request_id(database):
+    if database is None:
+        return None
+    return query_db("UPDATE change_sequence SET value = value + 1 WHERE name = 'request_id' RETURNING value",
+                    one=True, database=database)['value']
+
+
+# Function to move every request of a shop, its tombstones and its daily stats from one
+# database to another, batch_size requests per transaction. The target is attached to a
+# connection of the source, so both are written in the same transaction; in WAL mode a crash
+# can still commit one file and not the other, and running the move again finishes the job.
+def move_shop(shop_id, source, target, batch_size=1000):
+    conn = connect(source)
+    conn.execute('ATTACH DATABASE ? AS target', [target or DATABASE])
+    columns = ', '.join(row['name'] for row in conn.execute('PRAGMA main.table_info(user_request)'))
+    moved = 0
+    try:
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                ids = [row['id'] for row in conn.execute(
+                    'SELECT id FROM main.user_request WHERE shop_id = ? LIMIT ?', [shop_id, batch_size])]
+                if ids:
+                    move_requests(conn, columns, json.dumps(ids))
+                else:
+                    move_stats(conn, shop_id)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            moved += len(ids)
+            if not ids:
+                return moved
+    finally:
+        conn.close()
+
+
+def move_requests(conn, columns, ids):
+    # INSERT OR REPLACE, so rows copied before a crash are simply copied again. The insert
+    # trigger of the target gives every row a new change_seq there, so clients syncing a delta
+    # see the request as changed.
+    conn.execute(f'''
+        INSERT OR REPLACE INTO target.user_request ({columns})
+        SELECT {columns} FROM main.user_request WHERE id IN (SELECT value FROM json_each(?))
+    ''', [ids])
+    # The insert trigger also counted the rows as received today; the shop's history is
+    # moved as a whole by move_stats instead
+    conn.execute('''
+        UPDATE target.request_daily_stats AS stats
+        SET requests = stats.requests - copied.requests, pages = stats.pages - copied.pages, copies = stats.copies - copied.copies
+        FROM (
+            SELECT shop_id, COALESCE(date(request_time), date('now', 'localtime')) AS day,
+                   COALESCE(status, 'Pending') AS status, COALESCE(action, 'Pending') AS action, COUNT(*) AS requests,
+                   SUM(COALESCE(verified_pages, total_pages, 0) * COALESCE(no_of_copies, 1)) AS pages, SUM(COALESCE(no_of_copies, 1)) AS copies
+            FROM target.user_request WHERE id IN (SELECT value FROM json_each(?))
+            GROUP BY 1, 2, 3, 4
+        ) AS copied
+        WHERE stats.shop_id = copied.shop_id AND stats.day = copied.day AND stats.status = copied.status AND stats.action = copied.action
+    ''', [ids])
+    conn.execute('DELETE FROM target.request_daily_stats WHERE requests = 0 AND pages = 0 AND copies = 0')
+    # The rows did not go away, so the deletes from the source leave no tombstones behind
+    seq = conn.execute("SELECT value FROM main.change_sequence WHERE name = 'user_request'").fetchone()['value']
+    conn.execute('DELETE FROM main.user_request WHERE id IN (SELECT value FROM json_each(?))', [ids])
+    conn.execute('DELETE FROM main.request_tombstone WHERE change_seq > ?', [seq])
+
+
+def move_stats(conn, shop_id):
+    conn.execute('''
+        INSERT INTO target.request_daily_stats (shop_id, day, status, action, requests, pages, copies)
+        SELECT shop_id, day, status, action, requests, pages, copies FROM main.request_daily_stats WHERE shop_id = ?
+        ON CONFLICT (shop_id, day, status, action) DO UPDATE SET
+            requests = requests + excluded.requests, pages = pages + excluded.pages, copies = copies + excluded.copies
+    ''', [shop_id])
+    conn.execute('DELETE FROM main.request_daily_stats WHERE shop_id = ?', [shop_id])
+
+
+# Function to get every database that may hold requests: the main one, and the shard files
+# of the current and of any earlier shard count
+def request_databases():
+    return [None] + sorted(glob.glob(SHARD_DATABASE.format('*')))
+
+
+# Function to get the shops that have requests or stats in a database
+def shops_in(database):
+    conn = connect(database)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_request'").fetchone():
+            return []
+        return [row[0] for row in conn.execute('''
+            SELECT shop_id FROM user_request WHERE shop_id IS NOT NULL
+            UNION SELECT shop_id FROM request_daily_stats
+        ''')]
+    finally:
+        conn.close()
+
+
+# Function to move a shop to the given shard: its placement is switched first, so new
+# requests go to the new shard, and its rows follow once in-flight writes have landed
+def move(shop_id, shard, count, settle=MOVE_SETTLE_SECONDS):
+    conn = connect()
+    with conn:
+        if shard == shop_id % count:
+            conn.execute('DELETE FROM shop_shard WHERE shop_id = ?', [shop_id])
+        else:
+            conn.execute('''
+                INSERT INTO shop_shard (shop_id, shard) VALUES (?, ?)
+                ON CONFLICT (shop_id) DO UPDATE SET shard = excluded.shard
+            ''', [shop_id, shard])
+        conn.execute("UPDATE cache_version SET version = version + 1 WHERE name = 'shards'")
+    conn.close()
+    time.sleep(settle)
+
+    target = shard_database(shard, count)
+    return sum(move_shop(shop_id, source, target) for source in request_databases() if source != target)
+
+
+# Function to move every request that is not on the shard its shop is placed on, e.g. after
+# SHARD_COUNT was changed, or to take the requests of the single database over to the shards
+def rebalance(count):
+    shard_map = ShardMap(count)
+    moved = 0
+    for source in request_databases():
+        for shop_id in shops_in(source):
+            target = shard_map.database(shop_id)
+            if target != source:
+                moved += move_shop(shop_id, source, target)
+    return moved
+
+
+if __name__ == '__main__':
+    from models import create_tables
+
+    parser = argparse.ArgumentParser(description='Move requests between shard databases')
+    parser.add_argument('--shards', type=int, required=True, help='SHARD_COUNT of the app')
+    commands = parser.add_subparsers(dest='command', required=True)
+    move_command = commands.add_parser('move', help='move one shop to another shard')
+    move_command.add_argument('shop_id', type=int)
+    move_command.add_argument('shard', type=int)
+    commands.add_parser('rebalance', help='move every request to the shard of its shop')
+    args = parser.parse_args()
+
+    create_tables(args.shards)
+    if args.command == 'move':
+        if not 0 <= args.shard < args.shards:
+            parser.error(f'shard must be between 0 and {args.shards - 1}')
+        print(f'Moved {move(args.shop_id, args.shard, args.shards)} requests')
+    else:
+        print(f'Moved {rebalance(args.shards)} requests')
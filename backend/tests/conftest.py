@@ -0,0 +1,80 @@
+import itertools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+import db
+from models import create_tables
+from shards import ShardMap
+
+PASSWORD = 'secret'
+
+# Numbers used to give every account created by a test its own email
+_accounts = itertools.count(1)
+
+
+# One app and one database for the whole session, in a temporary working directory. The
+# caches of the app are keyed on the versions stored in the database, so it is not swapped
+# between tests; tests create their own accounts and shops instead.
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('print_seva')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    db.close_db()
+    flask_app = app_module.create_app({
+        'BCRYPT_LOG_ROUNDS': 4,
+        'PASSWORD_HASH_WORKERS': 1,
+        'ANALYSIS_WORKERS': 1,
+        'RETENTION_INTERVAL': None,
+    })
+    flask_app.root_path = str(workdir)
+    yield flask_app
+    app_module.shutdown_resources()
+    db.close_db()
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# Two shard databases and a main one in a directory of their own, for tests that work on the
+# tables directly. The database files are named relative to the working directory, so the
+# connections of this thread are closed before and after.
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    db.close_db()
+    monkeypatch.chdir(tmp_path)
+    create_tables(2)
+    yield ShardMap(2)
+    db.close_db()
+
+
+# Function to register and log in a new user, returning its id and auth headers
+def create_user(client):
+    email = f'user{next(_accounts)}@example.com'
+    response = client.post('/register/user', data={'name': 'User', 'email': email, 'password': PASSWORD, 'confirm_password': PASSWORD})
+    assert response.status_code == 201, response.get_data(as_text=True)
+    body = client.post('/login/user', json={'email': email, 'password': PASSWORD}).json
+    return body['user']['user_id'], {'Authorization': 'Bearer ' + body['token']}
+
+
+# Function to register and log in a new shopkeeper with the given prices, returning its id
+# and auth headers
+def create_shop(client, cost_single_side='1', cost_both_sides='2'):
+    number = next(_accounts)
+    email = f'shop{number}@example.com'
+    response = client.post('/register/shopkeeper', data={
+        'name': 'Shopkeeper', 'email': email, 'password': PASSWORD, 'confirmPassword': PASSWORD,
+        'shopName': f'Shop {number}', 'shopAddress': 'Main Road', 'contact': str(number),
+        'costSingleSide': cost_single_side, 'costBothSide': cost_both_sides,
+    })
+    assert response.status_code == 201, response.get_data(as_text=True)
+    body = client.post('/login/shopkeeper', json={'email': email, 'password': PASSWORD}).json
+    return body['user']['shopkeeper_id'], {'Authorization': 'Bearer ' + body['token']}
@@ -0,0 +1,73 @@
+import zlib
+
+from analysis import count_pdf_pages
+
+
+def page_tree(number, count, kids=b''):
+    return b'%d 0 obj\n<< /Type /Pages /Kids [%s] /Count %d >>\nendobj\n' % (number, kids, count)
+
+
+def catalog(number, pages):
+    return b'%d 0 obj\n<< /Type /Catalog /Pages %d 0 R >>\nendobj\n' % (number, pages)
+
+
+def trailer(root):
+    return b'trailer\n<< /Size 10 /Root %d 0 R >>\nstartxref\n0\n%%%%EOF\n' % root
+
+
+def write(tmp_path, data):
+    path = tmp_path / 'document.pdf'
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_counts_page_tree_root(tmp_path):
+    pages = b''.join(b'%d 0 obj\n<< /Type /Page /Parent 2 0 R >>\nendobj\n' % number for number in range(3, 6))
+    data = b'%PDF-1.4\n' + catalog(1, 2) + page_tree(2, 3, b'3 0 R 4 0 R 5 0 R') + pages + trailer(1)
+    assert count_pdf_pages(write(tmp_path, data)) == 3
+
+
+def test_incremental_update_replaces_page_tree(tmp_path):
+    first = b'%PDF-1.4\n' + catalog(1, 2) + page_tree(2, 19) + trailer(1)
+    update = page_tree(2, 4) + trailer(1)
+    assert count_pdf_pages(write(tmp_path, first + update)) == 4
+
+
+def test_incremental_update_points_catalog_at_new_page_tree(tmp_path):
+    first = b'%PDF-1.4\n' + catalog(1, 2) + page_tree(2, 19) + trailer(1)
+    update = catalog(1, 5) + page_tree(5, 4) + trailer(1)
+    assert count_pdf_pages(write(tmp_path, first + update)) == 4
+
+
+def test_incremental_update_with_new_catalog(tmp_path):
+    first = b'%PDF-1.4\n' + catalog(1, 2) + page_tree(2, 19) + trailer(1)
+    update = catalog(6, 7) + page_tree(7, 2) + trailer(6)
+    assert count_pdf_pages(write(tmp_path, first + update)) == 2
+
+
+def test_page_tree_in_object_stream(tmp_path):
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', b'<< /Type /Pages /Kids [] /Count 7 >>',
+               b'<< /Type /Pages /Kids [] /Count 50 >>']
+    offsets, body = [], b''
+    for obj in objects:
+        offsets.append(len(body))
+        body += obj + b' '
+    header = b' '.join(b'%d %d' % (number, offset) for number, offset in zip((1, 2, 3), offsets)) + b' '
+    stream = zlib.compress(header + body)
+    data = (b'%%PDF-1.5\n4 0 obj\n<< /Type /ObjStm /N 3 /First %d /Filter /FlateDecode /Length %d >>\nstream\n'
+            % (len(header), len(stream)) + stream + b'\nendstream\nendobj\n'
+            b'5 0 obj\n<< /Type /XRef /Root 1 0 R /Size 6 >>\nstream\n\nendstream\nendobj\n%%EOF\n')
+    assert count_pdf_pages(write(tmp_path, data)) == 7
+
+
+def test_falls_back_to_latest_leaf_pages(tmp_path):
+    pages = b''.join(b'%d 0 obj\n<< /Type /Page >>\nendobj\n' % number for number in range(3, 6))
+    # The update turns page 5 into something else, and there is no page tree to read
+    update = b'5 0 obj\n<< /Type /Font >>\nendobj\n'
+    assert count_pdf_pages(write(tmp_path, b'%PDF-1.4\n' + pages + update)) == 2
+
+
+def test_falls_back_to_latest_page_trees(tmp_path):
+    # No catalog and no trailer; the update replaces the page tree of the first revision
+    data = b'%PDF-1.4\n' + page_tree(2, 19) + page_tree(2, 4)
+    assert count_pdf_pages(write(tmp_path, data)) == 4
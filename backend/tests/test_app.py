@@ -0,0 +1,40 @@
+import importlib
+import subprocess
+import sys
+
+import app as app_module
+from conftest import create_shop, create_user
+
+
+def test_import_has_no_side_effects(tmp_path):
+    subprocess.run([sys.executable, '-c', 'import app'], cwd=tmp_path, check=True,
+                   env={'PYTHONPATH': app_module.__file__.rsplit('/', 1)[0]})
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_module_has_no_uninitialised_app():
+    assert not hasattr(importlib.import_module('app'), 'app')
+
+
+def test_create_app_again_replaces_resources(app):
+    writer = app_module.writer
+    writer.execute(lambda: None)
+    thread = writer.thread
+    second = app_module.create_app({'BCRYPT_LOG_ROUNDS': 4, 'PASSWORD_HASH_WORKERS': 1,
+                                    'ANALYSIS_WORKERS': 1, 'RETENTION_INTERVAL': None})
+    second.root_path = app.root_path
+    thread.join(5)
+    assert not thread.is_alive()
+    assert app_module.writer is not writer
+
+    client = second.test_client()
+    _, headers = create_user(client)
+    assert client.get('/api/user', headers=headers).status_code == 200
+    assert client.get('/metrics').status_code == 200
+
+
+def test_metrics_after_requests(client):
+    create_shop(client)
+    assert client.get('/api/shops').status_code == 200
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{endpoint="get_shops",method="GET",status="200"}' in body
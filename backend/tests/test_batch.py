@@ -0,0 +1,59 @@
+from conftest import create_shop, create_user
+from test_pagination import send_request
+
+
+def batch(client, headers, items):
+    response = client.post('/api/shopkeeper/requests/batch', headers=headers, json={'items': items})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return [result['result'] for result in response.json['results']], response.json['updated']
+
+
+def pending_requests(client, count):
+    shop_id, shop_headers = create_shop(client)
+    _, user_headers = create_user(client)
+    for number in range(count):
+        send_request(client, user_headers, shop_id, number)
+    ids = [row['id'] for row in client.get('/api/user/notifications', headers=user_headers).json]
+    return shop_headers, ids
+
+
+def status(client, request_id):
+    row = client.get(f'/api/user/requests/{request_id}').json
+    return row['status'], row['action']
+
+
+def test_batch_reports_every_outcome(client):
+    shop_headers, (first, second, third) = pending_requests(client, 3)
+    _, (foreign,) = pending_requests(client, 1)
+
+    results, updated = batch(client, shop_headers, [
+        {'id': first, 'action': 'accept'},
+        {'id': second, 'action': 'decline'},
+        {'id': first, 'action': 'decline'},
+        {'id': foreign, 'action': 'accept'},
+        {'id': 10 ** 9, 'action': 'accept'},
+        {'id': third, 'action': 'printed'},
+        {'id': third, 'action': ['accept']},
+        {'id': third, 'action': {'accept': 1}},
+        {'id': str(third), 'action': 'accept'},
+        {'id': True, 'action': 'accept'},
+        'accept',
+    ])
+    assert results == ['updated', 'updated', 'duplicate', 'not_found', 'not_found', 'wrong_state',
+                       'invalid', 'invalid', 'invalid', 'invalid', 'invalid']
+    assert updated == 2
+    assert status(client, first) == ('Responded', 'Accepted')
+    assert status(client, second) == ('Responded', 'Declined')
+    assert status(client, third)[0] == 'Pending'
+    assert status(client, foreign)[0] == 'Pending'
+
+
+def test_batch_follows_request_states(client):
+    shop_headers, (first, second) = pending_requests(client, 2)
+
+    assert batch(client, shop_headers, [{'id': first, 'action': 'accept'}, {'id': second, 'action': 'decline'}])[0] == ['updated', 'updated']
+    # Decided requests are not decided again, and only accepted ones are printed
+    assert batch(client, shop_headers, [{'id': first, 'action': 'decline'}, {'id': second, 'action': 'printed'}]) == (['wrong_state', 'wrong_state'], 0)
+    assert batch(client, shop_headers, [{'id': first, 'action': 'printed'}]) == (['updated'], 1)
+    assert status(client, first)[0] == 'Printed'
+    assert status(client, second) == ('Responded', 'Declined')
@@ -0,0 +1,69 @@
+import threading
+
+import db
+from conftest import create_shop, create_user
+from test_pagination import send_request
+
+
+def request_ids(client, headers):
+    response = client.get('/api/user/notifications', headers=headers)
+    assert response.status_code == 200
+    return [row['id'] for row in response.json], response.headers['X-Change-Seq']
+
+
+def delta(client, headers, since):
+    response = client.get('/api/user/notifications', headers=headers, query_string={'since': since})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.json
+
+
+def test_delta_reports_update_and_delete(client):
+    shop_id, _ = create_shop(client)
+    _, headers = create_user(client)
+    for number in range(2):
+        send_request(client, headers, shop_id, number)
+    (first, second), seq = request_ids(client, headers)
+
+    assert client.put(f'/api/user/requests/update/{first}', json={'comments': 'staple'}).status_code == 200
+    assert client.delete(f'/api/user/requests/{second}').status_code == 200
+
+    body = delta(client, headers, seq)
+    assert [row['id'] for row in body['changed']] == [first]
+    assert body['deleted'] == [second]
+    assert delta(client, headers, body['seq']) == {'changed': [], 'deleted': [], 'seq': body['seq'], 'has_more': False}
+
+
+# An update and a delete committed between the read of the rows and the read of the
+# tombstones must not let seq skip the update
+def test_delta_reads_rows_and_tombstones_in_one_snapshot(app, client):
+    shop_id, _ = create_shop(client)
+    _, headers = create_user(client)
+    for number in range(2):
+        send_request(client, headers, shop_id, number)
+    (first, second), seq = request_ids(client, headers)
+
+    def write_between_reads(query, elapsed):
+        if 'FROM user_request' not in query or 'change_seq >' not in query or fired:
+            return
+        fired.append(True)
+
+        def write():
+            writer = app.test_client()
+            assert writer.put(f'/api/user/requests/update/{first}', json={'comments': 'staple'}).status_code == 200
+            assert writer.delete(f'/api/user/requests/{second}').status_code == 200
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join()
+
+    fired = []
+    db.statement_listeners.append(write_between_reads)
+    try:
+        body = delta(client, headers, seq)
+    finally:
+        db.statement_listeners.remove(write_between_reads)
+    assert fired
+
+    # Whatever the first delta left out has to come with the next one
+    following = delta(client, headers, body['seq'])
+    assert first in {row['id'] for row in body['changed'] + following['changed']}
+    assert second in body['deleted'] + following['deleted']
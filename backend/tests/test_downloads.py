@@ -0,0 +1,56 @@
+import io
+import os
+from urllib.parse import unquote
+
+import pytest
+
+from conftest import create_shop, create_user
+
+NAME = 'report "final" 100% ü.pdf'
+
+
+@pytest.fixture
+def stored_file(app):
+    path = os.path.join(app.config['UPLOAD_FOLDER'], NAME)
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4\n%%EOF\n')
+    yield NAME
+    os.remove(path)
+
+
+@pytest.mark.parametrize('offload', ['x-accel-redirect', None])
+def test_download_headers_encode_the_name(app, client, monkeypatch, stored_file, offload):
+    monkeypatch.setitem(app.config, 'DOWNLOAD_OFFLOAD', offload)
+    _, headers = create_user(client)
+    response = client.get('/api/download/uploads/' + stored_file, headers=headers)
+    assert response.status_code == 200
+
+    disposition = response.headers['Content-Disposition']
+    assert "filename*=UTF-8''" in disposition
+    assert unquote(disposition.split("filename*=UTF-8''")[1]) == NAME
+    if offload:
+        assert disposition == ('attachment; filename="report _final_ 100_ u.pdf"; '
+                               "filename*=UTF-8''report%20%22final%22%20100%25%20%C3%BC.pdf")
+        redirect = response.headers['X-Accel-Redirect']
+        assert redirect == '/protected-uploads/report%20%22final%22%20100%25%20%C3%BC.pdf'
+        assert unquote(redirect) == '/protected-uploads/' + NAME
+
+
+@pytest.mark.parametrize('offload', ['x-accel-redirect', None])
+def test_blob_downloads_under_its_original_name(app, client, monkeypatch, offload):
+    monkeypatch.setitem(app.config, 'DOWNLOAD_OFFLOAD', offload)
+    shop_id, shop_headers = create_shop(client)
+    _, user_headers = create_user(client)
+    response = client.post('/api/user_request', headers=user_headers, content_type='multipart/form-data', data={
+        'file': (io.BytesIO(b'%PDF-1.4\n%%EOF\n' + os.urandom(8)), 'Quarterly report.pdf'), 'shop_id': str(shop_id),
+        'total_pages': '1', 'print_type': 'black&white', 'print_side': 'single', 'page_size': 'A4', 'no_of_copies': '1',
+    })
+    assert response.status_code == 201
+    file_path = client.get('/api/user/notifications', headers=user_headers).json[0]['file_path']
+    url = '/api/download/' + file_path.replace(os.sep, '/')
+
+    for headers in (user_headers, shop_headers):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert response.headers['Content-Disposition'] == ('attachment; filename="Quarterly_report.pdf"; '
+                                                           "filename*=UTF-8''Quarterly_report.pdf")
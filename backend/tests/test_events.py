@@ -0,0 +1,36 @@
+from conftest import create_user
+
+
+def open_stream(client, **kwargs):
+    response = client.get('/api/events', buffered=False, **kwargs)
+    status = response.status_code
+    response.close()
+    return status
+
+
+def stream_token(client, headers):
+    response = client.post('/api/events/token', headers=headers)
+    assert response.status_code == 200
+    return response.json['token']
+
+
+def test_access_token_is_not_accepted_in_the_url(client):
+    _, headers = create_user(client)
+    token = headers['Authorization'].split()[1]
+    assert client.get('/api/user', query_string={'jwt': token}).status_code == 401
+    assert open_stream(client, query_string={'jwt': token}) == 401
+    assert open_stream(client, headers=headers) == 200
+
+
+def test_stream_token_only_opens_the_stream(client):
+    _, headers = create_user(client)
+    token = stream_token(client, headers)
+    assert open_stream(client, query_string={'jwt': token}) == 200
+    assert client.get('/api/user', headers={'Authorization': 'Bearer ' + token}).status_code == 403
+    assert client.post('/api/events/token', headers={'Authorization': 'Bearer ' + token}).status_code == 403
+
+
+def test_stream_token_expires(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'EVENTS_TOKEN_EXPIRES', -1)
+    _, headers = create_user(client)
+    assert open_stream(client, query_string={'jwt': stream_token(client, headers)}) == 401
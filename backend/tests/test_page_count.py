@@ -0,0 +1,71 @@
+import time
+from concurrent.futures import Future
+
+import app as app_module
+from conftest import create_shop, create_user
+from db import query_db
+from test_pagination import send_request
+
+
+def wait_for_analysis(request_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        row = query_db('SELECT verified_pages, analysis_status, file_path FROM user_request WHERE id = ?', [request_id], one=True)
+        if row['analysis_status'] != 'Pending':
+            return row
+        time.sleep(0.05)
+    raise AssertionError('page count was never stored')
+
+
+def latest_request(client, headers):
+    return client.get('/api/user/notifications', headers=headers).json[-1]['id']
+
+
+def test_page_count_is_stored(client):
+    shop_id, _ = create_shop(client)
+    _, headers = create_user(client)
+    send_request(client, headers, shop_id, 'stored')
+    row = wait_for_analysis(latest_request(client, headers))
+    assert (row['verified_pages'], row['analysis_status']) == (1, 'Done')
+    assert query_db('SELECT page_count FROM blob WHERE path = ?', [row['file_path']], one=True)['page_count'] == 1
+
+
+def test_failed_page_count_marks_requests_failed(client):
+    shop_id, _ = create_shop(client)
+    _, headers = create_user(client)
+    send_request(client, headers, shop_id, 'failed')
+    request_id = latest_request(client, headers)
+    path = wait_for_analysis(request_id)['file_path']
+    query_db("UPDATE user_request SET analysis_status = 'Pending', verified_pages = NULL WHERE id = ?", [request_id])
+
+    future = Future()
+    future.set_exception(ValueError('broken file'))
+    app_module.store_page_count(path, future)
+    assert wait_for_analysis(request_id)['analysis_status'] == 'Failed'
+
+
+def test_failed_write_is_retried(client, monkeypatch):
+    shop_id, _ = create_shop(client)
+    _, headers = create_user(client)
+    send_request(client, headers, shop_id, 'retried')
+    request_id = latest_request(client, headers)
+    path = wait_for_analysis(request_id)['file_path']
+    query_db("UPDATE user_request SET analysis_status = 'Pending', verified_pages = NULL WHERE id = ?", [request_id])
+
+    original = app_module.write_request_page_count
+    calls = []
+
+    def flaky(path, page_count, database):
+        calls.append(page_count)
+        if len(calls) == 1:
+            raise RuntimeError('database is locked')
+        return original(path, page_count, database)
+
+    monkeypatch.setattr(app_module, 'PAGE_COUNT_RETRY_SECONDS', 0.01)
+    monkeypatch.setattr(app_module, 'write_request_page_count', flaky)
+    future = Future()
+    future.set_result(5)
+    app_module.store_page_count(path, future)
+    row = wait_for_analysis(request_id)
+    assert (row['verified_pages'], row['analysis_status']) == (5, 'Done')
+    assert calls == [5, 5]
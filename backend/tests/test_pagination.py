@@ -0,0 +1,66 @@
+import base64
+import io
+import json
+
+import pytest
+
+from conftest import create_shop, create_user
+
+PDF = b'%PDF-1.4\n1 0 obj<</Type/Pages/Count 1/Kids[]>>endobj\n%%EOF\n'
+
+
+def encode(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+
+def send_request(client, headers, shop_id, number):
+    response = client.post('/api/user_request', headers=headers, content_type='multipart/form-data', data={
+        'file': (io.BytesIO(PDF + str(number).encode('ascii')), 'document.pdf'), 'shop_id': str(shop_id),
+        'total_pages': '1', 'print_type': 'black&white', 'print_side': 'single', 'page_size': 'A4', 'no_of_copies': '1',
+    })
+    assert response.status_code == 201, response.get_data(as_text=True)
+
+
+MALFORMED = [
+    'not-base64!',
+    encode({'a': 1}),
+    encode([]),
+    encode([1]),
+    encode([{'a': 1}, 2]),
+    encode(['2024-01-01 00:00:00', '2']),
+    encode(['2024-01-01 00:00:00', True]),
+    encode(['2024-01-01 00:00:00', 2, 3]),
+]
+
+
+@pytest.mark.parametrize('cursor', MALFORMED)
+def test_malformed_request_cursor_is_rejected(client, cursor):
+    shop_id, shop_headers = create_shop(client)
+    _, user_headers = create_user(client)
+    assert client.get('/api/user/notifications', headers=user_headers, query_string={'cursor': cursor}).status_code == 400
+    assert client.post('/api/shopkeeper/requests', headers=shop_headers, query_string={'cursor': cursor},
+                       json={'shopkeeper_id': shop_id}).status_code == 400
+    assert client.get('/api/shopkeeper/pending_requests', headers=shop_headers,
+                      query_string={'shopkeeper_id': shop_id, 'cursor': cursor}).status_code == 400
+
+
+@pytest.mark.parametrize('cursor', [encode([1, 2]), encode(['1']), encode([1.5]), encode([None])])
+def test_malformed_shop_cursor_is_rejected(client, cursor):
+    assert client.get('/api/shops', query_string={'cursor': cursor}).status_code == 400
+
+
+def test_notifications_follow_cursor(client):
+    shop_id, _ = create_shop(client)
+    _, headers = create_user(client)
+    for number in range(5):
+        send_request(client, headers, shop_id, number)
+
+    ids, cursor = [], None
+    while True:
+        response = client.get('/api/user/notifications', headers=headers, query_string={'limit': 2, 'cursor': cursor})
+        assert response.status_code == 200
+        ids += [row['id'] for row in response.json]
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert len(ids) == len(set(ids)) == 5
@@ -0,0 +1,27 @@
+import time
+
+import app as app_module
+from conftest import PASSWORD, create_user
+from db import query_db
+from passwords import hash_rounds
+
+
+def test_rehash_on_login_goes_through_write_queue(client, monkeypatch):
+    user_id, _ = create_user(client)
+    email = query_db('SELECT email FROM user WHERE user_id = ?', [user_id], one=True)['email']
+    submitted = []
+    submit = app_module.writer.submit
+
+    def recording_submit(function, *args):
+        submitted.append(function)
+        return submit(function, *args)
+
+    monkeypatch.setattr(app_module.bcrypt, 'rounds', 5)
+    monkeypatch.setattr(app_module.writer, 'submit', recording_submit)
+    assert client.post('/login/user', json={'email': email, 'password': PASSWORD}).status_code == 200
+
+    deadline = time.monotonic() + 10
+    while hash_rounds(query_db('SELECT password FROM user WHERE user_id = ?', [user_id], one=True)['password']) != 5:
+        assert time.monotonic() < deadline, 'password was never rehashed'
+        time.sleep(0.05)
+    assert app_module.store_rehash in submitted
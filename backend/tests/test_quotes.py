@@ -0,0 +1,38 @@
+import math
+
+import pytest
+
+from conftest import create_shop
+from quotes import parse_price
+
+
+@pytest.mark.parametrize('value, expected', [(2, 2.0), ('1.5', 1.5), (None, None), ('', None), ('abc', None), ('inf', None)])
+def test_parse_price(value, expected):
+    parsed = parse_price(value)
+    assert math.isnan(parsed) if expected is None else parsed == expected
+
+
+def test_malformed_price_is_left_out_of_quotes(client):
+    good_id, _ = create_shop(client, '2', '3')
+    bad_id, _ = create_shop(client, '', 'abc')
+
+    response = client.get('/api/shops/quote', query_string={'total_pages': 4, 'limit': 500})
+    assert response.status_code == 200
+    shop_ids = [shop['shopkeeper_id'] for shop in response.json]
+    assert good_id in shop_ids and bad_id not in shop_ids
+
+    response = client.get('/api/shops/quote', query_string={'total_pages': 4, 'print_side': 'double', 'limit': 500})
+    assert response.status_code == 200
+    assert bad_id not in [shop['shopkeeper_id'] for shop in response.json]
+
+    response = client.post(f'/api/shops/{bad_id}/quote', json={'jobs': [{'total_pages': 4}]})
+    assert response.status_code == 200
+    assert response.json['prices'] == [None]
+
+
+@pytest.mark.parametrize('param', ['min_single', 'max_single', 'min_both', 'max_both'])
+def test_malformed_price_is_left_out_of_price_filters(client, param):
+    bad_id, _ = create_shop(client, 'free', 'abc')
+    response = client.get('/api/shops/search', query_string={param: 1, 'limit': 500})
+    assert response.status_code == 200
+    assert bad_id not in [shop['shopkeeper_id'] for shop in response.json]
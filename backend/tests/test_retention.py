@@ -0,0 +1,82 @@
+import hashlib
+import os
+import threading
+import time
+
+import db
+from retention import RetentionJob, enable_incremental_vacuum
+
+
+def old_blob_file(folder, content):
+    digest = hashlib.sha256(content).hexdigest()
+    path = os.path.join(folder, digest[:2], digest[2:4], digest + '.pdf')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    os.utime(path, (time.time() - 7200, time.time() - 7200))
+    return digest, path
+
+
+def test_stray_blob_is_removed(app, tmp_path):
+    _, path = old_blob_file(str(tmp_path), b'stray')
+    assert RetentionJob(str(tmp_path)).remove_stray_files() == 1
+    assert not os.path.exists(path)
+
+
+def test_blob_committed_during_the_check_is_kept(app, tmp_path):
+    digest, path = old_blob_file(str(tmp_path), b'reused')
+    inserted, release = threading.Event(), threading.Event()
+
+    # An upload of the same content: it finds the file in place and only inserts the row
+    def upload():
+        with db.transaction():
+            db.execute_db('INSERT INTO blob (sha256, path, size, ref_count) VALUES (?, ?, ?, 1)', [digest, path, 6])
+            inserted.set()
+            release.wait(5)
+        db.close_db()
+
+    uploader = threading.Thread(target=upload)
+    uploader.start()
+    inserted.wait(5)
+    results = []
+    collector = threading.Thread(target=lambda: results.append(RetentionJob(str(tmp_path)).remove_stray_files()))
+    collector.start()
+    time.sleep(0.2)
+    release.set()
+    uploader.join(5)
+    collector.join(10)
+
+    assert results == [0]
+    assert os.path.exists(path)
+
+
+def test_vacuum_leaves_older_databases_to_the_command(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    conn = db.connect(path)
+    conn.execute('CREATE TABLE filler (data BLOB)')
+    with conn:
+        conn.executemany('INSERT INTO filler VALUES (?)', [(os.urandom(4096),) for _ in range(50)])
+    with conn:
+        conn.execute('DELETE FROM filler')
+    free_pages = lambda: conn.execute('PRAGMA freelist_count').fetchone()[0]
+    assert free_pages()
+
+    # The periodic job never runs a full VACUUM
+    job = RetentionJob(str(tmp_path), databases=[path])
+    assert job.vacuum_database(path) is False
+    assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 0
+
+    conn.close()
+    assert enable_incremental_vacuum(path) is True
+    assert enable_incremental_vacuum(path) is False
+    conn = db.connect(path)
+    assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+    with conn:
+        conn.executemany('INSERT INTO filler VALUES (?)', [(os.urandom(4096),) for _ in range(50)])
+    with conn:
+        conn.execute('DELETE FROM filler')
+    assert free_pages()
+    assert job.vacuum_database(path) is True
+    assert free_pages() == 0
+    conn.close()
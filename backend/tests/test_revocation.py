@@ -0,0 +1,58 @@
+import threading
+import time
+
+import pytest
+
+from conftest import create_user
+from db import execute_db
+from revocation import RevocationStore
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def store(app):
+    return RevocationStore(sync_interval=0.01, prune_interval=0.05)
+
+
+def test_logout_revokes_token(client):
+    _, headers = create_user(client)
+    assert client.get('/api/user', headers=headers).status_code == 200
+    assert client.post('/api/logout', headers=headers).status_code == 200
+    assert client.get('/api/user', headers=headers).status_code == 401
+
+
+def test_sync_and_prune_run_off_the_request_thread(store, monkeypatch):
+    threads = []
+    rebuild = store.rebuild
+
+    def recording_rebuild():
+        threads.append(threading.current_thread().name)
+        rebuild()
+
+    monkeypatch.setattr(store, 'rebuild', recording_rebuild)
+    assert not store.is_revoked('never-revoked')
+    wait_until(lambda: store.bloom is not None)
+
+    # A revocation made by another worker shows up after the next sync
+    execute_db('INSERT INTO revoked_token (jti, expires_at) VALUES (?, ?)', ['other-worker', int(time.time()) + 60])
+    wait_until(lambda: 'other-worker' in store.bloom)
+    assert store.is_revoked('other-worker')
+
+    # Expired revocations are pruned by the periodic rebuild
+    execute_db('INSERT INTO revoked_token (jti, expires_at) VALUES (?, ?)', ['expired', int(time.time()) - 1])
+    wait_until(lambda: len(threads) >= 3)
+    assert not store.is_revoked('expired')
+    assert set(threads) == {'revocation-sync'}
+
+
+def test_revoke_during_rebuild_is_kept(store):
+    store.rebuild()
+    store.revoke('local', time.time() + 60)
+    store.rebuild()
+    assert 'local' in store.bloom and store.is_revoked('local')
@@ -0,0 +1,72 @@
+import random
+
+import pytest
+
+from scheduler import JOB_OVERHEAD, POLICIES, PRINT_SIDES, PRINT_TYPES, SETUP_SECONDS, Job, estimate_seconds, schedule
+
+
+def job(id, user_id=1, pages=1, waited=0, page_size='A4', print_type='black&white', print_side='single', copies=1):
+    return Job(id, user_id, pages, copies, print_side, print_type, page_size, waited)
+
+
+def order(jobs, policy):
+    return [scheduled.job.id for scheduled in schedule(jobs, policy)]
+
+
+def test_estimate_counts_pages_copies_and_sides():
+    assert estimate_seconds(job(1, pages=40)) == 60 + JOB_OVERHEAD
+    assert estimate_seconds(job(1, pages=40, print_type='color')) == 120 + JOB_OVERHEAD
+    assert estimate_seconds(job(1, pages=40, copies=2, print_side='double')) == pytest.approx(192 + JOB_OVERHEAD)
+
+
+def test_fifo_serves_the_longest_waiting_first():
+    jobs = [job(1, waited=10, pages=1), job(2, waited=300, pages=200), job(3, waited=60, user_id=2), job(4, waited=60)]
+    assert order(jobs, 'fifo') == [2, 3, 4, 1]
+
+
+def test_sjf_serves_short_jobs_first_until_a_long_one_has_waited_long_enough():
+    short, long = job(1, pages=1), job(2, pages=100, user_id=2)
+    assert order([long, short], 'sjf') == [1, 2]
+    # 0.1 of a second of priority for every second waited: 150 seconds more work is made up
+    # after 1500 seconds of waiting
+    assert order([job(2, pages=100, user_id=2, waited=1600), short], 'sjf') == [2, 1]
+
+
+def test_balanced_takes_turns_between_users():
+    jobs = [job(1, user_id=1), job(2, user_id=1), job(3, user_id=1), job(4, user_id=2)]
+    assert order(jobs, 'sjf') == [1, 2, 3, 4]
+    # Once the first user has had a job printed, the second user's job goes before their next one
+    assert order(jobs, 'balanced') == [1, 4, 2, 3]
+
+
+def test_balanced_serves_the_shorter_jobs_of_a_user_first():
+    jobs = [job(1, user_id=1, pages=50), job(2, user_id=1, pages=5), job(3, user_id=2, pages=20)]
+    scheduled = order(jobs, 'balanced')
+    assert scheduled.index(2) < scheduled.index(1)
+
+
+def test_balanced_batches_jobs_of_the_same_setup():
+    jobs = [job(1, page_size='A4'), job(2, page_size='A3'), job(3, page_size='A4'), job(4, page_size='A3')]
+    assert order(jobs, 'sjf') == [1, 2, 3, 4]
+    assert order(jobs, 'balanced') == [1, 3, 2, 4]
+    assert schedule(jobs, 'balanced')[-1].end < schedule(jobs, 'sjf')[-1].end
+
+
+@pytest.mark.parametrize('policy', sorted(POLICIES))
+def test_every_job_is_scheduled_once_back_to_back(policy):
+    rng = random.Random(policy)
+    jobs = [job(number, user_id=rng.randrange(5), pages=rng.randint(1, 100), waited=rng.randint(0, 3600),
+                page_size=rng.choice(('A4', 'A3')), print_type=rng.choice(PRINT_TYPES), print_side=rng.choice(PRINT_SIDES),
+                copies=rng.randint(1, 3)) for number in range(200)]
+    scheduled = schedule(jobs, policy)
+
+    assert sorted(item.job.id for item in scheduled) == list(range(200))
+    assert scheduled[0].start == 0
+    for previous, item in zip(scheduled, scheduled[1:]):
+        setup_changed = (previous.job.page_size, previous.job.print_type) != (item.job.page_size, item.job.print_type)
+        assert item.start == pytest.approx(previous.end + (SETUP_SECONDS if setup_changed else 0))
+        assert item.end == pytest.approx(item.start + estimate_seconds(item.job))
+
+
+def test_no_jobs():
+    assert schedule([], 'balanced') == []
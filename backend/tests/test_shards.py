@@ -0,0 +1,107 @@
+import app as app_module
+import db
+from conftest import create_shop
+from shards import ID_BITS, ShardMap, first_request_id, move_shop, next_request_id, rebalance
+
+SHARDS = ['print_seva.shard0.db', 'print_seva.shard1.db']
+
+
+def add_request(database, shop_id, request_time, status='Pending', action='Pending', user_id=1):
+    with db.transaction(database):
+        return db.query_db('''
+            INSERT INTO user_request (id, user_id, shop_id, total_pages, no_of_copies, status, action, request_time, update_time)
+            VALUES (?, ?, ?, 2, 3, ?, ?, ?, ?) RETURNING id
+        ''', [next_request_id(database), user_id, shop_id, status, action, request_time, request_time], one=True, database=database)['id']
+
+
+def requests_of(database, shop_id):
+    return [dict(row) for row in db.query_db('''
+        SELECT id, user_id, shop_id, status, action, request_time FROM user_request WHERE shop_id = ? ORDER BY id
+    ''', [shop_id], database=database)]
+
+
+def stats_of(database, shop_id):
+    return [tuple(row) for row in db.query_db('''
+        SELECT day, status, action, requests, pages, copies FROM request_daily_stats WHERE shop_id = ? ORDER BY 1, 2, 3
+    ''', [shop_id], database=database)]
+
+
+def test_shops_are_placed_by_id_unless_moved(shards):
+    assert shards.databases() == SHARDS
+    assert shards.database(4) == SHARDS[0]
+    assert shards.database('7') == SHARDS[1]
+    assert ShardMap(1).databases() == [None]
+    assert ShardMap(1).database(7) is None
+
+    db.execute_db('INSERT INTO shop_shard (shop_id, shard) VALUES (4, 1)')
+    db.bump_version('shards')
+    assert shards.database(4) == SHARDS[1]
+    # Overrides for shards that no longer exist are ignored
+    assert ShardMap(1).database(4) is None
+
+
+def test_request_ids_come_from_the_range_of_their_shard(shards):
+    first = [add_request(SHARDS[0], 2, '2024-01-01 10:00:00') for _ in range(3)]
+    second = [add_request(SHARDS[1], 3, '2024-01-01 10:00:00') for _ in range(2)]
+
+    assert first == sorted(first) and len(set(first)) == 3
+    assert all(first_request_id(0) < request_id < first_request_id(1) for request_id in first)
+    assert all(first_request_id(1) < request_id < first_request_id(2) for request_id in second)
+    assert shards.databases_for_id(second[0]) == [SHARDS[1], SHARDS[0]]
+    assert shards.databases_for_id(first[0]) == SHARDS
+    # Ids of the single database are looked up everywhere
+    assert shards.databases_for_id((1 << ID_BITS) - 1) == SHARDS
+    assert shards.databases_for_id('x') == SHARDS
+
+
+def test_move_shop_takes_requests_and_stats(shards):
+    source, target = SHARDS[1], SHARDS[0]
+    ids = [add_request(source, 5, f'2024-01-0{day} 10:00:00') for day in (1, 1, 2)]
+    other = add_request(source, 7, '2024-01-01 10:00:00')
+    db.execute_db("UPDATE user_request SET status = 'Responded', action = 'Accepted', update_time = '2024-01-03 09:00:00' WHERE id = ?",
+                  [ids[0]], database=source)
+    requests, stats = requests_of(source, 5), stats_of(source, 5)
+    seq = db.query_db("SELECT value FROM change_sequence WHERE name = 'user_request'", one=True, database=target)['value']
+
+    assert move_shop(5, source, target, batch_size=2) == 3
+
+    assert requests_of(target, 5) == requests
+    assert stats_of(target, 5) == stats
+    assert requests_of(source, 5) == [] and stats_of(source, 5) == []
+    assert [row['id'] for row in requests_of(source, 7)] == [other]
+    # Clients syncing the target see the requests as changed, those of the source see no deletes
+    assert all(row['change_seq'] > seq for row in db.query_db('SELECT change_seq FROM user_request WHERE shop_id = 5', database=target))
+    assert db.query_db('SELECT * FROM request_tombstone', database=source) == []
+
+    # Running the move again finds nothing left
+    assert move_shop(5, source, target) == 0
+    assert stats_of(target, 5) == stats
+
+
+def test_rebalance_moves_requests_of_the_single_database(shards):
+    add_request(None, 2, '2024-01-01 10:00:00')
+    add_request(None, 3, '2024-01-01 10:00:00')
+    add_request(None, 3, '2024-01-02 10:00:00')
+
+    assert rebalance(2) == 3
+    assert len(requests_of(SHARDS[0], 2)) == 1
+    assert len(requests_of(SHARDS[1], 3)) == 2
+    assert requests_of(None, 2) == requests_of(None, 3) == []
+    assert rebalance(2) == 0
+
+
+def test_scatter_query_merges_shards_in_request_order(shards, monkeypatch):
+    monkeypatch.setattr(app_module, 'shard_map', shards)
+    times = ['2024-01-01 10:00:00', '2024-01-01 11:00:00', '2024-01-01 11:00:00', '2024-01-02 08:00:00', '2024-01-03 08:00:00']
+    expected = sorted((time, add_request(shards.database(shop_id), shop_id, time, user_id=9))
+                      for time, shop_id in zip(times, (1, 2, 1, 1, 2)))
+
+    query = 'SELECT id, request_time FROM user_request WHERE user_id = ? ORDER BY request_time, id LIMIT ?'
+    rows = app_module.scatter_query(query, [9, 4], 4)
+    assert [(row['request_time'], row['id']) for row in rows] == expected[:4]
+
+
+def test_pending_requests_reject_non_numeric_shop(client):
+    _, headers = create_shop(client)
+    response = client.get('/api/shopkeeper/pending_requests', headers=headers, query_string={'shopkeeper_id': 'abc'})
+    assert response.status_code == 400
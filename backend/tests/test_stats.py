@@ -0,0 +1,88 @@
+import collections
+
+import db
+from retention import RetentionJob
+from shards import move_shop
+from test_shards import SHARDS, add_request
+
+SHOP = 5
+COLUMNS = 'status, action, COALESCE(verified_pages, total_pages, 0) * COALESCE(no_of_copies, 1) AS pages, COALESCE(no_of_copies, 1) AS copies'
+
+
+# Function to read the rollup of the shop as {(status, action): (requests, pages, copies)}
+def rollup(database):
+    return {(row['status'], row['action']): (row['requests'], row['pages'], row['copies']) for row in db.query_db('''
+        SELECT status, action, SUM(requests) AS requests, SUM(pages) AS pages, SUM(copies) AS copies
+        FROM request_daily_stats WHERE shop_id = ? GROUP BY status, action
+    ''', [SHOP], database=database)}
+
+
+# Function to work out the rollup from the requests themselves: every request was received,
+# and counts once for each status it went through (printed ones were accepted first)
+def counted(rows):
+    totals = collections.defaultdict(lambda: [0, 0, 0])
+    for row in rows:
+        steps = [('Pending', 'Pending')]
+        if row['action'] in ('Accepted', 'Declined'):
+            steps.append(('Responded', row['action']))
+        if row['status'] == 'Printed':
+            steps.append(('Printed', row['action']))
+        for step in steps:
+            totals[step][0] += 1
+            totals[step][1] += row['pages']
+            totals[step][2] += row['copies']
+    return {step: tuple(values) for step, values in totals.items()}
+
+
+def rows_of(database):
+    return [dict(row) for row in db.query_db(f'SELECT id, {COLUMNS} FROM user_request WHERE shop_id = ?', [SHOP], database=database)]
+
+
+def archived_rows(path):
+    conn = db.connect(path)
+    try:
+        return [dict(row) for row in conn.execute(f'SELECT id, {COLUMNS} FROM user_request WHERE shop_id = ?', [SHOP])]
+    finally:
+        conn.close()
+
+
+def change(database, ids, status, action, day):
+    db.execute_db('UPDATE user_request SET status = ?, action = ?, update_time = ? WHERE id IN (SELECT value FROM json_each(?))',
+                  [status, action, f'{day} 12:00:00', f'[{",".join(map(str, ids))}]'], database=database)
+
+
+def test_rollup_matches_requests_through_their_life(shards, tmp_path):
+    source, target = SHARDS[SHOP % 2], SHARDS[(SHOP + 1) % 2]
+    ids = [add_request(source, SHOP, f'2024-01-0{1 + number % 3} 10:00:00') for number in range(8)]
+    add_request(source, SHOP + 2, '2024-01-01 10:00:00')
+    assert rollup(source) == counted(rows_of(source))
+
+    change(source, ids[:4], 'Responded', 'Accepted', '2024-01-04')
+    change(source, ids[4:6], 'Responded', 'Declined', '2024-01-04')
+    assert rollup(source) == counted(rows_of(source))
+
+    change(source, ids[:2], 'Printed', 'Accepted', '2024-01-05')
+    # Writes that leave status and action alone do not count
+    db.execute_db("UPDATE user_request SET comments = 'staple', update_time = '2024-01-06 09:00:00' WHERE id = ?", [ids[2]], database=source)
+    change(source, ids[3:4], 'Responded', 'Accepted', '2024-01-06')
+    assert rollup(source) == counted(rows_of(source))
+
+    # Deleting and archiving requests keeps the history they made
+    deleted = [row for row in rows_of(source) if row['id'] in (ids[6], ids[3])]
+    db.execute_db('DELETE FROM user_request WHERE id IN (?, ?)', [ids[6], ids[3]], database=source)
+    assert rollup(source) == counted(rows_of(source) + deleted)
+
+    archive = str(tmp_path / 'archive.db')
+    job = RetentionJob(str(tmp_path), retention_days=0, archive_database=archive, databases=[source])
+    assert job.archive_requests() == 4
+    assert rollup(source) == counted(rows_of(source) + deleted + archived_rows(archive))
+
+    # Moving the shop takes its history along
+    expected, remaining = rollup(source), len(rows_of(source))
+    assert move_shop(SHOP, source, target) == remaining
+    assert rollup(source) == {}
+    assert rollup(target) == expected == counted(rows_of(target) + deleted + archived_rows(archive))
+
+    # Requests changed after the move are counted on the new shard
+    change(target, [ids[7]], 'Responded', 'Declined', '2024-01-07')
+    assert rollup(target) == counted(rows_of(target) + deleted + archived_rows(archive))
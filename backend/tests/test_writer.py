@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+import db
+from writer import WriteQueue, WriteQueueFull
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'writes.db')
+    db.execute_db('CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT)', database=path)
+    return path
+
+
+def insert(name, database):
+    db.execute_db('INSERT INTO item (name) VALUES (?)', [name], database=database)
+    return name
+
+
+def names(database):
+    return [row['name'] for row in db.query_db('SELECT name FROM item ORDER BY id', database=database)]
+
+
+def test_failing_write_only_rolls_back_itself(database):
+    # A long window, so the three writes share one batch and one transaction
+    writes = WriteQueue(window=1, max_batch=3, database=database)
+
+    def failing(database):
+        insert('partial', database)
+        raise ValueError('bad write')
+
+    # Nothing of the batch is visible to other connections before it commits
+    def committed(database):
+        conn = db.connect(database)
+        try:
+            return [row['name'] for row in conn.execute('SELECT name FROM item')]
+        finally:
+            conn.close()
+
+    try:
+        first = writes.submit(insert, 'first', database)
+        failed = writes.submit(failing, database)
+        last = writes.submit(lambda: (insert('last', database), committed(database)))
+        assert first.result(5) == 'first'
+        assert last.result(5) == ('last', [])
+        with pytest.raises(ValueError):
+            failed.result(5)
+    finally:
+        writes.shutdown()
+    assert names(database) == ['first', 'last']
+
+
+def test_timed_out_write_is_cancelled(database):
+    writes = WriteQueue(timeout=0.2, database=database)
+    started, release = threading.Event(), threading.Event()
+
+    def blocker(database):
+        started.set()
+        release.wait(5)
+        return insert('blocker', database)
+
+    try:
+        blocked = writes.submit(blocker, database)
+        assert started.wait(5)
+        # The writer is busy, so this write is still queued when the timeout runs out
+        with pytest.raises(WriteQueueFull):
+            writes.execute(insert, 'late', database)
+        release.set()
+        assert blocked.result(5) == 'blocker'
+    finally:
+        release.set()
+        writes.shutdown()
+    assert names(database) == ['blocker']
+
+
+def test_running_write_is_waited_for(database):
+    writes = WriteQueue(timeout=0.1, database=database)
+
+    def slow(database):
+        time.sleep(0.3)
+        return insert('slow', database)
+
+    try:
+        assert writes.execute(slow, database) == 'slow'
+    finally:
+        writes.shutdown()
+    assert names(database) == ['slow']
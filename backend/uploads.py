@@ -0,0 +1,93 @@
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+
+# Size of the chunks an upload is copied and hashed in
+CHUNK_SIZE = 64 * 1024
+
+# Number of leading bytes kept to sniff the real file type
+HEADER_SIZE = 512
+
+# Leading bytes of the binary file types we accept, keyed by extension
+MAGIC_NUMBERS = {
+    'pdf': (b'%PDF-',),
+    'docx': (b'PK\x03\x04',),
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+}
+
+# An upload that has been written to a temporary file but not yet moved into place
+StagedUpload = namedtuple('StagedUpload', ['temp_path', 'extension', 'sha256', 'size', 'header'])
+
+
+# Raised when an upload cannot be accepted, status is the HTTP status to answer with
+class UploadRejected(Exception):
+    status = 400
+
+
+class UploadTooLarge(UploadRejected):
+    status = 413
+
+    def __init__(self, max_size):
+        super().__init__(f'File is larger than {max_size} bytes')
+        self.max_size = max_size
+
+
+# Function to get the lower-case extension of a file name
+def file_extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+# Function to check that the first bytes of an upload match its extension.
+# Text files have no signature, they only must not contain NUL bytes.
+def header_matches(extension, header):
+    if extension == 'txt':
+        return b'\x00' not in header
+    signatures = MAGIC_NUMBERS.get(extension)
+    return signatures is None or header.startswith(signatures)
+
+
+# Function to stream an uploaded file into a temporary file next to its final location,
+# computing its SHA-256 on the way and stopping as soon as it grows past max_size.
+# Raises UploadRejected if the content does not match the extension.
+def stage_upload(file_storage, directory, extension, max_size):
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.part')
+    digest = hashlib.sha256()
+    size = 0
+    header = b''
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file_storage.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge(max_size)
+                if len(header) < HEADER_SIZE:
+                    header += chunk[:HEADER_SIZE - len(header)]
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    if not header_matches(extension, header):
+        os.unlink(temp_path)
+        raise UploadRejected('File content does not match its type')
+    return StagedUpload(temp_path, extension, digest.hexdigest(), size, header)
+
+
+# Function to atomically move a staged upload to its final path
+def commit_upload(staged, path):
+    os.chmod(staged.temp_path, 0o644)
+    os.replace(staged.temp_path, path)
+
+
+# Function to remove a staged upload that will not be used
+def discard_upload(staged):
+    try:
+        os.unlink(staged.temp_path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,143 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from db import transaction, savepoint
+
+
+# Raised when too many writes are queued already; answer with 503 and Retry-After
+class WriteQueueFull(Exception):
+    pass
+
+
+# Dedicated writer thread that applies the writes of many requests together. Writes queued
+# within window seconds of each other (up to max_batch of them) share one transaction and so
+# one commit, instead of every request waiting for the write lock on its own. Each write runs
+# in its own savepoint, so a failing write only fails its own future. At most max_queue writes
+# wait at once; any more are refused at once. Each database (see shards.py) has its own queue.
+class WriteQueue:
+    def __init__(self, window=0.002, max_batch=64, max_queue=1000, timeout=10, database=None):
+        self.window = window
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.database = database
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_queue(self):
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.queue = queue.Queue(self.max_queue)
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='db-writer', daemon=True)
+                self.thread.start()
+            return self.queue
+
+    # Function to queue function(*args, **kwargs) for the writer thread and get its future, or
+    # raise WriteQueueFull. The function runs with the writer's connection inside the batch
+    # transaction, in a copy of the caller's context variables; it may use query_db, execute_db
+    # and transaction() on the queue's database as usual, but must not touch the Flask request.
+    # Cancelling the future before the writer picks it up keeps the write from being applied.
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        # A write queued from the writer thread itself could never be picked up, run it in place
+        if threading.current_thread() is self.thread:
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        try:
+            self.get_queue().put_nowait((function, args, kwargs, future, contextvars.copy_context()))
+        except queue.Full:
+            raise WriteQueueFull()
+        return future
+
+    # Function to run a write through the queue and wait for its result once it is committed.
+    # Exceptions raised by the write are raised here. A write still waiting after timeout
+    # seconds is cancelled and WriteQueueFull raised, so it is never applied; one the writer
+    # already started is waited for, as its batch is about to commit.
+    def execute(self, function, *args, **kwargs):
+        future = self.submit(function, *args, **kwargs)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise WriteQueueFull()
+        return future.result()
+
+    # Function to get the number of writes waiting for the writer thread
+    def depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    # Function to stop the writer thread of this process once the writes queued before are
+    # committed. A later submit starts a new thread.
+    def shutdown(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is None or self.pid != os.getpid():
+                return
+            self.queue.put(None)
+        thread.join(self.timeout)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # None is the stop marker queued by shutdown()
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            if batch:
+                self.write(batch)
+
+    # Function to apply one batch in a single transaction. Results are only handed out once
+    # the commit succeeded; if it fails, every write of the batch gets the error.
+    def write(self, batch):
+        outcomes = []
+        try:
+            with transaction(self.database):
+                for function, args, kwargs, future, context in batch:
+                    if not future.set_running_or_notify_cancel():
+                        outcomes.append(None)
+                        continue
+                    try:
+                        with savepoint(database=self.database):
+                            outcomes.append((True, context.run(function, *args, **kwargs)))
+                    except Exception as e:
+                        outcomes.append((False, e))
+        except Exception as e:
+            for _, _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, _, future, _), outcome in zip(batch, outcomes):
+            if outcome is None:
+                continue
+            succeeded, value = outcome
+            if succeeded:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
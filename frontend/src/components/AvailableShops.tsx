@@ -1,5 +1,7 @@
 import { useState, useEffect } from "react";
 import axios from "axios";
+import { addPage, nextCursor } from "../utils/pagination";
+import LoadMoreButton from "./LoadMoreButton";
 
 interface Shop {
   shopkeeper_id: number;
@@ -13,19 +15,22 @@ interface Shop {
 
 const AvailableShops = () => {
   const [shopsData, setShopsData] = useState<Shop[]>([]);
+  const [cursor, setCursor] = useState<string | null>(null);
 
-  useEffect(() => {
-    const fetchShops = async () => {
-      try {
-        const response = await axios.get<Shop[]>(
-          "http://127.0.0.1:5000/api/shops"
-        );
-        setShopsData(response.data);
-      } catch (error) {
-        console.error("Error fetching shops:", error);
-      }
-    };
+  // Fetches the first page of shops, or the page after the given cursor
+  const fetchShops = async (after?: string | null) => {
+    try {
+      const response = await axios.get<Shop[]>("http://127.0.0.1:5000/api/shops", {
+        params: { cursor: after },
+      });
+      setShopsData((prev) => addPage(prev, response, after));
+      setCursor(nextCursor(response));
+    } catch (error) {
+      console.error("Error fetching shops:", error);
+    }
+  };
 
+  useEffect(() => {
     fetchShops();
   }, []);
 
@@ -67,6 +72,11 @@ const AvailableShops = () => {
           </div>
         </div>
       ))}
+      {cursor && (
+        <div className="col-span-full">
+          <LoadMoreButton onClick={() => fetchShops(cursor)} />
+        </div>
+      )}
     </div>
   );
 };
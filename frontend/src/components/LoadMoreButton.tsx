@@ -0,0 +1,18 @@
+interface LoadMoreButtonProps {
+  onClick: () => void;
+}
+
+// Button under a list to fetch its next page
+const LoadMoreButton = ({ onClick }: LoadMoreButtonProps) => (
+  <div className="flex justify-center py-4">
+    <button
+      type="button"
+      onClick={onClick}
+      className="px-4 py-2 bg-blue-500 text-white rounded-md hover:bg-blue-600 transition-colors duration-300"
+    >
+      Load more
+    </button>
+  </div>
+);
+
+export default LoadMoreButton;
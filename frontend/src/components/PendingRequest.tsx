@@ -1,5 +1,7 @@
 import { useState, useEffect } from "react";
 import axios from "axios";
+import { addPage, nextCursor } from "../utils/pagination";
+import LoadMoreButton from "./LoadMoreButton";
 import { useShopkeeper } from "../context/ShopkeeperContext";
 import { useAlert } from '../context/AlertContext';
 import refreshIcon from "../icons/svg/refresh.svg";
@@ -8,6 +10,7 @@ interface Request {
   id: number;
   sender_email: string;
   file_path: string;
+  file_name: string | null;
   status: string;
   request_time?: string;
 }
@@ -16,6 +19,7 @@ const PendingRequest = () => {
   const [requests, setRequests] = useState<Request[]>([]);
   const [readyToPrintIndex, setReadyToPrintIndex] = useState<number | null>(null);
   const [downloadedIndexes, setDownloadedIndexes] = useState<Set<number>>(new Set());
+  const [cursor, setCursor] = useState<string | null>(null);
   const { shopkeeper } = useShopkeeper();
   const { showAlert } = useAlert();
 
@@ -25,21 +29,20 @@ const PendingRequest = () => {
     }
   }, [shopkeeper?.shopkeeper_id]);
 
-  const fetchPendingRequests = async () => {
+  // Fetches the first page of pending requests, or the page after the given cursor
+  const fetchPendingRequests = async (after?: string | null) => {
     try {
-      const response = await axios.get(
-        "http://127.0.0.1:5000/api/shopkeeper/pending_requests",
-        {
-          params: { shopkeeper_id: shopkeeper?.shopkeeper_id },
-          headers: {
-            Authorization: `Bearer ${localStorage.getItem("shopkeeper_token")}`,
-          },
-        }
-      );
+      const response = await axios.get("http://127.0.0.1:5000/api/shopkeeper/pending_requests", {
+        params: { shopkeeper_id: shopkeeper?.shopkeeper_id, cursor: after },
+        headers: {
+          Authorization: `Bearer ${localStorage.getItem("shopkeeper_token")}`,
+        },
+      });
       const requestsData = response.data;
 
       if (Array.isArray(requestsData)) {
-        setRequests(requestsData);
+        setRequests((prev) => addPage(prev, response, after));
+        setCursor(nextCursor(response));
       } else {
         showAlert("info", "No pending requests available at the moment.");
       }
@@ -87,7 +90,7 @@ const PendingRequest = () => {
     setReadyToPrintIndex(null);
   };
 
-  const downloadFile = async (filePath: string) => {
+  const downloadFile = async (filePath: string, fileName: string | null) => {
     try {
       const url = `http://127.0.0.1:5000/api/download/${encodeURIComponent(filePath)}`;
       const response = await axios.get(url, {
@@ -100,7 +103,7 @@ const PendingRequest = () => {
       const blobUrl = window.URL.createObjectURL(new Blob([response.data]));
       const link = document.createElement('a');
       link.href = blobUrl;
-      link.setAttribute('download', filePath);
+      link.setAttribute('download', fileName || filePath);
       document.body.appendChild(link);
       link.click();
       link.remove();
@@ -119,7 +122,7 @@ const PendingRequest = () => {
       <div className="sm:flex sm:items-center sm:justify-between">
         <h2 className="text-3xl font-bold text-gray-800">Pending Requests</h2>
         <button
-          onClick={fetchPendingRequests}
+          onClick={() => fetchPendingRequests()}
           className="hover:animate-rotate px-2 py-2 bg-blue-600 text-white rounded-full hover:bg-blue-700 transition-colors duration-300 flex items-center group"
         >
           <img
@@ -161,10 +164,10 @@ const PendingRequest = () => {
                   <td className="px-4 py-4 text-sm text-gray-700">
                     <a
                       href="#"
-                      onClick={() => downloadFile(request.file_path)}
+                      onClick={() => downloadFile(request.file_path, request.file_name)}
                       className="text-blue-500 hover:underline"
                     >
-                      {request.file_path}
+                      {request.file_name || request.file_path}
                     </a>
                   </td>
                   <td className="px-4 py-4 text-sm">
@@ -211,6 +214,7 @@ const PendingRequest = () => {
             </tbody>
           </table>
         )}
+        {cursor && <LoadMoreButton onClick={() => fetchPendingRequests(cursor)} />}
       </div>
     </section>
   );
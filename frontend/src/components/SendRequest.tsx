@@ -1,5 +1,7 @@
 import { useState, useEffect } from "react";
 import axios from "axios";
+import { addPage, nextCursor } from "../utils/pagination";
+import LoadMoreButton from "./LoadMoreButton";
 import { useUser } from "../context/UserContext";
 import { useAlert } from "../context/AlertContext";
 import trackRequestIcon from "../icons/svg/track_request.svg";
@@ -41,20 +43,25 @@ const SendRequest = () => {
   const [formData, setFormData] = useState<FormData>(initialFormData);
   const [fileSize, setFileSize] = useState<number | null>(null);
   const [shops, setShops] = useState<Shop[]>([]);
+  const [cursor, setCursor] = useState<string | null>(null);
   const { user } = useUser();
   const { showAlert } = useAlert();
 
-  useEffect(() => {
-    const fetchShops = async () => {
-      try {
-        const response = await axios.get("http://127.0.0.1:5000/api/shops");
-        setShops(response.data);
-      } catch (error) {
-        showAlert("warning", "Error fetching shops.");
-        console.error("Error fetching shops:", error);
-      }
-    };
+  // Fetches the first page of shops, or the page after the given cursor
+  const fetchShops = async (after?: string | null) => {
+    try {
+      const response = await axios.get("http://127.0.0.1:5000/api/shops", {
+        params: { cursor: after },
+      });
+      setShops((prev) => addPage(prev, response, after));
+      setCursor(nextCursor(response));
+    } catch (error) {
+      showAlert("warning", "Error fetching shops.");
+      console.error("Error fetching shops:", error);
+    }
+  };
 
+  useEffect(() => {
     fetchShops();
   }, []);
 
@@ -106,6 +113,10 @@ const SendRequest = () => {
     formDataToSend.append("page_size", pageSize);
     formDataToSend.append("no_of_copies", String(no_of_copies));
     formDataToSend.append("shop_name", shop_name);
+    const selectedShop = shops.find((shop) => shop.shop_name === shop_name);
+    if (selectedShop) {
+      formDataToSend.append("shop_id", String(selectedShop.shopkeeper_id));
+    }
     formDataToSend.append("file", file);
     formDataToSend.append("comments", comments);
 
@@ -241,6 +252,7 @@ const SendRequest = () => {
                   </option>
                 ))}
               </select>
+              {cursor && <LoadMoreButton onClick={() => fetchShops(cursor)} />}
             </div>
             <div className="mb-4">
               <label className="block text-gray-700">Comments</label>
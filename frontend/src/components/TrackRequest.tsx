@@ -1,6 +1,8 @@
 import { useEffect, useState } from "react";
 import { useAlert } from "../context/AlertContext";
 import axios from "axios";
+import { addPage, nextCursor } from "../utils/pagination";
+import LoadMoreButton from "./LoadMoreButton";
 import paymentIcon from "../icons/svg/payment.svg";
 
 interface TrackRequest {
@@ -11,6 +13,7 @@ interface TrackRequest {
   page_size: string;
   no_of_copies: number;
   file_path: string;
+  file_name: string | null;
   comments: string;
   status: string;
   action: string;
@@ -23,37 +26,41 @@ const TrackRequest = () => {
   const [expandedNotificationId, setExpandedNotificationId] = useState<
     number | null
   >(null);
+  const [cursor, setCursor] = useState<string | null>(null);
   const { showAlert } = useAlert();
 
-  useEffect(() => {
-    const fetchNotifications = async () => {
-      try {
-        const token = localStorage.getItem("user_token");
-        if (!token) {
-          showAlert("error", "Authorization token not found");
-          return;
-        }
-
-        const response = await axios.get(
-          "http://127.0.0.1:5000/api/user/notifications",
-          {
-            headers: {
-              Authorization: `Bearer ${token}`,
-            },
-          }
-        );
+  // Fetches the first page, or the page after the given cursor
+  const fetchNotifications = async (after?: string | null) => {
+    try {
+      const token = localStorage.getItem("user_token");
+      if (!token) {
+        showAlert("error", "Authorization token not found");
+        return;
+      }
 
-        if (response.status === 200) {
-          setNotifications(response.data);
-        } else {
-          showAlert("warning", "No notifications found");
+      const response = await axios.get(
+        "http://127.0.0.1:5000/api/user/notifications",
+        {
+          params: { cursor: after },
+          headers: {
+            Authorization: `Bearer ${token}`,
+          },
         }
-      } catch (error) {
-        console.error("Error fetching notifications:", error);
-        showAlert("warning", "Error fetching notifications");
+      );
+
+      if (response.status === 200) {
+        setNotifications((prev) => addPage(prev, response, after));
+        setCursor(nextCursor(response));
+      } else {
+        showAlert("warning", "No notifications found");
       }
-    };
+    } catch (error) {
+      console.error("Error fetching notifications:", error);
+      showAlert("warning", "Error fetching notifications");
+    }
+  };
 
+  useEffect(() => {
     fetchNotifications();
   }, []);
 
@@ -87,7 +94,7 @@ const TrackRequest = () => {
     setExpandedNotificationId((prevId) => (prevId === id ? null : id));
   };
 
-  const downloadFile = async (filePath: string) => {
+  const downloadFile = async (filePath: string, fileName: string | null) => {
     try {
       const url = `http://127.0.0.1:5000/api/download/${encodeURIComponent(
         filePath
@@ -103,7 +110,7 @@ const TrackRequest = () => {
       const blobUrl = window.URL.createObjectURL(new Blob([response.data]));
       const link = document.createElement("a");
       link.href = blobUrl;
-      link.setAttribute("download", filePath); // Use the file name for download
+      link.setAttribute("download", fileName || filePath); // Save it under the name it was uploaded with
       document.body.appendChild(link);
       link.click();
       link.remove();
@@ -209,7 +216,7 @@ const TrackRequest = () => {
                     <p>
                       <strong>File Path:</strong>{" "}
                       <button
-                        onClick={() => downloadFile(notification.file_path)}
+                        onClick={() => downloadFile(notification.file_path, notification.file_name)}
                         className="text-blue-500 underline"
                       >
                         View File
@@ -244,6 +251,7 @@ const TrackRequest = () => {
             </div>
           ))
         )}
+        {cursor && <LoadMoreButton onClick={() => fetchNotifications(cursor)} />}
       </div>
     </div>
   );
@@ -2,6 +2,8 @@ import { useEffect, useState } from 'react';
 import { useShopkeeper } from '../../context/ShopkeeperContext';
 import { useAlert } from '../../context/AlertContext';
 import axios from 'axios';
+import { addPage, nextCursor } from '../../utils/pagination';
+import LoadMoreButton from '../LoadMoreButton';
 
 interface UserRequest {
   id: number;
@@ -11,52 +13,58 @@ interface UserRequest {
   page_size: string;
   no_of_copies: number;
   file_path: string;
+  file_name: string | null;
   comments: string;
   sender_email: string;
 }
 
 const ShopkeeperNotification = () => {
   const [requests, setRequests] = useState<UserRequest[]>([]);
+  const [cursor, setCursor] = useState<string | null>(null);
   const { shopkeeper } = useShopkeeper();
   const { showAlert } = useAlert();
 
-  useEffect(() => {
-    const fetchRequests = async () => {
-        try {
-          if (!shopkeeper) {
-            showAlert('error', 'Shopkeeper ID is not available');
-            return;
-          }
-  
-          // Debug log: before sending the request
-          console.log(`Fetching requests for shopkeeper_id: ${shopkeeper.shopkeeper_id}`);
-  
-          const response = await axios.post(
-            `http://127.0.0.1:5000/api/shopkeeper/requests`,
-            { shopkeeper_id: shopkeeper.shopkeeper_id },
-            {
-              headers: {
-                Authorization: `Bearer ${localStorage.getItem('shopkeeper_token')}`,
-              },
-            }
-          );
-  
-          console.log('Response received:', response.data);
-  
-          if (Array.isArray(response.data)) {
-            setRequests(response.data);
-            showAlert('success', 'Requests fetched successfully');
-          } else {
-            setRequests([]);  // Set to an empty array if unexpected format
-            showAlert('info', 'No request found');
-          }
-        } catch (error) {
-          console.error('Error fetching requests:', error);
-          setRequests([]);  // Ensure requests is an array
-          showAlert('error', 'Error fetching requests');
+  // Fetches the first page of requests, or the page after the given cursor
+  const fetchRequests = async (after?: string | null) => {
+    try {
+      if (!shopkeeper) {
+        showAlert('error', 'Shopkeeper ID is not available');
+        return;
+      }
+
+      // Debug log: before sending the request
+      console.log(`Fetching requests for shopkeeper_id: ${shopkeeper.shopkeeper_id}`);
+
+      const response = await axios.post(
+        `http://127.0.0.1:5000/api/shopkeeper/requests`,
+        { shopkeeper_id: shopkeeper.shopkeeper_id },
+        {
+          params: { cursor: after },
+          headers: {
+            Authorization: `Bearer ${localStorage.getItem('shopkeeper_token')}`,
+          },
         }
-      };
-  
+      );
+
+      console.log('Response received:', response.data);
+
+      if (Array.isArray(response.data)) {
+        setRequests(prev => addPage(prev, response, after));
+        setCursor(nextCursor(response));
+        showAlert('success', 'Requests fetched successfully');
+      } else {
+        setRequests([]);  // Set to an empty array if unexpected format
+        setCursor(null);
+        showAlert('info', 'No request found');
+      }
+    } catch (error) {
+      console.error('Error fetching requests:', error);
+      if (!after) setRequests([]);  // Ensure requests is an array, keep the pages already shown
+      showAlert('error', 'Error fetching requests');
+    }
+  };
+
+  useEffect(() => {
     fetchRequests();
   }, [shopkeeper]);
   
@@ -76,7 +84,7 @@ const ShopkeeperNotification = () => {
     }
   };
 
-  const downloadFile = async (filePath: string) => {
+  const downloadFile = async (filePath: string, fileName: string | null) => {
     try {
       const url = `http://127.0.0.1:5000/api/download/${encodeURIComponent(filePath)}`;
       const response = await axios.get(url, {
@@ -90,7 +98,7 @@ const ShopkeeperNotification = () => {
       const blobUrl = window.URL.createObjectURL(new Blob([response.data]));
       const link = document.createElement('a');
       link.href = blobUrl;
-      link.setAttribute('download', filePath); // Use the file name for download
+      link.setAttribute('download', fileName || filePath); // Save it under the name it was uploaded with
       document.body.appendChild(link);
       link.click();
       link.remove();
@@ -120,7 +128,7 @@ const ShopkeeperNotification = () => {
               <p><strong>Comments:</strong> {request.comments.toUpperCase() || 'No Comments Added'}</p>
               <p><strong>File Path:</strong> 
                 <button 
-                  onClick={() => downloadFile(request.file_path)}
+                  onClick={() => downloadFile(request.file_path, request.file_name)}
                   className="text-blue-500 underline"
                 >
                   View File
@@ -143,6 +151,7 @@ const ShopkeeperNotification = () => {
             </div>
           ))
         )}
+        {cursor && <LoadMoreButton onClick={() => fetchRequests(cursor)} />}
       </div>
     </div>
   );
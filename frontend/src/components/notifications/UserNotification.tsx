@@ -1,6 +1,8 @@
 import { useEffect, useState } from "react";
 import { useAlert } from "../../context/AlertContext";
 import axios from "axios";
+import { addPage, nextCursor } from "../../utils/pagination";
+import LoadMoreButton from "../LoadMoreButton";
 import paymentIcon from "../../icons/svg/payment.svg";
 import UpdateRequest from "../UpdateRequest";
 
@@ -9,6 +11,7 @@ interface UserNotification {
   status: string;
   action: string;
   file_path: string;
+  file_name: string | null;
   [key: string]: any; // Add this to allow dynamic key access
 }
 
@@ -18,13 +21,15 @@ const UserNotification = () => {
   const [expandedNotificationId, setExpandedNotificationId] = useState<
     number | null
   >(null);
+  const [cursor, setCursor] = useState<string | null>(null);
   const { showAlert } = useAlert();
 
   useEffect(() => {
     fetchNotifications();
   }, []);
 
-  const fetchNotifications = async () => {
+  // Fetches the first page, or the page after the given cursor
+  const fetchNotifications = async (after?: string | null) => {
     try {
       const token = localStorage.getItem("user_token");
       if (!token) {
@@ -35,6 +40,7 @@ const UserNotification = () => {
       const response = await axios.get(
         "http://127.0.0.1:5000/api/user/notifications",
         {
+          params: { cursor: after },
           headers: {
             Authorization: `Bearer ${token}`,
           },
@@ -42,7 +48,8 @@ const UserNotification = () => {
       );
 
       if (response.status === 200) {
-        setNotifications(response.data);
+        setNotifications((prev) => addPage(prev, response, after));
+        setCursor(nextCursor(response));
       } else {
         showAlert("warning", "No notifications found");
       }
@@ -69,6 +76,33 @@ const UserNotification = () => {
     return colors[status] || "text-gray-500";
   };
 
+  const downloadFile = async (filePath: string, fileName: string | null) => {
+    try {
+      const response = await axios.get(
+        `http://127.0.0.1:5000/api/download/${encodeURIComponent(filePath)}`,
+        {
+          headers: {
+            Authorization: `Bearer ${localStorage.getItem("user_token")}`,
+          },
+          responseType: "blob",
+        }
+      );
+
+      // Save the file under the name it was uploaded with, stored files are named after their content
+      const blobUrl = window.URL.createObjectURL(new Blob([response.data]));
+      const link = document.createElement("a");
+      link.href = blobUrl;
+      link.setAttribute("download", fileName || filePath);
+      document.body.appendChild(link);
+      link.click();
+      link.remove();
+      window.URL.revokeObjectURL(blobUrl);
+    } catch (error) {
+      console.error("Error downloading file:", error);
+      showAlert("error", "Error downloading file");
+    }
+  };
+
   const handleEdit = (id: number) => setEditingRequestId(id);
   const handleDelete = async (id: number) => {
     const confirmed = window.confirm(
@@ -151,14 +185,14 @@ const UserNotification = () => {
               </p>
               <p>
                 <strong>File Path:</strong>{" "}
-                <a
-                  href={notification.file_path}
+                <button
+                  onClick={() =>
+                    downloadFile(notification.file_path, notification.file_name)
+                  }
                   className="text-blue-500 hover:underline"
-                  target="_blank"
-                  rel="noopener noreferrer"
                 >
                   View File
-                </a>
+                </button>
               </p>
 
               {expandedNotificationId === notification.id && (
@@ -229,6 +263,7 @@ const UserNotification = () => {
             </div>
           ))
         )}
+        {cursor && <LoadMoreButton onClick={() => fetchNotifications(cursor)} />}
       </div>
 
       {editingRequestId !== null && (
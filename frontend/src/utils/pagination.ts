@@ -0,0 +1,17 @@
+import { AxiosResponse } from "axios";
+
+// List endpoints return one page at a time and send the cursor of the next page in the
+// X-Next-Cursor header, none after the last page. List views show the first page and fetch
+// the next one only when the user asks for more.
+export const nextCursor = (response: AxiosResponse): string | null =>
+  response.headers["x-next-cursor"] || null;
+
+// Rows shown after a page arrives: the first page (no cursor) replaces them, later pages are appended
+export const addPage = <T>(
+  rows: T[],
+  response: AxiosResponse,
+  cursor?: string | null
+): T[] => {
+  const page: T[] = Array.isArray(response.data) ? response.data : [];
+  return cursor ? rows.concat(page) : page;
+};